@@ -0,0 +1,189 @@
+from scipy.constants import epsilon_0, mu_0
+import argparse
+import csv
+import numpy as np
+import os
+import shutil
+import sys
+
+
+# first pass settings, the loop refines from there
+COARSE_SETTINGS = {
+    'Threshold.SizeMin': 0.04,
+    'Threshold.SizeMax': 0.25,
+}
+
+
+def _node_ids(coords, tol=1.0e-9):
+    """Shared node index of every (element, node) of a discontinuous view"""
+    scale = max(np.abs(coords).max(), 1.0)
+    keys = np.round(coords.reshape(-1, 3) / (tol * scale)).astype(np.int64)
+    _, ids = np.unique(keys, axis=0, return_inverse=True)
+    return ids.reshape(coords.shape[:2])
+
+
+def indicator(e_store, h_store):
+    """
+    Recovery (Zienkiewicz-Zhu) error indicator of tetrahedral e and h
+    views: the energy of the difference between each element's nodal
+    values and their average over the elements sharing the node,
+    relative to the total field energy.
+
+    Returns element node coordinates (E, 4, 3), mean edge length (E)
+    and the indicator (E).
+    """
+    coords = e_store.element_nodes()[:, :4]
+    if coords.shape[1] != 4 or len(h_store) != len(e_store):
+        raise ValueError('e and h must be the same tetrahedral view')
+    ids = _node_ids(coords)
+    n = ids.max() + 1
+    energy = []
+    recovered = []
+    for store, weight in ((e_store, epsilon_0), (h_store, mu_0)):
+        values = np.asarray(store.values)[:, :4]
+        mean = np.zeros((n, 3), dtype=complex)
+        count = np.bincount(ids.ravel(), minlength=n)[:, None]
+        for c in range(3):
+            mean[:, c] = np.bincount(ids.ravel(), values[..., c].real.ravel(),
+                                     n) + \
+                1j * np.bincount(ids.ravel(), values[..., c].imag.ravel(), n)
+        mean /= count
+        jump = np.abs(values - mean[ids]) ** 2
+        energy.append(weight * jump.sum(axis=2).mean(axis=1))
+        recovered.append(weight * (np.abs(mean[ids]) ** 2).sum(axis=2)
+                         .mean(axis=1))
+
+    a, b, c, d = (coords[:, i] for i in range(4))
+    volume = np.abs(np.einsum('ij,ij->i', b - a, np.cross(c - a, d - a))) / 6.0
+    edges = [b - a, c - a, d - a, c - b, d - b, d - c]
+    size = np.mean([np.linalg.norm(v, axis=1) for v in edges], axis=0)
+    total = np.sum(volume * sum(recovered))
+    eta = volume * sum(energy) / max(total, np.finfo(float).tiny)
+    return coords, size, eta
+
+
+def sizes(size, eta, frozen=None, reduce=0.5, refine=0.25, coarsen=2.0,
+          size_min=5.0e-4, size_max=0.30):
+    """
+    New element sizes equidistributing the indicator. For first order
+    edge elements eta ~ h^5, so h is scaled by (target / eta)^(1/5),
+    target being reduce times the mean indicator. Frozen elements
+    (e.g. the PML) keep their size.
+    """
+    target = reduce * np.mean(eta)
+    factor = (target / np.maximum(eta, np.finfo(float).tiny)) ** 0.2
+    factor = np.clip(factor, refine, coarsen)
+    if frozen is not None:
+        factor[frozen] = 1.0
+    return np.clip(size * factor, size_min, size_max)
+
+
+def write_size_view(filename, coords, size, name='size'):
+    """Scalar tetrahedron view of the target size, for a PostView field"""
+    rows = np.concatenate([coords.reshape(-1, 12), np.repeat(
+        size[:, None], 4, axis=1)], axis=1)
+    with open(filename, 'w') as f:
+        f.write(f'View "{name}" {{\n')
+        for start in range(0, len(rows), 65536):
+            block = rows[start:start + 65536]
+            f.write(''.join(
+                'SS(' + ','.join(map(repr, r[:12])) + '){' +
+                ','.join(map(repr, r[12:])) + '};\n' for r in block))
+        f.write('};\n')
+
+
+def apply_size_view(filename):
+    """Merge a size view and make it the only background size field"""
+    from gmsh import model
+    import gmsh
+
+    gmsh.merge(filename)
+    view = gmsh.view.get_tags()[-1]
+    field = model.mesh.field
+    tag = field.add('PostView')
+    field.set_number(tag, 'ViewTag', view)
+    field.set_as_background_mesh(tag)
+
+
+def refine(antenna, tol=0.05, max_passes=6, reduce=0.5,
+           frozen_radius=None, root='.'):
+    """
+    Solve, estimate, remesh until S11 changes by less than tol dB.
+    Needs an initialized session (mstrip.setup_onelab) and runs in root,
+    every pass leaves its mesh and size view as pass_NN.*.
+    Returns one record per pass.
+    """
+    from gmsh import onelab
+    import mstrip
+    import pos_reader
+
+    if frozen_radius is None:
+        frozen_radius = antenna.dims['r_air']
+    history = []
+    size_view = None
+    s11 = None
+    for i in range(max_passes):
+        antenna.refresh()
+        pro = mstrip.create_problem(antenna)
+        mstrip.solve(pro, antenna, None, size_view=size_view)
+        previous, s11 = s11, onelab.get_number('s11')[0]
+        e = pos_reader.convert('build/e.pos', f'build/e_{i:02d}.store',
+                               f'{mstrip.MODEL_NAME}.msh')
+        h = pos_reader.convert('build/h.pos', f'build/h_{i:02d}.store',
+                               f'{mstrip.MODEL_NAME}.msh')
+        e_store = next(s for s in e.values() if s.kind == 'VS')
+        h_store = next(s for s in h.values() if s.kind == 'VS')
+        coords, size, eta = indicator(e_store, h_store)
+        record = {'pass': i, 's11': s11, 'elements': len(eta),
+                  'error': float(np.sum(eta))}
+        history.append(record)
+        print(f'pass {i}: {len(eta)} tetrahedra, s11 {s11:.3f} dB, '
+              f'indicator {record["error"]:.3e}')
+        shutil.copyfile(f'{mstrip.MODEL_NAME}.msh',
+                        os.path.join(root, f'pass_{i:02d}.msh'))
+        if previous is not None and abs(s11 - previous) < tol:
+            break
+        frozen = np.linalg.norm(coords.mean(axis=1), axis=1) > frozen_radius
+        size_view = os.path.join(root, f'pass_{i + 1:02d}_size.pos')
+        write_size_view(size_view, coords,
+                        sizes(size, eta, frozen, reduce))
+    return history
+
+
+def main(argv=None):
+    import gmsh
+    import mstrip
+
+    parser = argparse.ArgumentParser(
+        description='Adaptive mesh refinement driven by an a-posteriori '
+                    'error indicator')
+    parser.add_argument('--tol', type=float, default=0.05,
+                        help='stop when S11 changes by less (dB)')
+    parser.add_argument('--max-passes', type=int, default=6)
+    parser.add_argument('--reduce', type=float, default=0.5,
+                        help='target indicator relative to the mean')
+    parser.add_argument('--size-min', type=float,
+                        default=COARSE_SETTINGS['Threshold.SizeMin'],
+                        help='first pass Threshold.SizeMin')
+    parser.add_argument('--size-max', type=float,
+                        default=COARSE_SETTINGS['Threshold.SizeMax'],
+                        help='first pass Threshold.SizeMax')
+    parser.add_argument('-o', '--output', default='adaptive_mesh.csv')
+    args = parser.parse_args(argv)
+
+    mstrip.setup_onelab()
+    antenna = mstrip.Mspa(mstrip.MODEL_NAME, lazy=True, mesh_settings={
+        'Threshold.SizeMin': args.size_min,
+        'Threshold.SizeMax': args.size_max,
+    })
+    history = refine(antenna, args.tol, args.max_passes, args.reduce)
+    gmsh.finalize()
+    with open(args.output, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=list(history[0]))
+        writer.writeheader()
+        writer.writerows(history)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,202 @@
+import argparse
+import csv
+import numpy as np
+import os
+import sys
+
+
+ZL = 50.0  # Ohm, same load as zl in the generated .pro
+
+
+def reflection(y, zl=ZL):
+    return (1.0 - zl * y) / (1.0 + zl * y)
+
+
+def s11_db(y, zl=ZL):
+    return 20.0 * np.log10(np.abs(reflection(y, zl)))
+
+
+class RationalModel(object):
+    '''
+    Barycentric rational interpolant of complex samples (AAA algorithm)
+
+    Support points are picked greedily where the current fit is worst,
+    the weights come from the null vector of the Loewner matrix.
+    '''
+
+    def __init__(self, x, y, tol=1.0e-9, max_order=None):
+        super().__init__()
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=complex)
+        # work on [-1, 1] to keep the Loewner matrix well conditioned
+        self.center = 0.5 * (x.max() + x.min())
+        self.scale = max(0.5 * (x.max() - x.min()), np.finfo(float).tiny)
+        z = (x - self.center) / self.scale
+        if max_order is None:
+            max_order = len(z) - 1
+
+        free = np.ones(len(z), dtype=bool)
+        r = np.full(len(z), np.mean(y))
+        support = []
+        for _ in range(max_order + 1):
+            j = np.argmax(np.where(free, np.abs(y - r), -1.0))
+            support.append(j)
+            free[j] = False
+            zj = z[support]
+            yj = y[support]
+            c = 1.0 / (z[free, None] - zj[None, :])
+            loewner = (y[free, None] - yj[None, :]) * c
+            _, _, vh = np.linalg.svd(loewner, full_matrices=True)
+            w = vh[-1].conj()
+            r = y.copy()
+            r[free] = (c @ (w * yj)) / (c @ w)
+            if not free.any() or \
+                    np.max(np.abs(y - r)) <= tol * np.max(np.abs(y)):
+                break
+        self.zj = zj
+        self.yj = yj
+        self.w = w
+
+    def __call__(self, x):
+        z = (np.atleast_1d(np.asarray(x, dtype=float)) - self.center) / \
+            self.scale
+        d = z[:, None] - self.zj[None, :]
+        exact = d == 0.0
+        d[exact] = 1.0
+        c = 1.0 / d
+        r = (c @ (self.w * self.yj)) / (c @ self.w)
+        rows, cols = np.nonzero(exact)
+        r[rows] = self.yj[cols]
+        return r
+
+    @property
+    def order(self):
+        return len(self.zj) - 1
+
+
+def _next_frequencies(grid, error, sampled, count):
+    span = grid[-1] - grid[0]
+    gap = span / (2.0 * (len(sampled) + count))
+    chosen = []
+    for i in np.argsort(error)[::-1]:
+        f = grid[i]
+        taken = np.concatenate([sampled, chosen])
+        if np.min(np.abs(taken - f)) > gap:
+            chosen.append(f)
+        if len(chosen) == count:
+            break
+    return np.array(chosen)
+
+
+def adaptive_sweep(solve, fmin, fmax, tol=1.0e-3, n_init=5, n_max=40,
+                   batch=1, n_grid=2001, zl=ZL):
+    """
+    Sample y(f) where a rational fit of it is least certain.
+
+    solve maps an array of frequencies to an array of complex y.
+    The error indicator is the change of the reflection coefficient
+    between two successive fits (the first fit is compared with a fit
+    through every other sample), refinement stops when it is below
+    tol everywhere on the grid or n_max samples were solved. Each
+    step solves up to batch new samples, never more than the grid
+    points still above tol.
+
+    Returns sampled frequencies, sampled y and the final RationalModel.
+    """
+    grid = np.linspace(fmin, fmax, n_grid)
+    freqs = np.linspace(fmin, fmax, n_init)
+    y = np.asarray(solve(freqs), dtype=complex)
+    previous = RationalModel(freqs[::2], y[::2])
+    while True:
+        current = RationalModel(freqs, y)
+        error = np.abs(reflection(current(grid), zl) -
+                       reflection(previous(grid), zl))
+        if error.max() <= tol or len(freqs) >= n_max:
+            break
+        count = min(batch, n_max - len(freqs),
+                    int(np.count_nonzero(error > tol)))
+        new = _next_frequencies(grid, error, freqs, count)
+        if len(new) == 0:
+            break
+        freqs = np.concatenate([freqs, new])
+        y = np.concatenate([y, np.asarray(solve(new), dtype=complex)])
+        order = np.argsort(freqs)
+        freqs = freqs[order]
+        y = y[order]
+        previous = current
+    return freqs, y, current
+
+
+def sweep_solver(root='adaptive', workers=None, cache_dir=None,
+                 design_frequency=None, **params):
+    """
+    solve() callback running full-wave points through sweep.run,
+    each refinement step in its own directory under root. Every step
+    meshes the domain sized for design_frequency (MHz), the top of the
+    band, so the fit sees a single model.
+    """
+    import sweep
+
+    step = [0]
+
+    def solve(freqs):
+        points = [dict(params, frequency=float(f)) for f in freqs]
+        rows = sweep.run(points, os.path.join(root, f'step_{step[0]:03d}'),
+                         workers, cache_dir=cache_dir,
+                         design_frequency=design_frequency)
+        step[0] += 1
+        for r in rows:
+            if r['error']:
+                raise RuntimeError(
+                    f"{r['frequency']} MHz failed: {r['error']}")
+        return [complex(r['y_re'], r['y_im']) for r in rows]
+
+    return solve
+
+
+def main(argv=None):
+    import sweep
+
+    parser = argparse.ArgumentParser(
+        description='Adaptive S11 sweep with rational interpolation of y')
+    parser.add_argument('--fmin', type=float, required=True, help='MHz')
+    parser.add_argument('--fmax', type=float, required=True, help='MHz')
+    parser.add_argument('--tol', type=float, default=1.0e-3,
+                        help='max change of the reflection coefficient')
+    parser.add_argument('--n-init', type=int, default=5)
+    parser.add_argument('--n-max', type=int, default=40)
+    parser.add_argument('--n-grid', type=int, default=2001)
+    parser.add_argument('--batch', type=int, default=2,
+                        help='new samples per refinement step')
+    for name in ('epr',) + sweep.MSPA_PARAMS:
+        parser.add_argument(f'--{name}', type=float)
+    parser.add_argument('-j', '--workers', type=int, default=None)
+    parser.add_argument('-d', '--root', default='adaptive')
+    parser.add_argument('-o', '--output', default='s11.csv')
+    args = parser.parse_args(argv)
+
+    workers = args.workers or os.cpu_count()
+    params = {name: getattr(args, name)
+              for name in ('epr',) + sweep.MSPA_PARAMS
+              if getattr(args, name) is not None}
+    solve = sweep_solver(args.root, workers, design_frequency=args.fmax,
+                         **params)
+    freqs, y, fit = adaptive_sweep(
+        solve, args.fmin, args.fmax, args.tol, args.n_init, args.n_max,
+        batch=args.batch, n_grid=args.n_grid)
+
+    grid = np.linspace(args.fmin, args.fmax, args.n_grid)
+    yf = fit(grid)
+    with open(args.output, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['frequency', 'y_re', 'y_im', 's11', 'solved'])
+        for fi, yi in zip(grid, yf):
+            writer.writerow([fi, yi.real, yi.imag, s11_db(yi), 0])
+        for fi, yi in zip(freqs, y):
+            writer.writerow([fi, yi.real, yi.imag, s11_db(yi), 1])
+    print(f'{len(freqs)} solves, rational order {fit.order}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,279 @@
+from concurrent.futures import ProcessPoolExecutor
+import argparse
+import datetime
+import importlib
+import itertools
+import json
+import meshing
+import multiprocessing
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import traceback
+
+
+SOURCE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# design frequency (MHz) and mesh setting axes of each antenna model,
+# mstrip.create_problem models the coaxial feed of patch_137 only
+MODELS = {
+    'patch_137': {
+        'frequency': 137.1,
+        'solve': True,
+        'matrix': {
+            'Threshold.SizeMin': [0.02, 0.01],
+            'Threshold.SizeMax': [0.30, 0.20],
+            'Threshold.DistMax': [0.20],
+            'Cylinder.VIn': [0.001, 0.0005],
+            'Cylinder.VOut': [0.30],
+            'Distance.NumPointsPerCurve': [10, 20],
+        },
+    },
+    'comsol_patch_1575': {
+        'frequency': 1575.0,
+        'solve': False,
+        'matrix': {
+            'Threshold.SizeMin': [0.0100, 0.0075],
+            'Threshold.SizeMax': [0.015],
+            'Threshold.DistMax': [0.010],
+            'Distance.NumPointsPerCurve': [50, 100],
+        },
+    },
+}
+COLUMNS = ['model', 'case', 'backend', 'settings', 'mesh_time',
+           'tetrahedra', 'nodes', 'edges', 'faces', 'dofs', 'quality_min',
+           'quality_mean', 'solve_time', 'peak_rss_mb',
+           'process_peak_rss_children_mb', 's11', 'note', 'error']
+
+
+def cases(model, matrix=None):
+    """Cartesian product of the setting axes valid for model"""
+    module = importlib.import_module(model)
+    matrix = MODELS[model]['matrix'] if matrix is None else matrix
+    unknown = [name for name in matrix if name not in module.MESH_SETTINGS]
+    if unknown:
+        raise ValueError(f'{model} has no mesh settings {unknown}')
+    names = list(matrix)
+    return [dict(zip(names, values))
+            for values in itertools.product(*matrix.values())]
+
+
+def _stage(stages, name, key):
+    return sum(s.get(key, 0.0) for s in stages if s['name'] == name)
+
+
+def measure(model, index, settings, root, backend=None):
+    """
+    Mesh and solve one case in its own directory and process, never
+    through the mesh cache so the meshing time is real. Models the
+    generated problem does not support are measured up to the mesh.
+    Only y and s11 are post-processed, so solve_time is the solve.
+    backend names the meshing.BACKENDS the settings select, if any.
+    """
+    build_dir = os.path.join(os.path.abspath(root), f'{model}_{index:03d}')
+    shutil.rmtree(build_dir, ignore_errors=True)
+    os.makedirs(build_dir)
+    shutil.copy(os.path.join(SOURCE_DIR, 'defines.pro'), build_dir)
+    os.chdir(build_dir)
+
+    from gmsh import onelab
+    import gmsh
+    import mstrip
+    import profiling
+
+    row = dict.fromkeys(COLUMNS, '')
+    row.update(model=model, case=index, backend=backend or '',
+               settings=settings)
+    mstrip.setup_onelab()
+    profiler = profiling.Profiler('profile.json')
+    try:
+        with profiler:
+            onelab.set_number('Model/Frequency', [MODELS[model]['frequency']])
+            module = importlib.import_module(model)
+            antenna = module.Mspa(mstrip.MODEL_NAME,
+                                  mesh_settings=settings)
+            if MODELS[model]['solve']:
+                # port quantities only, writing fields is not solving
+                pro = mstrip.create_problem(antenna, output='s11')
+                mstrip.solve(pro, antenna)
+                row['s11'] = onelab.get_number('s11')[0]
+            else:
+                row['note'] = 'mesh only'
+                antenna.mesh(f'{mstrip.MODEL_NAME}.msh')
+            row.update(meshing.quality())
+    except Exception:
+        row['error'] = traceback.format_exc(limit=1).strip().splitlines()[-1]
+    finally:
+        gmsh.finalize()
+    stages = profiler.stages
+    row['mesh_time'] = _stage(stages, 'mesh_generate', 'wall')
+    row['solve_time'] = _stage(stages, 'solve', 'wall')
+    for record in stages:
+        if record['name'] == 'mesh_generate':
+            for key in ('tetrahedra', 'nodes', 'edges', 'faces', 'dofs'):
+                row[key] = record.get(key, '')
+    if stages:
+        # stage peaks where measured, else the worker's lifetime peak
+        peaks = [s['peak_rss_mb'] for s in stages
+                 if s['peak_rss_mb'] is not None]
+        row['peak_rss_mb'] = max(peaks) if peaks else \
+            stages[-1]['process_peak_rss_mb']
+        row['process_peak_rss_children_mb'] = \
+            stages[-1]['process_peak_rss_children_mb']
+    return row
+
+
+def _git_revision():
+    try:
+        out = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                             cwd=SOURCE_DIR, capture_output=True, text=True,
+                             check=True)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return out.stdout.strip()
+
+
+def environment():
+    """What a result depends on besides the mesh settings"""
+    import gmsh
+
+    return {
+        'date': datetime.datetime.now().isoformat(timespec='seconds'),
+        'revision': _git_revision(),
+        'host': platform.node(),
+        'cpus': os.cpu_count(),
+        'python': platform.python_version(),
+        'gmsh': gmsh.__version__,
+    }
+
+
+def run(models, root='benchmark', workers=1, matrices=None, backends=None,
+        threads=None):
+    """
+    Rows of every case of every model. One worker by default,
+    concurrent cases would compete for cores and skew the timings.
+    With backends (see meshing.BACKENDS), every case is meshed by each
+    of them on threads, to compare their time, quality and s11.
+    """
+    matrices = matrices or {}
+    jobs = []
+    for m in models:
+        variants = [(c, b) for c in cases(m, matrices.get(m))
+                    for b in backends or [None]]
+        for i, (c, b) in enumerate(variants):
+            if b is not None:
+                c = meshing.backend_settings(c, b, threads)
+            jobs.append((m, i, c, root, b))
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=workers,
+                             mp_context=context) as pool:
+        futures = [pool.submit(measure, *job) for job in jobs]
+        return [f.result() for f in futures]
+
+
+def save(rows, filename, env=None):
+    """Append one run (environment plus rows) as a JSON line"""
+    record = {'environment': env or environment(), 'rows': rows}
+    with open(filename, 'a') as f:
+        f.write(json.dumps(record) + '\n')
+    return record
+
+
+def load(filename):
+    with open(filename) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def compare(old, new):
+    """Per case (model, settings) changes between two saved runs"""
+    def key(row):
+        return row['model'], json.dumps(row['settings'], sort_keys=True)
+
+    before = {key(r): r for r in old['rows']}
+    changes = []
+    for row in new['rows']:
+        r = before.get(key(row))
+        if r is None:
+            continue
+        change = {'model': row['model'], 'settings': row['settings']}
+        for name in ('mesh_time', 'solve_time', 'tetrahedra', 'quality_min',
+                     'peak_rss_mb', 's11'):
+            a, b = r.get(name, ''), row[name]
+            change[name] = (a, b)
+        changes.append(change)
+    return changes
+
+
+def _print_rows(rows):
+    print(f"{'model':18} {'case':>4} {'backend':>8} {'mesh s':>8} "
+          f"{'tets':>9} {'q min':>6} {'solve s':>8} {'rss MB':>8} "
+          f"{'s11 dB':>8}  error")
+    for r in rows:
+        def num(value, fmt):
+            return format(value, fmt) if value != '' else '-'
+        print(f"{r['model']:18} {r['case']:>4} {r['backend'] or '-':>8} "
+              f"{num(r['mesh_time'], '8.2f'):>8} "
+              f"{num(r['tetrahedra'], '9d'):>9} "
+              f"{num(r['quality_min'], '6.3f'):>6} "
+              f"{num(r['solve_time'], '8.2f'):>8} "
+              f"{num(r['peak_rss_mb'], '8.0f'):>8} "
+              f"{num(r['s11'], '8.2f'):>8}  {r['error']}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Mesh/solve benchmark of the antenna models over a '
+                    'matrix of mesh settings')
+    parser.add_argument('models', nargs='*', metavar='model',
+                        help=f'default: all of {", ".join(MODELS)}')
+    parser.add_argument('--matrix', default=None,
+                        help='JSON file {model: {setting: [values]}}')
+    parser.add_argument('-j', '--workers', type=int, default=1)
+    parser.add_argument('-d', '--root', default='benchmark',
+                        help='directory for per-case builds')
+    parser.add_argument('-o', '--output', default='benchmark.jsonl',
+                        help='results history, one run per line')
+    parser.add_argument('--backends', nargs='+', default=None,
+                        choices=list(meshing.BACKENDS),
+                        help='mesh every case with each of these 3D '
+                             'algorithms')
+    parser.add_argument('--threads', type=int, default=None,
+                        help='with --backends, meshing threads, default '
+                             'all the cores')
+    parser.add_argument('--compare', action='store_true',
+                        help='compare the last two runs of --output')
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        runs = load(args.output)
+        if len(runs) < 2:
+            parser.error(f'{args.output} holds {len(runs)} runs')
+        old, new = runs[-2], runs[-1]
+        print(f"{old['environment']['date']} -> {new['environment']['date']}")
+        for c in compare(old, new):
+            print(c['model'], json.dumps(c['settings'], sort_keys=True))
+            for name in ('mesh_time', 'solve_time', 'tetrahedra',
+                         'quality_min', 'peak_rss_mb', 's11'):
+                print(f'    {name:12} {c[name][0]!s:>14} -> '
+                      f'{c[name][1]!s:>14}')
+        return 0
+
+    models = args.models or list(MODELS)
+    for model in models:
+        if model not in MODELS:
+            parser.error(f'unknown model {model}')
+    matrices = None
+    if args.matrix is not None:
+        with open(args.matrix) as f:
+            matrices = json.load(f)
+    rows = run(models, args.root, args.workers, matrices, args.backends,
+               args.threads)
+    save(rows, args.output)
+    _print_rows(rows)
+    return 1 if any(r['error'] for r in rows) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
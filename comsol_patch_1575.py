@@ -1,19 +1,63 @@
+from entity_index import EntityIndex
 import gmsh
 import math
 import os
 import sys
 import numpy as np
+import profiling
+import symmetry
+import truncation
+
+MM = 1.0e-3
+FREQUENCY = 1575.0  # MHz, design frequency, sizes the air and PML spheres
+MESH_SETTINGS = {
+    # 1: MeshAdapt, 2: Automatic, 3: Initial mesh only,
+    # 5: Delaunay, 6: Frontal-Delaunay, 7: BAMG,
+    # 8: Frontal-Delaunay for Quads, 9: Packing of Parallelograms
+    'Mesh.Algorithm': 2,
+    # 1: Delaunay, 3: Initial mesh only,
+    # 4: Frontal, 7: MMG3D, 9: R-tree, 10: HXT
+    'Mesh.Algorithm3D': 4,
+    'Mesh.Optimize': 1,
+    'Mesh.Smoothing': 5,
+    'Mesh.MeshSizeExtendFromBoundary': 0,
+    'Mesh.MeshSizeFromPoints': 0,
+    'Mesh.MeshSizeFromCurvature': 0,
+    'Distance.NumPointsPerCurve': 100,
+    'Threshold.SizeMin': 7.5 * MM,
+    'Threshold.SizeMax': 15.0 * MM,
+    'Threshold.DistMin': 0.0 * MM,
+    'Threshold.DistMax': 10.0 * MM,
+    'Size.Conductor': 5.0 * MM,  # 2.5
+    'Size.Substrate': 5.0 * MM,
+    'Size.Environment': 15.0 * MM,
+}
 
 
 class Mspa(object):
     '''
     Microstrip patch antenna
+
+    The model is mirror symmetric about x = 0, symmetry='x=0' builds
+    the x >= 0 half only, with a symmetry_bc 'pmc' (the quasi-TEM line
+    mode) or 'pec' wall on the plane.
+
+    The air and PML spheres are sized for frequency (MHz) as in
+    patch_137.
     '''
 
-    def __init__(self, name='untitled'):
+    def __init__(self, name='untitled', mesh_settings=None, symmetry=None,
+                 symmetry_bc='pmc', frequency=FREQUENCY,
+                 air_fraction=truncation.AIR_FRACTION,
+                 pml_fraction=truncation.PML_FRACTION):
         super().__init__()
 
         self.name = name
+        self.symmetry = symmetry
+        self.symmetry_bc = symmetry_bc
+        self.frequency = frequency
+        self.air_fraction = air_fraction
+        self.pml_fraction = pml_fraction
 
         mm = 1.0e-3
         mil = 0.0254 * mm
@@ -36,14 +80,25 @@ class Mspa(object):
         self.dims['l_stub'] = l_stub
         self.dims['w_sub'] = w_sub
         self.dims['l_sub'] = l_sub
+        self.dims.update(truncation.radii(
+            [-0.5 * w_sub, -0.5 * l_sub, -0.5 * d,
+             0.5 * w_sub, 0.5 * l_sub, 0.5 * d],
+            frequency, air_fraction, pml_fraction))
 
         self.tags = {}
+        self.mesh_settings = dict(MESH_SETTINGS)
+        self.mesh_settings.update(mesh_settings or {})
 
         gmsh.initialize()
-        gmsh.model.add(self.name)
-        self._create_antenna()
-        gmsh.model.occ.synchronize()
-        self._set_mesh_settings()
+        with profiling.stage('occ_build'):
+            gmsh.model.add(self.name)
+            self._create_antenna()
+            gmsh.model.occ.synchronize()
+            if self.symmetry is not None:
+                self._cut_half()
+            self._find_surfaces()
+        with profiling.stage('mesh_settings'):
+            self._set_mesh_settings()
         self._create_groups()
 
     def _create_antenna(self):
@@ -80,9 +135,9 @@ class Mspa(object):
                           tag=0, removeObject=True, removeTool=True)
         vol_patch = tags[0]
 
-        tag = occ.addSphere(0.0, 0.0, 0.0, l_sub)
+        tag = occ.addSphere(0.0, 0.0, 0.0, self.dims['r_air'])
         vol_air = (3, tag)
-        tag = occ.addSphere(0.0, 0.0, 0.0, l_sub + 0.02)
+        tag = occ.addSphere(0.0, 0.0, 0.0, self.dims['r_pml'])
         vol_pml = (3, tag)
 
         occ.synchronize()
@@ -104,47 +159,68 @@ class Mspa(object):
         occ.synchronize()
         occ.removeAllDuplicates()
 
-        self.tags['sur_feed'] = (2, 18)
-        self.tags['sur_gnd'] = (2, 24)
-        self.tags['sur_gnd1'] = (2, 11)
-        self.tags['sur_patch'] = (2, 9)
         self.tags['sur_pml'] = sur_pml
         self.tags['vol_air'] = vol_air
         self.tags['vol_patch'] = vol_patch
         self.tags['vol_pml'] = vol_pml
         self.tags['vol_substrate'] = vol_substrate
 
+    def _cut_half(self):
+        symmetry.check(self.symmetry)
+        kept = symmetry.cut_half(self.symmetry, self.dims['r_pml'])
+        for name in ('vol_air', 'vol_patch', 'vol_pml', 'vol_substrate'):
+            self.tags[name] = (3, kept[self.tags[name][1]][0])
+        self.tags['sur_pml'] = symmetry.outer_face(self.tags['vol_pml'],
+                                                   self.symmetry)
+        self.tags['sur_symmetry'] = symmetry.on_plane(self.symmetry)
+
+    def _box(self, box):
+        if self.symmetry is None:
+            return box
+        return symmetry.clip(box, self.symmetry)
+
+    def _find_surfaces(self):
+        d = self.dims['d']
+        w_line = self.dims['w_line']
+        w_path = self.dims['w_path']
+        l_patch = self.dims['l_patch']
+        w_sub = self.dims['w_sub']
+        l_sub = self.dims['l_sub']
+        z_bot = -0.5 * d
+        z_top = 0.5 * d
+
+        index = EntityIndex(2)
+
+        # port: feed line cross-section on the patch edge
+        tags = index.matching(self._box([-0.5 * w_line, -0.5 * l_patch, z_bot,
+                                         0.5 * w_line, -0.5 * l_patch,
+                                         z_top]))
+        self.tags['sur_feed'] = index.one(tags, 'feed port')
+
+        tags = index.matching(self._box([-0.5 * w_sub, -0.5 * l_sub, z_bot,
+                                         0.5 * w_sub, 0.5 * l_sub, z_bot]))
+        self.tags['sur_gnd'] = index.one(tags, 'ground plane')
+
+        tags = index.matching(self._box([-0.5 * w_path, -0.5 * l_patch, z_bot,
+                                         0.5 * w_path, 0.5 * l_patch,
+                                         z_bot]))
+        self.tags['sur_gnd1'] = index.one(tags, 'ground under patch')
+
+        tags = index.matching(self._box([-0.5 * w_path, -0.5 * l_patch, z_top,
+                                         0.5 * w_path, 0.5 * l_patch,
+                                         z_top]))
+        self.tags['sur_patch'] = index.one(tags, 'patch')
+
     def _set_mesh_settings(self):
-        gmsh.option.setNumber('General.Antialiasing', 1)
-        gmsh.option.setNumber('General.AlphaBlending', 1)
-        gmsh.option.setNumber('View.FakeTransparency', 1)
-
-        # 1: MeshAdapt, 2: Automatic, 3: Initial mesh only,
-        # 5: Delaunay, 6: Frontal-Delaunay, 7: BAMG,
-        # 8: Frontal-Delaunay for Quads, 9: Packing of Parallelograms
-        gmsh.option.setNumber('Mesh.Algorithm', 2)
-        # 1: Delaunay, 3: Initial mesh only,
-        # 4: Frontal, 7: MMG3D, 9: R-tree, 10: HXT
-        gmsh.option.setNumber('Mesh.Algorithm3D', 4)
-        gmsh.option.setNumber('Mesh.Optimize', 1)
-        gmsh.option.setNumber('Mesh.Smoothing', 5)
-        gmsh.option.setNumber('Mesh.SmoothNormals', 1)
-        # 0: By element type
-        # 1: By elementary entity
-        # 2: By physical group
-        # 3: By mesh partition
-        gmsh.option.setNumber('Mesh.ColorCarousel', 2)
-        gmsh.option.setNumber('Mesh.VolumeEdges', 0)
-
-        gmsh.option.setNumber("Mesh.MeshSizeExtendFromBoundary", 0)
-        gmsh.option.setNumber("Mesh.MeshSizeFromPoints", 0)
-        gmsh.option.setNumber("Mesh.MeshSizeFromCurvature", 0)
+        settings = self.mesh_settings
+        for name, value in settings.items():
+            if name.startswith('Mesh.'):
+                gmsh.option.setNumber(name, value)
 
         # mesh sizes by elements
-        mm = 1.0e-3
-        mesh_size_condutor = 5.0 * mm  # 2.5
-        mesh_size_substrate = 5.0 * mm
-        mesh_size_environment = 15.0 * mm
+        mesh_size_condutor = settings['Size.Conductor']
+        mesh_size_substrate = settings['Size.Substrate']
+        mesh_size_environment = settings['Size.Environment']
         sur_feed = self.tags['sur_feed']
         sur_gnd = self.tags['sur_gnd']
         sur_patch = self.tags['sur_patch']
@@ -159,6 +235,10 @@ class Mspa(object):
         tags = gmsh.model.getBoundary(tags, False, False, False)
         a = np.array(tags)
         a = list(np.unique(a[:, 1]))
+        if self.symmetry is not None:
+            # cut edges are not feature edges, don't refine along them
+            cut = set(symmetry.on_plane(self.symmetry, 1))
+            a = [t for t in a if t not in cut]
         # tags = gmsh.model.getBoundary([sur_feed], False, False, False)
         # af = np.array(tags)
         # af = list(np.unique(af[:, 1]))
@@ -166,7 +246,8 @@ class Mspa(object):
 
         gmsh.model.mesh.field.add("Distance", 1)
         gmsh.model.mesh.field.setNumbers(1, "CurvesList", a)
-        gmsh.model.mesh.field.setNumber(1, "NumPointsPerCurve", 100)
+        gmsh.model.mesh.field.setNumber(
+            1, "NumPointsPerCurve", settings['Distance.NumPointsPerCurve'])
 
         # gmsh.model.mesh.field.add("Distance", 2)
         # gmsh.model.mesh.field.setNumbers(2, "CurvesList", af)
@@ -174,10 +255,14 @@ class Mspa(object):
 
         gmsh.model.mesh.field.add("Threshold", 3)
         gmsh.model.mesh.field.setNumber(3, "InField", 1)
-        gmsh.model.mesh.field.setNumber(3, "SizeMin", 7.5 * mm)
-        gmsh.model.mesh.field.setNumber(3, "SizeMax", 15.0 * mm)
-        gmsh.model.mesh.field.setNumber(3, "DistMin", 0.0 * mm)
-        gmsh.model.mesh.field.setNumber(3, "DistMax", 10.0 * mm)
+        gmsh.model.mesh.field.setNumber(
+            3, "SizeMin", settings['Threshold.SizeMin'])
+        gmsh.model.mesh.field.setNumber(
+            3, "SizeMax", settings['Threshold.SizeMax'])
+        gmsh.model.mesh.field.setNumber(
+            3, "DistMin", settings['Threshold.DistMin'])
+        gmsh.model.mesh.field.setNumber(
+            3, "DistMax", settings['Threshold.DistMax'])
 
         # gmsh.model.mesh.field.add("Threshold", 4)
         # gmsh.model.mesh.field.setNumber(4, "InField", 2)
@@ -205,6 +290,32 @@ class Mspa(object):
             [sur_feed, sur_patch, sur_gnd], False, False, True)
         gmsh.model.mesh.setSize(tags, mesh_size_condutor)
 
+    def mesh(self, filename, cache=None):
+        """
+        Generate the 3D mesh and write it to filename.
+        With a MeshCache, an identical geometry is merged from disk
+        instead of being remeshed. Returns True on a cache hit.
+        """
+        key = None
+        cached = None
+        if cache is not None:
+            key = cache.key(self)
+            cached = cache.get(key)
+        if cached is None:
+            with profiling.stage('mesh_generate', counts=True):
+                gmsh.model.mesh.generate(3)
+        else:
+            # the cached file carries the same physical groups,
+            # drop ours so merging doesn't tag the entities twice
+            gmsh.model.removePhysicalGroups()
+            with profiling.stage('mesh_merge', [cached], counts=True):
+                gmsh.merge(cached)
+        with profiling.stage('mesh_write', [filename]):
+            gmsh.write(filename)
+        if key is not None and cached is None:
+            cache.put(key, filename)
+        return cached is not None
+
     def _create_groups(self):
 
         sur_feed = self.tags['sur_feed']
@@ -236,3 +347,7 @@ class Mspa(object):
 
         tag = gmsh.model.addPhysicalGroup(2, [sur_pml[1]])
         gmsh.model.setPhysicalName(2, tag, 'SigmaInf')
+
+        if self.symmetry is not None:
+            tag = gmsh.model.addPhysicalGroup(2, self.tags['sur_symmetry'])
+            gmsh.model.setPhysicalName(2, tag, 'SymmetryPlane')
@@ -0,0 +1,68 @@
+from gmsh import model
+import numpy as np
+
+
+class EntityIndex(object):
+    '''
+    Bounding-box index over the model entities of one dimension
+
+    Entities are sorted by their lower x bound, so a query only tests
+    the boxes whose x range can reach it. Used to find surfaces by
+    position instead of relying on tags that change with topology.
+    '''
+
+    def __init__(self, dim, tol=1.0e-6):
+        super().__init__()
+        self.dim = dim
+        self.tol = tol
+        tags = [tag for _, tag in model.get_entities(dim)]
+        boxes = [model.get_bounding_box(dim, tag) for tag in tags]
+        boxes = np.array(boxes, dtype=float).reshape(-1, 6)
+        order = np.argsort(boxes[:, 0], kind='stable')
+        self.tags = np.array(tags, dtype=int)[order]
+        self.boxes = boxes[order]
+
+    def _candidates(self, box):
+        # entities with xmin > box xmax can never overlap the query
+        end = np.searchsorted(self.boxes[:, 0], box[3] + self.tol, 'right')
+        return slice(0, end)
+
+    def overlapping(self, box):
+        """Tags of entities whose bounding box intersects box"""
+        s = self._candidates(box)
+        b = self.boxes[s]
+        lo = np.asarray(box[:3]) - self.tol
+        hi = np.asarray(box[3:]) + self.tol
+        mask = np.all((b[:, 3:] >= lo) & (b[:, :3] <= hi), axis=1)
+        return list(self.tags[s][mask])
+
+    def inside(self, box):
+        """Tags of entities whose bounding box lies within box"""
+        s = self._candidates(box)
+        b = self.boxes[s]
+        lo = np.asarray(box[:3]) - self.tol
+        hi = np.asarray(box[3:]) + self.tol
+        mask = np.all((b[:, :3] >= lo) & (b[:, 3:] <= hi), axis=1)
+        return list(self.tags[s][mask])
+
+    def matching(self, box):
+        """Tags of entities whose bounding box equals box"""
+        s = self._candidates(box)
+        b = self.boxes[s]
+        mask = np.all(np.abs(b - np.asarray(box)) <= self.tol, axis=1)
+        return list(self.tags[s][mask])
+
+    def on_plane(self, axis, value):
+        """Tags of entities flat on the plane x[axis] = value"""
+        lo = self.boxes[:, axis]
+        hi = self.boxes[:, axis + 3]
+        mask = (np.abs(lo - value) <= self.tol) & \
+            (np.abs(hi - value) <= self.tol)
+        return list(self.tags[mask])
+
+    def one(self, tags, what):
+        """The single tag of a query result, as a (dim, tag) pair"""
+        if len(tags) != 1:
+            raise ValueError(
+                f'expected one entity for {what}, found {len(tags)}: {tags}')
+        return (self.dim, int(tags[0]))
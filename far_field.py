@@ -0,0 +1,226 @@
+from pos_reader import convert
+from scipy.constants import epsilon_0, mu_0, speed_of_light
+import argparse
+import csv
+import numpy as np
+import sys
+
+
+ETA0 = np.sqrt(mu_0 / epsilon_0)
+
+# direction x source point products kept per batch, bounds the memory
+# of the phase matrix to BATCH complex numbers
+BATCH = 1 << 22
+
+
+def ongrid(r, n_theta=30, n_phi=60, phi0=0.0, phi_span=2.0 * np.pi):
+    """
+    GetDP OnGrid arguments sampling a sphere of radius r with
+    n_theta x n_phi quadrangles, poles and the phi = 2 Pi seam included.
+    phi0 and phi_span restrict the grid to a sector, e.g. the half
+    sphere of a symmetric half model.
+    """
+    dt = np.pi / n_theta
+    dp = phi_span / n_phi
+    return (f'{{{r!r} * Sin[$A] * Cos[$B], {r!r} * Sin[$A] * Sin[$B], '
+            f'{r!r} * Cos[$A]}} '
+            f'{{0:{np.pi + 0.5 * dt!r}:{dt!r}, '
+            f'{phi0!r}:{phi0 + phi_span + 0.5 * dp!r}:{dp!r}, 0}}')
+
+
+def angles(n_theta=30, n_phi=60):
+    """theta in [0, Pi], phi in [0, 2 Pi), the NearToFarField plugin grid"""
+    theta = np.linspace(0.0, np.pi, n_theta + 1)
+    phi = np.linspace(0.0, 2.0 * np.pi, n_phi, endpoint=False)
+    return theta, phi
+
+
+def surface(coords, center=(0.0, 0.0, 0.0)):
+    """
+    Quadrature of triangles or quadrangles (E, n, 3): centroids and
+    area vectors oriented away from center
+    """
+    coords = np.asarray(coords, dtype=float)
+    if coords.shape[1] in (3, 6):
+        a = coords[:, 1] - coords[:, 0]
+        b = coords[:, 2] - coords[:, 0]
+        corners = coords[:, :3]
+    else:
+        # half the cross product of the diagonals, exact for planar quads
+        a = coords[:, 2] - coords[:, 0]
+        b = coords[:, 3] - coords[:, 1]
+        corners = coords[:, :4]
+    points = corners.mean(axis=1)
+    ds = 0.5 * np.cross(a, b)
+    flip = np.einsum('ij,ij->i', ds, points - np.asarray(center)) < 0.0
+    ds[flip] *= -1.0
+    return points, ds
+
+
+def from_stores(e_store, h_store, center=(0.0, 0.0, 0.0)):
+    """Quadrature points, area vectors and element mean e, h of two stores"""
+    if len(e_store) != len(h_store):
+        raise ValueError(f'{e_store.name} has {len(e_store)} elements, '
+                         f'{h_store.name} has {len(h_store)}')
+    n = {'T': 3, 'Q': 4, 'T2': 3, 'Q2': 4}.get(e_store.kind[1:])
+    if n is None:
+        raise ValueError(f'{e_store.name}: {e_store.kind} is not a surface')
+    points, ds = surface(e_store.element_nodes(), center)
+    e = np.asarray(e_store.values)[:, :n].mean(axis=1)
+    h = np.asarray(h_store.values)[:, :n].mean(axis=1)
+    return points, ds, e, h
+
+
+def read_near_field(e_filename, h_filename, center=(0.0, 0.0, 0.0)):
+    """from_stores on the single surface view of two .pos files"""
+    fields = []
+    for filename in (e_filename, h_filename):
+        stores = convert(filename)
+        if len(stores) != 1:
+            raise ValueError(
+                f'{filename}: expected one view, found {sorted(stores)}')
+        fields.append(next(iter(stores.values())))
+    return from_stores(*fields, center)
+
+
+def far_field(points, ds, e, h, k, theta, phi, eta=ETA0,
+              center=(0.0, 0.0, 0.0)):
+    """
+    Far-field pattern of the surface fields e, h on a closed surface.
+
+    points, ds (P, 3) come from surface(), e and h are (P, 3) or (F, P, 3)
+    for F wavenumbers k. Returns F_theta, F_phi of shape (F, T, Q) for the
+    theta (T) and phi (Q) grid, with E(r) = F exp(-j k r) / r (GetDP's
+    exp(j w t) convention). Equivalent currents J = n x H, M = -n x E
+    are radiated with one (directions x points) matrix product per
+    frequency and batch of directions.
+    """
+    k = np.atleast_1d(np.asarray(k, dtype=float))
+    e = np.asarray(e, dtype=complex).reshape(-1, len(points), 3)
+    h = np.asarray(h, dtype=complex).reshape(-1, len(points), 3)
+    if len(e) != len(k) or len(h) != len(k):
+        raise ValueError(f'{len(k)} wavenumbers for {len(e)} e and '
+                         f'{len(h)} h fields')
+    theta = np.asarray(theta, dtype=float)
+    phi = np.asarray(phi, dtype=float)
+    t, p = np.meshgrid(theta, phi, indexing='ij')
+    st, ct, sp, cp = np.sin(t), np.cos(t), np.sin(p), np.cos(p)
+    r_hat = np.stack([st * cp, st * sp, ct], axis=-1).reshape(-1, 3)
+    t_hat = np.stack([ct * cp, ct * sp, -st], axis=-1).reshape(-1, 3)
+    p_hat = np.stack([-sp, cp, np.zeros_like(sp)], axis=-1).reshape(-1, 3)
+
+    r = np.asarray(points, dtype=float) - np.asarray(center)
+    ds = np.asarray(ds, dtype=float)
+    # currents times area, J and M side by side: (F, P, 6)
+    sources = np.concatenate([np.cross(ds, h), -np.cross(ds, e)], axis=-1)
+    n_dir = len(r_hat)
+    step = max(1, BATCH // max(1, len(r)))
+    f_theta = np.empty((len(k), n_dir), dtype=complex)
+    f_phi = np.empty((len(k), n_dir), dtype=complex)
+    for start in range(0, n_dir, step):
+        s = slice(start, start + step)
+        projection = r_hat[s] @ r.T
+        for i, ki in enumerate(k):
+            nl = np.exp(1j * ki * projection) @ sources[i]
+            n_vec, l_vec = nl[:, :3], nl[:, 3:]
+            n_t = np.einsum('ij,ij->i', n_vec, t_hat[s])
+            n_p = np.einsum('ij,ij->i', n_vec, p_hat[s])
+            l_t = np.einsum('ij,ij->i', l_vec, t_hat[s])
+            l_p = np.einsum('ij,ij->i', l_vec, p_hat[s])
+            c = 1j * ki / (4.0 * np.pi)
+            f_theta[i, s] = -c * (l_p + eta * n_t)
+            f_phi[i, s] = c * (l_t - eta * n_p)
+    shape = (len(k), len(theta), len(phi))
+    return f_theta.reshape(shape), f_phi.reshape(shape)
+
+
+def radiated_power(ds, e, h):
+    """Time averaged Poynting flux through the surface, (F,)"""
+    e = np.asarray(e, dtype=complex).reshape(-1, len(ds), 3)
+    h = np.asarray(h, dtype=complex).reshape(-1, len(ds), 3)
+    return 0.5 * np.einsum('fpi,pi->f', np.cross(e, h.conj()), ds).real
+
+
+def intensity(f_theta, f_phi, eta=ETA0):
+    """Radiation intensity U = |F|^2 / (2 eta), W/sr"""
+    return (np.abs(f_theta) ** 2 + np.abs(f_phi) ** 2) / (2.0 * eta)
+
+
+def directivity(f_theta, f_phi, power, eta=ETA0):
+    """4 Pi U / P_rad, power from radiated_power()"""
+    u = intensity(f_theta, f_phi, eta)
+    return 4.0 * np.pi * u / np.asarray(power).reshape(-1, 1, 1)
+
+
+def to_db(x, floor=1.0e-30):
+    return 10.0 * np.log10(np.maximum(x, floor))
+
+
+def write_pattern(filename, theta, phi, values, name='far_field'):
+    """
+    Parsed .pos view of values (F, T, Q) on the unit sphere, one time
+    step per frequency, for display next to the near field
+    """
+    values = np.asarray(values, dtype=float).reshape(-1, len(theta), len(phi))
+    t, p = np.meshgrid(theta, np.append(phi, phi[0]), indexing='ij')
+    xyz = np.stack([np.sin(t) * np.cos(p), np.sin(t) * np.sin(p),
+                    np.cos(t)], axis=-1)
+    v = np.concatenate([values, values[:, :, :1]], axis=2)
+    with open(filename, 'w') as f:
+        f.write(f'View "{name}" {{\n')
+        for i in range(len(theta) - 1):
+            for j in range(len(phi)):
+                corners = [(i, j), (i + 1, j), (i + 1, j + 1), (i, j + 1)]
+                c = ','.join(repr(x) for a in corners for x in xyz[a])
+                s = ','.join(repr(x) for step in v
+                             for a in corners for x in [step[a]])
+                f.write(f'SQ({c}){{{s}}};\n')
+        f.write('};\n')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Far-field patterns from e and h sampled on a sphere')
+    parser.add_argument('fields', nargs='+',
+                        help='e.pos h.pos pairs, one pair per frequency')
+    parser.add_argument('-f', '--frequency', type=float, nargs='+',
+                        required=True, help='MHz, one per pair')
+    parser.add_argument('--theta', type=int, default=30)
+    parser.add_argument('--phi', type=int, default=60)
+    parser.add_argument('-o', '--output', default='far_field.csv')
+    parser.add_argument('--pos', default=None,
+                        help='also write the directivity (dBi) as a view')
+    args = parser.parse_args(argv)
+
+    if len(args.fields) != 2 * len(args.frequency):
+        parser.error('need one e.pos h.pos pair per frequency')
+    e = []
+    h = []
+    for i in range(len(args.frequency)):
+        points, ds, ei, hi = read_near_field(*args.fields[2 * i:2 * i + 2])
+        e.append(ei)
+        h.append(hi)
+    k = 2.0 * np.pi * np.array(args.frequency) * 1.0e6 / speed_of_light
+    theta, phi = angles(args.theta, args.phi)
+    f_theta, f_phi = far_field(points, ds, e, h, k, theta, phi)
+    d = to_db(directivity(f_theta, f_phi, radiated_power(ds, e, h)))
+
+    with open(args.output, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['frequency', 'theta', 'phi', 'f_theta_re',
+                         'f_theta_im', 'f_phi_re', 'f_phi_im', 'd_dbi'])
+        for i, fi in enumerate(args.frequency):
+            for a, ta in enumerate(theta):
+                for b, pb in enumerate(phi):
+                    ft = f_theta[i, a, b]
+                    fp = f_phi[i, a, b]
+                    writer.writerow([fi, np.degrees(ta), np.degrees(pb),
+                                     ft.real, ft.imag, fp.real, fp.imag,
+                                     d[i, a, b]])
+    if args.pos:
+        write_pattern(args.pos, theta, phi, d, 'directivity')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
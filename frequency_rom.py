@@ -0,0 +1,305 @@
+from scipy.constants import speed_of_light
+from scipy.sparse.linalg import splu
+import argparse
+import csv
+import numpy as np
+import os
+import scipy.sparse as sp
+import shutil
+import subprocess
+import sys
+
+
+# frequency dependence of the Microwave_e system once the PML stretch is
+# frozen: h projection ~ 1/f, curl-curl ~ 1, DtDof sigma ~ f,
+# DtDtDof epsilon ~ f^2
+POWERS = (-1, 0, 1, 2)
+
+MAT_FILE_CLASSID = 1211216
+VEC_FILE_CLASSID = 1211214
+
+
+def read_petsc_binary(filename, scalar='complex'):
+    """
+    All Mat/Vec objects of a PETSc binary file, in file order.
+    scalar='real' reads a real-arithmetic dump of a complex system
+    (2x2 real blocks per complex entry) and folds it back to complex.
+    """
+    values = np.dtype('>c16') if scalar == 'complex' else np.dtype('>f8')
+    data = np.fromfile(filename, dtype=np.uint8).tobytes()
+    objects = []
+    pos = 0
+    while pos < len(data):
+        classid = np.frombuffer(data, '>i4', 1, pos)[0]
+        if classid == MAT_FILE_CLASSID:
+            m, n, nz = np.frombuffer(data, '>i4', 3, pos + 4)
+            pos += 16
+            row_nz = np.frombuffer(data, '>i4', m, pos)
+            pos += 4 * m
+            cols = np.frombuffer(data, '>i4', nz, pos)
+            pos += 4 * nz
+            vals = np.frombuffer(data, values, nz, pos)
+            pos += values.itemsize * nz
+            indptr = np.concatenate([[0], np.cumsum(row_nz)])
+            obj = sp.csr_matrix((vals.astype(complex), cols, indptr),
+                                shape=(m, n))
+            if scalar != 'complex':
+                obj = obj[0::2, 0::2] + 1j * obj[1::2, 0::2]
+        elif classid == VEC_FILE_CLASSID:
+            n = np.frombuffer(data, '>i4', 1, pos + 4)[0]
+            pos += 8
+            obj = np.frombuffer(data, values, n, pos).astype(complex)
+            pos += values.itemsize * n
+            if scalar != 'complex':
+                obj = obj[0::2] + 1j * obj[1::2]
+        else:
+            raise ValueError(f'{filename}: unknown PETSc class id {classid}')
+        objects.append(obj)
+    return objects
+
+
+def write_res(template, x, filename):
+    """Copy a GetDP .res file, replacing its first solution by x"""
+    with open(template) as f:
+        lines = f.read().splitlines()
+    start = next(i for i, l in enumerate(lines) if l.startswith('$Solution'))
+    # skip the "dofdata time time_imag step" header line
+    start += 2
+    end = lines.index('$EndSolution', start)
+    if end - start != len(x):
+        raise ValueError(
+            f'{template} holds {end - start} dofs, solution has {len(x)}')
+    values = [f'{v.real:.17g} {v.imag:.17g}' for v in x]
+    with open(filename, 'w') as f:
+        f.write('\n'.join(lines[:start] + values + lines[end:]) + '\n')
+
+
+def _taylor(p, j, s):
+    """j-th Taylor coefficient of s^p"""
+    c = 1.0
+    for i in range(j):
+        c *= (p - i) / (i + 1)
+    return c * s ** (p - j)
+
+
+class LaurentSystem(object):
+    '''
+    Frequency dependent linear system A(f) x = b(f) with
+    A(f) = sum_p (f / f_ref)^p A_p and b(f) likewise
+    '''
+
+    def __init__(self, matrices, vectors, powers=POWERS, f_ref=1.0):
+        super().__init__()
+        self.matrices = [m.tocsc() for m in matrices]
+        self.vectors = [np.asarray(v, dtype=complex) for v in vectors]
+        self.powers = tuple(powers)
+        self.f_ref = f_ref
+
+    @classmethod
+    def from_samples(cls, freqs, matrices, vectors, powers=POWERS,
+                     f_ref=None):
+        """Recover A_p, b_p from systems assembled at len(powers) frequencies"""
+        freqs = np.asarray(freqs, dtype=float)
+        if f_ref is None:
+            f_ref = np.sqrt(freqs.min() * freqs.max())
+        s = freqs / f_ref
+        vander = s[:, None] ** np.array(powers)[None, :]
+        inv = np.linalg.pinv(vander)
+        blocks = []
+        rhs = []
+        for k in range(len(powers)):
+            blocks.append(sum(inv[k, i] * matrices[i]
+                              for i in range(len(freqs))))
+            rhs.append(sum(inv[k, i] * vectors[i]
+                           for i in range(len(freqs))))
+        return cls(blocks, rhs, powers, f_ref)
+
+    @property
+    def size(self):
+        return self.matrices[0].shape[0]
+
+    def matrix(self, f, order=0):
+        """A(f), or its order-th Taylor coefficient in f / f_ref"""
+        s = f / self.f_ref
+        return sum(_taylor(p, order, s) * m
+                   for p, m in zip(self.powers, self.matrices))
+
+    def rhs(self, f, order=0):
+        s = f / self.f_ref
+        return sum(_taylor(p, order, s) * v
+                   for p, v in zip(self.powers, self.vectors))
+
+    def solve(self, freqs):
+        """Direct solve at every frequency, one row per frequency"""
+        return np.array([splu(self.matrix(f).tocsc()).solve(self.rhs(f))
+                         for f in freqs])
+
+
+class KrylovRom(object):
+    '''
+    Galerkin projection of a LaurentSystem on the span of the first
+    n_moments Taylor moments of x(f) around each of the centers
+
+    Each center costs one sparse factorization, every frequency after
+    that is a dense solve of size len(centers) * n_moments.
+    '''
+
+    def __init__(self, system, centers, n_moments=8):
+        super().__init__()
+        self.system = system
+        basis = []
+        for fc in np.atleast_1d(centers):
+            lu = splu(system.matrix(fc).tocsc())
+            moments = []
+            for k in range(n_moments):
+                r = system.rhs(fc, k)
+                for j in range(1, k + 1):
+                    r = r - system.matrix(fc, j) @ moments[k - j]
+                moments.append(lu.solve(r))
+                v = moments[-1].copy()
+                # two passes of modified Gram-Schmidt
+                for _ in range(2):
+                    for q in basis:
+                        v -= (q.conj() @ v) * q
+                norm = np.linalg.norm(v)
+                if norm > 1.0e-12 * np.linalg.norm(moments[-1]):
+                    basis.append(v / norm)
+        self.basis = np.array(basis).T
+        vh = self.basis.conj().T
+        self.matrices = [vh @ (m @ self.basis) for m in system.matrices]
+        self.vectors = [vh @ v for v in system.vectors]
+
+    @property
+    def order(self):
+        return self.basis.shape[1]
+
+    def solve(self, freqs):
+        s = np.asarray(freqs, dtype=float) / self.system.f_ref
+        x = []
+        for si in s:
+            a = sum(si ** p * m
+                    for p, m in zip(self.system.powers, self.matrices))
+            b = sum(si ** p * v
+                    for p, v in zip(self.system.powers, self.vectors))
+            x.append(self.basis @ np.linalg.solve(a, b))
+        return np.array(x)
+
+
+def _getdp(args, cwd):
+    cmd = [os.environ.get('GETDP', 'getdp')] + args + ['-v', '2']
+    subprocess.run(cmd, cwd=cwd, check=True, stdout=subprocess.DEVNULL)
+
+
+def assemble(freqs, model_name='mspa', epr=None, cwd='.', scalar='complex'):
+    """
+    Run the Analysis resolution at each frequency with PETSc dumping the
+    system, returns matrices, right hand sides and a .res template
+    """
+    matrices = []
+    vectors = []
+    for i, f in enumerate(freqs):
+        args = [f'{model_name}.pro', '-msh', f'{model_name}.msh',
+                '-setnumber', 'Model/Frequency', repr(float(f))]
+        if epr is not None:
+            args += ['-setnumber', 'Model/epr', repr(float(epr))]
+        args += ['-solve', 'Analysis',
+                 '-ksp_view_mat', f'binary:A_{i}.bin',
+                 '-ksp_view_rhs', f'binary:b_{i}.bin']
+        _getdp(args, cwd)
+        # the BC projection is solved first, the Analysis system is last
+        a = [o for o in read_petsc_binary(os.path.join(cwd, f'A_{i}.bin'),
+                                          scalar) if sp.issparse(o)]
+        b = read_petsc_binary(os.path.join(cwd, f'b_{i}.bin'), scalar)
+        matrices.append(a[-1])
+        vectors.append(b[-1])
+    template = os.path.join(cwd, f'{model_name}_template.res')
+    shutil.copyfile(os.path.join(cwd, f'{model_name}.res'), template)
+    return matrices, vectors, template
+
+
+def admittance(freqs, solutions, template, model_name='mspa', epr=None,
+               cwd='.'):
+    """y at each frequency by post-processing stored solutions"""
+    import mstrip
+
+    y = []
+    res = f'{model_name}_rom.res'
+    for f, x in zip(freqs, solutions):
+        write_res(template, x, os.path.join(cwd, res))
+        args = [f'{model_name}.pro', '-msh', f'{model_name}.msh',
+                '-setnumber', 'Model/Frequency', repr(float(f))]
+        if epr is not None:
+            args += ['-setnumber', 'Model/epr', repr(float(epr))]
+        args += ['-res', res, '-pos', 'Admittance']
+        _getdp(args, cwd)
+        _, yi = mstrip.read_frequency_table(
+            os.path.join(cwd, 'build', 'y.txt'))
+        y.append(yi)
+    return np.array(y)
+
+
+def main(argv=None):
+    from adaptive_sweep import s11_db
+    from gmsh import onelab
+    from mesh_cache import MeshCache
+    import gmsh
+    import mstrip
+    import sweep
+
+    parser = argparse.ArgumentParser(
+        description='Multi-frequency solve from one set of assembled matrices')
+    parser.add_argument('--fmin', type=float, required=True, help='MHz')
+    parser.add_argument('--fmax', type=float, required=True, help='MHz')
+    parser.add_argument('-n', type=int, default=101,
+                        help='number of output frequencies')
+    parser.add_argument('--rom', action='store_true',
+                        help='Krylov reduced model instead of direct solves')
+    parser.add_argument('--moments', type=int, default=8)
+    parser.add_argument('--centers', type=int, default=1,
+                        help='number of expansion points for --rom')
+    parser.add_argument('--real', action='store_true',
+                        help='getdp built with real PETSc scalars')
+    for name in ('epr',) + sweep.MSPA_PARAMS:
+        parser.add_argument(f'--{name}', type=float)
+    parser.add_argument('-o', '--output', default='rom.csv')
+    args = parser.parse_args(argv)
+
+    fc = 0.5 * (args.fmin + args.fmax)
+    mstrip.setup_onelab()
+    onelab.set_number('Model/Frequency', [fc])
+    if args.epr is not None:
+        onelab.set_number('Model/epr', [args.epr])
+    antenna = mstrip.Mspa(mstrip.MODEL_NAME, lazy=True, frequency=args.fmax)
+    antenna.update(**{name: getattr(args, name) for name in sweep.MSPA_PARAMS
+                      if getattr(args, name) is not None})
+    k0 = 2.0 * np.pi * fc * 1.0e6 / speed_of_light
+    pro = mstrip.create_problem(antenna, pml_k0=k0)
+    mstrip.prepare(pro, antenna, MeshCache())
+    gmsh.finalize()
+
+    samples = np.linspace(args.fmin, args.fmax, len(POWERS))
+    matrices, vectors, template = assemble(
+        samples, mstrip.MODEL_NAME, args.epr,
+        scalar='real' if args.real else 'complex')
+    system = LaurentSystem.from_samples(samples, matrices, vectors)
+
+    freqs = np.linspace(args.fmin, args.fmax, args.n)
+    if args.rom:
+        edges = np.linspace(args.fmin, args.fmax, args.centers + 1)
+        rom = KrylovRom(system, 0.5 * (edges[1:] + edges[:-1]), args.moments)
+        x = rom.solve(freqs)
+        print(f'reduced order {rom.order} of {system.size}')
+    else:
+        x = system.solve(freqs)
+    y = admittance(freqs, x, template, mstrip.MODEL_NAME, args.epr)
+
+    with open(args.output, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['frequency', 'y_re', 'y_im', 's11'])
+        for fi, yi in zip(freqs, y):
+            writer.writerow([fi, yi.real, yi.imag, s11_db(yi)])
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
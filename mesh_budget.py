@@ -0,0 +1,106 @@
+import math
+
+import profiling
+import truncation
+
+
+# minimum elements per free space wavelength of each basis order
+PER_WAVELENGTH = {1: 10.0, 2: 5.0}
+COARSE = 2.5  # size scale of the calibration mesh, relative to the settings
+EXPONENT = 2.0  # first guess of -d log(elements) / d log(size)
+DENSITY = 1.5  # d log(tetrahedra) / d log(triangles)
+TOLERANCE = 0.10  # relative error accepted from the budget
+MAX_PASSES = 8
+
+
+def scaled(settings, names, scale, cap=None):
+    """settings with the sizes names times scale, at most cap"""
+    settings = dict(settings)
+    for name in names:
+        if name in settings:
+            value = settings[name] * scale
+            settings[name] = value if cap is None else min(value, cap)
+    return settings
+
+
+def _premesh(antenna, settings, order, dim):
+    """Mesh counts, with order's dofs, of antenna meshed to dim with settings"""
+    from gmsh import model
+
+    antenna.apply_mesh_settings(settings)
+    model.mesh.generate(dim)
+    counts = profiling.mesh_counts(order)
+    model.mesh.clear()
+    return counts
+
+
+def plan(antenna, elements=None, dofs=None, order=1, per_wavelength=None):
+    """
+    Size the mesh of antenna for a budget of elements (tetrahedra) or of
+    dofs of the given basis order, with at least per_wavelength
+    elements per wavelength at antenna.frequency. The sizes in
+    antenna.SIZES are scaled together, each at most a wavelength over
+    per_wavelength.
+
+    A single coarse volume mesh calibrates the volume density: the
+    tetrahedra then follow the surface triangles to the power DENSITY,
+    and the dofs the tetrahedra. Every other pass only meshes the
+    surfaces of the built model with new size fields. The element count
+    does not follow a fixed power of the sizes (the refinement distances
+    and the cap stay put), so the scale is found by a secant iteration
+    on log(count) against log(scale), and the pass closest to the budget
+    is kept. The wavelength constraint wins over the budget.
+
+    Sets and returns antenna.mesh_settings and a record of the plan, with
+    the estimated counts.
+    """
+    if (elements is None) == (dofs is None):
+        raise ValueError('give either an element or a dof budget')
+    if per_wavelength is None:
+        per_wavelength = PER_WAVELENGTH[order]
+    target = elements if elements is not None else dofs
+    key = 'tetrahedra' if elements is not None else 'dofs'
+    base = dict(antenna.mesh_settings)
+    cap = truncation.wavelength(antenna.frequency) / per_wavelength
+
+    scale, exponent, previous, best = COARSE, EXPONENT, None, None
+    with profiling.stage('mesh_budget'):
+        calibration = _premesh(antenna, scaled(base, antenna.SIZES, scale,
+                                               cap), order, 3)
+        for i in range(MAX_PASSES):
+            settings = scaled(base, antenna.SIZES, scale, cap)
+            if i == 0:
+                counts = calibration
+            else:
+                surface = _premesh(antenna, settings, order, 2)
+                ratio = surface['triangles'] / calibration['triangles']
+                counts = {k: calibration[k] * ratio ** DENSITY
+                          for k in ('tetrahedra', 'dofs')}
+            count = counts[key]
+            error = abs(math.log(count / target))
+            capped = any(settings.get(n) == cap for n in antenna.SIZES)
+            if best is None or error < best[0]:
+                best = error, scale, settings, counts, capped
+            if abs(count / target - 1.0) <= TOLERANCE:
+                break
+            if previous is not None and previous[1] != count and \
+                    previous[0] != scale:
+                exponent = math.log(previous[1] / count) / \
+                    math.log(scale / previous[0])
+                exponent = min(max(exponent, 0.5), 3.0)
+            previous = scale, count
+            scale *= (count / target) ** (1.0 / exponent)
+
+    error, scale, settings, counts, capped = best
+    antenna.apply_mesh_settings(settings)
+    count = counts[key]
+    return settings, {
+        'target': float(target),
+        'tetrahedra': int(round(counts['tetrahedra'])),
+        'dofs': int(round(counts['dofs'])),
+        'scale': float(scale),
+        'wavelength_cap': float(cap),
+        'limited_by_wavelength': bool(capped and count > target *
+                                      (1.0 + TOLERANCE)),
+        'passes': i + 1,
+    }
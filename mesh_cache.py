@@ -0,0 +1,59 @@
+import gmsh
+import hashlib
+import inspect
+import json
+import os
+import shutil
+import tempfile
+
+
+class MeshCache(object):
+    '''
+    Content-addressed on-disk cache of .msh files
+
+    Meshes are keyed by the antenna class source, its dims,
+    mesh_settings and symmetry plane, and the gmsh version, so only
+    identical geometry and mesh fields share an entry.
+    '''
+
+    def __init__(self, directory=None):
+        super().__init__()
+        if directory is None:
+            directory = os.environ.get(
+                'MSPA_MESH_CACHE',
+                os.path.join(os.path.expanduser('~'), '.cache', 'mspa', 'mesh'))
+        self.directory = directory
+        os.makedirs(self.directory, exist_ok=True)
+
+    def key(self, antenna):
+        cls = type(antenna)
+        source = hashlib.sha256(inspect.getsource(cls).encode()).hexdigest()
+        data = {
+            'class': f'{cls.__module__}.{cls.__qualname__}',
+            'source': source,
+            'dims': antenna.dims,
+            'mesh_settings': antenna.mesh_settings,
+            'symmetry': antenna.symmetry,
+            'gmsh': gmsh.__version__,
+        }
+        text = json.dumps(data, sort_keys=True, default=repr)
+        return hashlib.sha256(text.encode()).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + '.msh')
+
+    def get(self, key):
+        path = self.path(key)
+        return path if os.path.isfile(path) else None
+
+    def put(self, key, filename):
+        # copy then rename, so concurrent sweep workers never see a partial file
+        fd, tmp = tempfile.mkstemp(suffix='.msh', dir=self.directory)
+        os.close(fd)
+        try:
+            shutil.copyfile(filename, tmp)
+            os.replace(tmp, self.path(key))
+        except BaseException:
+            os.remove(tmp)
+            raise
+        return self.path(key)
@@ -0,0 +1,46 @@
+import os
+
+
+# gmsh 3D algorithm of each meshing backend. Frontal and Delaunay mesh
+# a volume on one thread, HXT is a parallel Delaunay. The surfaces are
+# meshed in parallel, one per thread, whatever the backend.
+BACKENDS = {
+    'frontal': 4,
+    'delaunay': 1,
+    'hxt': 10,
+}
+THREADS = ('Mesh.MaxNumThreads1D', 'Mesh.MaxNumThreads2D',
+           'Mesh.MaxNumThreads3D')
+
+
+def backend_settings(settings, backend=None, threads=None):
+    """
+    mesh settings with the 3D algorithm of backend (None keeps the
+    settings' own) on threads, all the cores by default
+    """
+    settings = dict(settings)
+    if backend is not None:
+        if backend not in BACKENDS:
+            raise ValueError(f'unknown mesh backend {backend}, '
+                             f'expected one of {", ".join(BACKENDS)}')
+        settings['Mesh.Algorithm3D'] = BACKENDS[backend]
+    if threads is None:
+        threads = os.cpu_count() or 1
+    for name in THREADS:
+        settings[name] = threads
+    return settings
+
+
+def quality(dim=3, measure='minSICN'):
+    """
+    Worst and mean quality of the current mesh's elements of dim, by
+    gmsh's measure (minSICN: 1 for a regular element, <= 0 inverted)
+    """
+    from gmsh import model
+    import numpy as np
+
+    _, tags, _ = model.mesh.get_elements(dim)
+    if not tags:
+        return {}
+    q = model.mesh.get_element_qualities(np.concatenate(tags), measure)
+    return {'quality_min': float(q.min()), 'quality_mean': float(q.mean())}
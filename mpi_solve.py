@@ -0,0 +1,68 @@
+from gmsh import model
+from gmsh import onelab
+from gmsh import option
+from scipy.constants import speed_of_light
+from solvers import SOLVERS
+import gmsh
+import numpy as np
+import os
+import shutil
+import subprocess
+import sys
+
+
+# distributed direct solve, PETSc's own LU only runs on one rank
+# (an iterative solver set in the .pro overrides these)
+SOLVER_OPTIONS = SOLVERS['mumps']
+
+
+def mpiexec():
+    """MPI launcher from env MPIEXEC or the PATH, None if there is none"""
+    return shutil.which(os.environ.get('MPIEXEC', 'mpiexec'))
+
+
+def partition(filename, ranks):
+    """Split the current mesh into ranks partitions and rewrite filename"""
+    option.set_number('Mesh.PartitionCreateGhostCells', 0)
+    option.set_number('Mesh.PartitionSplitMeshFiles', 0)
+    model.mesh.partition(ranks)
+    gmsh.write(filename)
+
+
+def set_results():
+    """Publish what a onelab run of getdp would have sent back"""
+    import mstrip
+
+    f = onelab.get_number('Model/Frequency')[0]
+    k0 = 2.0 * np.pi * f * 1.0e6 / speed_of_light
+    onelab.set_number('Model/Lambda', [2.0 * np.pi / k0])
+    onelab.set_number('Model/WaveNumber', [k0])
+    _, s11 = mstrip.read_frequency_table(os.path.join('build', 's11.txt'))
+    onelab.set_number('s11', [s11.real])
+
+
+def run(model_name, ranks, options=SOLVER_OPTIONS):
+    """
+    Solve Analysis and post-process Microwave_e with ranks getdp processes
+    on the partitioned model_name.msh. The onelab parameters are passed
+    on the command line. Returns False when no MPI launcher is available
+    or the parallel run fails, so the caller can solve serially.
+    """
+    launcher = mpiexec()
+    if launcher is None:
+        print('mpi_solve: no mpiexec found, solving serially',
+              file=sys.stderr)
+        return False
+    cmd = [launcher, '-n', str(ranks),
+           os.environ.get('GETDP', 'getdp'), f'{model_name}.pro',
+           '-msh', f'{model_name}.msh']
+    for name in ('Model/Frequency', 'Model/epr'):
+        cmd += ['-setnumber', name, repr(onelab.get_number(name)[0])]
+    cmd += ['-solve', 'Analysis', '-pos', 'Microwave_e'] + list(options)
+    try:
+        subprocess.run(cmd, check=True, stdout=subprocess.DEVNULL)
+    except (OSError, subprocess.CalledProcessError) as e:
+        print(f'mpi_solve: {e}, solving serially', file=sys.stderr)
+        return False
+    set_results()
+    return True
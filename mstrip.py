@@ -1,19 +1,9 @@
 
-# from comsol_patch_1575 import Mspa
-from gmsh import model
-from gmsh import onelab
-from gmsh import option
-from gmsh import plugin
-from matplotlib import pyplot
-from numpy.lib.type_check import imag
-from patch_137 import Mspa
-from pprint import pprint
-from pygetdp import Group, Function, Problem
-from pygetdp.helpers import build_example_png, print_html
-from scipy.constants import mu_0, epsilon_0, pi, speed_of_light
-import gmsh
+import argparse
+import meshing
 import numpy as np
-import os
+import profiling
+import solvers
 import sys
 
 
@@ -49,8 +39,72 @@ GDICT2 = {
     'Prism': 21,
 }
 
+GDICT3 = {
+    'Point': 1,
+    'Line': 6,
+    'Triangle': 16,
+    'Quadrangle': 7,
+    'Tetrahedron': 29,
+    'Hexahedron': 34,
+    'Prism': 21,
+}
+
+# Gauss rules of increasing degree, basis order p integrates with
+# GDICTS[p - 1] (I1, volume terms) and GDICTS[p] (I2, port terms)
+GDICTS = [GDICT1, GDICT2, GDICT3]
+
+# hierarchical Hcurl basis of each order: coefficient suffix, GetDP
+# function and the entities carrying the coefficients
+BASIS = {
+    1: [('', 'BF_Edge', 'EdgesOf')],
+    2: [('', 'BF_Edge', 'EdgesOf'),
+        ('2e', 'BF_Edge_2E', 'EdgesOf'),
+        ('3fb', 'BF_Edge_3F_b', 'FacetsOf'),
+        ('3fc', 'BF_Edge_3F_c', 'FacetsOf')],
+}
+# far from the conductors an order p element resolves the wave about
+# as well as this many first order ones along each edge
+ORDER_COARSENING = {1: 1.0, 2: 2.0}
+ORDER_SIZES = ('Threshold.SizeMax', 'Cylinder.VOut')
+
 
 MODEL_NAME = 'mspa'
+FREQUENCY = 137.1  # MHz, onelab default of Model/Frequency
+EPR = 1.05  # onelab default of Model/epr
+# display cut a x + b y + c z + d = 0, just above the patch
+CUT_PLANE = (0.0, 0.0, 1.0, -0.0145)
+
+# post-processing output profiles: what Microwave_e writes besides y and s11
+OUTPUTS = {
+    'full': ('volume', 'sphere'),  # e and h in the whole domain, ASCII
+    'binary': ('binary', 'sphere'),  # e and h outside the PML, see pipeline
+    'cuts': ('sphere', 'plane'),  # near field sphere and CUT_PLANE only
+    'far_field': ('sphere',),
+    's11': (),
+}
+
+# display only, never set by the headless pipeline
+GUI_OPTIONS = {
+    'General.Antialiasing': 1,
+    'General.AlphaBlending': 1,
+    'View.FakeTransparency': 1,
+    'Mesh.SmoothNormals': 1,
+    # 0: By element type
+    # 1: By elementary entity
+    # 2: By physical group
+    # 3: By mesh partition
+    'Mesh.ColorCarousel': 2,
+    'Mesh.VolumeEdges': 0,
+}
+
+
+def __getattr__(name):
+    # the antenna model pulls in gmsh, only import it when asked for
+    if name == 'Mspa':
+        # from comsol_patch_1575 import Mspa
+        from patch_137 import Mspa
+        return Mspa
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
 
 
 def add_integration(integration, name, group_dict, itype='Gauss'):
@@ -62,360 +116,481 @@ def add_integration(integration, name, group_dict, itype='Gauss'):
         ici.add(GeoElement=element, NumberOfPoints=value)
 
 
+def _check_order(order):
+    if order not in BASIS:
+        raise ValueError(f'unsupported basis order {order}, '
+                         f'expected one of {", ".join(map(str, BASIS))}')
+
+
+def order_mesh_settings(settings, order):
+    """
+    Mesh settings for basis order: the far field sizes (ORDER_SIZES)
+    grow by ORDER_COARSENING, the sizes resolving the geometry stay
+    """
+    _check_order(order)
+    settings = dict(settings)
+    for name in ORDER_SIZES:
+        if name in settings:
+            settings[name] *= ORDER_COARSENING[order]
+    return settings
+
+
+def setup_gui():
+    from gmsh import option
+
+    for name, value in GUI_OPTIONS.items():
+        option.set_number(name, value)
+
+
 def setup_planes():
+    from gmsh import option
+    from gmsh import plugin
+    import gmsh
+
     name = 'CutPlane'
-    plugin.set_number(name, 'A', 0.0)
-    plugin.set_number(name, 'B', 0.0)
-    plugin.set_number(name, 'C', 1.0)
-    plugin.set_number(name, 'D', -0.0145)
+    for option_name, value in zip('ABCD', CUT_PLANE):
+        plugin.set_number(name, option_name, value)
     plugin.set_number(name, 'View', 0)
-    plugin.run(name)
+    cut = plugin.run(name)
     # name = 'ModulusPhase'
     # plugin.set_number(name, 'RealPart', 0)
     # plugin.set_number(name, 'ImaginaryPart', 1)
     # plugin.set_number(name, 'View', 2)
     # plugin.run(name)
-    option.set_string('View[2].Name', 'e_amp')
-    # option.set_number('View[2].ScaleType', 2)
-    option.set_number('View[2].ForceNumComponents', 9)
+    index = gmsh.view.get_index(cut)
+    option.set_string(f'View[{index}].Name', 'e_amp')
+    # option.set_number(f'View[{index}].ScaleType', 2)
+    option.set_number(f'View[{index}].ForceNumComponents', 9)
+
+
+def section(plane=CUT_PLANE):
+    """Three points of the plane a x + b y + c z + d = 0, for OnSection"""
+    n = np.array(plane[:3], dtype=float)
+    origin = -plane[3] * n / np.dot(n, n)
+    u = np.cross(n, np.eye(3)[np.argmin(np.abs(n))])
+    u /= np.linalg.norm(u)
+    v = np.cross(n / np.linalg.norm(n), u)
+    return '{' + ' '.join('{' + ', '.join(map(repr, p.tolist())) + '}'
+                          for p in (origin, origin + u, origin + v)) + '}'
 
 
 def setup_onelab():
-    gmsh.initialize()
-    onelab.set(
-        """
-        [
-            {
-                "type": "number",
-                "name": "Model/Frequency",
-                "values": [137.1],
-                "min": 141.5,
-                "max": 141.0,
-                "step": 10.0,
-                "index": 0,
-                "clients": {"Gmsh": 0}
-            },
-            {
-                "type": "number",
-                "name": "Model/epr",
-                "values": [1.05],
-                "min": 1.0,
-                "max": 1.5,
-                "step": 0.1,
-                "index": 0,
-                "clients": {"Gmsh": 0}
-            },
-            {
-                "type": "number",
-                "name": "Model/Lambda",
-                "readOnly": true,
-                "index": 1,
-                "clients": {"Gmsh": 0}
-            },
-            {
-                "type": "number",
-                "name": "Model/WaveNumber",
-                "label": "Wave Number",
-                "readOnly": true,
-                "index": 2,
-                "clients": {"Gmsh": 0}
-            }
-        ]
-        """
-    )
-
-
-def setup_plugins(r, wavenumber):
-    name = 'CutSphere'
-    plugin.set_number(name, 'Xc', 0.0)
-    plugin.set_number(name, 'Yc', 0.0)
-    plugin.set_number(name, 'Xc', 0.0)
-    plugin.set_number(name, 'R', r)
+    from gmsh import onelab
+    import gmsh
+    import json
 
-    plugin.set_number(name, 'View', 0)
-    plugin.run(name)
-    plugin.set_number(name, 'View', 1)
-    plugin.run(name)
-
-    name = 'NearToFarField'
-    plugin.set_number(name, 'Wavenumber', wavenumber)
-    plugin.set_number(name, 'RFar', 1)
-    plugin.set_number(name, 'NumPointsPhi', 60)  # 50
-    plugin.set_number(name, 'NumPointsTheta', 30)  # 25
-    plugin.set_number(name, 'EView', 3)
-    plugin.set_number(name, 'HView', 4)
-    plugin.set_number(name, 'Normalize', 0)
-    plugin.set_number(name, 'dB', 1)
-    plugin.run(name)
-
-
-setup_onelab()
-antenna = Mspa(MODEL_NAME)
-
-pro = Problem()
-pro.filename = MODEL_NAME + '.pro'
-pro.include('defines.pro')
-
-groups = model.get_physical_groups()
-for g in groups:
-    tag = g[1]
-    name = model.get_physical_name(g[0], g[1])
-    pro.group.add(name, tag)
-pro.group.Region('SurBC', 'SkinFeed')
-pro.group.Region(
-    'DomainTot', ['Substrate', 'SkinFeed', 'Air', 'Pml', 'SigmaInf'])
-pro.group.Region('DomainC', [])  # TODO remove
-pro.group.Region('Domain', ['Substrate', 'Air', 'Pml'])
-pro.group.define('DomainS')  # TODO remove
-pro.group.define('SurS')  # TODO remove
-pro.group.ElementsOf('TrGr', 'Domain', OnOneSideOf='SkinFeed')
-
-
-fvar = {}
-fvar['mu0'] = mu_0
-fvar['nu0'] = 1.0 / mu_0
-fvar['ep0'] = epsilon_0
-# fvar['epr'] = 1.5  # 1.5  # Dielectric constant for FR4 is ~4.5
-
-box = model.occ.get_bounding_box(*antenna.tags['vol_air'])
-
-fvar['pml_xmax'] = box[3]
-fvar['pml_ymax'] = box[4]
-fvar['pml_zmax'] = box[5]
-fvar['pml_xmin'] = box[0]
-fvar['pml_ymin'] = box[1]
-fvar['pml_zmin'] = box[2]
-dc = 0.0  # 0.035e-3
-gap = antenna.dims['gap']
-fvar['gap'] = gap  # TODO refactor it
-fvar['pml_delta'] = 0.2
-fvar['air_boundary'] = 1.3
-fvar['zl'] = 50.0  # Ohm load resistance
-
-f = pro.function
-
-for name, value in fvar.items():
-    f.constant(name, value)
-
-f.add('I', f.Complex(0.0, 1.0))
-f.add('epsilon', 'ep0', region=['Air', 'SkinFeed', 'SigmaInf'])
-f.add('epsilon', 'epr * ep0', region=['Substrate'])
-f.add('nu', 'nu0', region=['Air', 'Substrate', 'SkinFeed', 'SigmaInf'])
-
-f.add('sigma', '6.0e7')  # Copper 6.0e7
-f.define('js0')  # TODO remove
-f.define('ks0')  # TODO remove
-f.define('nxh')  # TODO remove
-
-f.add('r', f.Sqrt('X[]^2 + Y[]^2 + Z[]^2'))
-f.add('dumping_r', '(r[] >= air_boundary) ? 1.0 / (pml_delta - (r[] - air_boundary)) : 0.0')
-f.add('cx', f.Complex(1.0, '-dumping_r[] / k0'))
-f.add('cy', f.Complex(1.0, '-dumping_r[] / k0'))
-f.add('cz', f.Complex(1.0, '-dumping_r[] / k0'))
-
-f.add('tens', f.TensorDiag('cy[] * cz[] / cx[]',
-                           'cx[] * cz[] / cy[]',
-                           'cx[] * cy[] / cz[]'))
-f.add('epsilon', 'ep0 * tens[]', region='Pml')
-f.add('nu', 'nu0 / tens[]', region='Pml')
-
-y_feed = antenna.dims['d_feed']  # - 0.5 * antenna.dims['w_path']
-f.constant('y_feed', y_feed)
-
-# f.add('r_xy', f.Sqrt('X[]^2 + (Y[] + y_feed)^2'))
-# f.add('BC_Fct_e', f.Vector('X[] / r_xy[] / gap',
-#       '(Y[] + y_feed) / r_xy[] / gap', 0.0))
-
-# f.add('dr', f.Vector('-(Y[] + y_feed) / r_xy[] / gap',
-#       'X[] / r_xy[] / gap', 0.0), region=['SkinFeed'])
-
-f.add('r_xy', f.Sqrt('(X[] + y_feed)^2 + (Y[] + y_feed)^2'))
-f.add('BC_Fct_e', f.Vector('(X[] + y_feed) / r_xy[] / gap',
-      '(Y[] + y_feed) / r_xy[] / gap', 0.0))
-
-f.add('dr', f.Vector('-(Y[] + y_feed) / r_xy[] / gap',
-      '(X[] + y_feed) / r_xy[] / gap', 0.0), region=['SkinFeed'])
-
-constr = pro.constraint
-ef = constr.add('ElectricField')
-c0 = ef.add()
-c0.add(Region='SkinFeed', Type='AssignFromResolution',
-       NameOfResolution='Microwave_e_BC')
-c0.add(Region='SkinConductor', Type='Assign', Value=0.0)
-c0.add(Region='SigmaInf', Type='Assign', Value=0.0)
-
-jacobian = pro.jacobian
-for js, s in enumerate(['Vol', 'Sur']):
-    jacobian.add(Name=('J' + s))
-    jacobian.items[js].add()
-    jacobian.items[js].cases[0].add(Region="All", Jacobian=s)
-
-fspace = pro.functionspace
-fs = fspace.add('Hcurl_e', Type='Form1')
-fs.add_basis_function(
-    Name='se',
-    NameOfCoef='ee',
-    Function='BF_Edge',
-    Support='DomainTot',
-    Entity='EdgesOf[All]'
-)
-fs.add_constraint(NameOfCoef='ee', EntityType='EdgesOf',
-                  NameOfConstraint='ElectricField')
-fs = fspace.add('Hcurl_h', Type='Form1')
-fs.add_basis_function(
-    Name='sh',
-    NameOfCoef='he',
-    Function='BF_Edge',
-    Support='DomainTot',
-    Entity='EdgesOf[All]'
-)
-
-add_integration(pro.integration, 'I1', GDICT1)
-add_integration(pro.integration, 'I2', GDICT2)
-
-formulation = pro.formulation
-f = formulation.add('Microwave_e_BC', Type='FemEquation')
-q = f.add_quantity()
-q.add(Name='e', Type='Local', NameOfSpace='Hcurl_e')
-e = f.add_equation()
-e.add('Galerkin', '',
-      'Dof{e} , {e}',
-      In='SurBC', Integration='I2', Jacobian='JSur')
-e.add('Galerkin', '',
-      '-BC_Fct_e[] , {e}',
-      In='SurBC', Integration='I2', Jacobian='JSur')
-
-f = formulation.add('Microwave_e', Type='FemEquation')
-q = f.add_quantity()
-q.add(Name='e', Type='Local', NameOfSpace='Hcurl_e')
-q.add(Name='h', Type='Local', NameOfSpace='Hcurl_h')
-
-e = f.add_equation()
-e.add('Galerkin', '',
-      'nu[] * Dof{d e} , {d e}',
-      In='Domain', Integration='I1', Jacobian='JVol')
-e.add('Galerkin', 'DtDof',
-      'sigma[] * Dof{e}, {e}',
-      In='DomainC', Integration='I1', Jacobian='JVol')
-e.add('Galerkin', 'DtDtDof',
-      'epsilon[] * Dof{e} , {e}',
-      In='Domain', Integration='I1', Jacobian='JVol')
-e.add('Galerkin', '',
-      'Dof{h} , {h}',
-      In='TrGr', Integration='I1', Jacobian='JVol')
-e.add('Galerkin', '',
-      '-I[] * nu[] * Dof{d e} / (2.0 * Pi * freq), {h}',
-      In='TrGr', Integration='I1', Jacobian='JVol')
-
-resolution = pro.resolution
-
-res = resolution.add('Microwave_e_BC; Hidden 1')
-s = res.add_system()
-s.add(Name='B', NameOfFormulation='Microwave_e_BC', DestinationSystem='A')
-
-operation = res.add_operation()
-operation.Generate('B')
-operation.Solve('B')
-operation.TransferSolution('B')
-
-res = resolution.add('Analysis')
-s = res.add_system()
-s.add(Name='A', NameOfFormulation='Microwave_e',
-      Type='Complex', Frequency='freq')
-
-operation = res.add_operation()
-operation.CreateDirectory('build')
-operation.Generate('A')
-operation.Solve('A')
-operation.SaveSolution('A')
-
-pp = pro.postprocessing
-ppi = pp.add('Microwave_e', 'Microwave_e')
-quantity = ppi.add()
-quantity.add(Name='e', Type='Local',
-             Value='{e}',
-             In='DomainTot', Jacobian='JVol')
-quantity.add(Name='h', Type='Local',
-             Value='I[] * nu[] * {d e} / (2.0 * Pi * freq)',
-             In='Domain', Jacobian='JVol')
-
-# quantity.add(Name='e_norm', Type='Local',
-#              Value='Norm[{e}]',
-#              In='Domain', Jacobian='JVol')
-# admittance
-quantity.add(Name='y', Type='Integral',
-             Value='{h} * dr[]', In='SkinFeed',
-             Jacobian='JSur', Integration='I2')
-quantity.add(Name='s11', Type='Term',
-             Value='20.0 * Log10[Norm[(1.0 - zl * $y) / (1.0 + zl * $y)]]', In='SkinFeed')
-
-po = pro.postoperation
-poi = po.add('Microwave_e', 'Microwave_e')
-poi0 = poi.add()
-poi0.add('e', OnElementsOf='Region[{Domain}]', File='./build/e.pos')  # , -Pml
-poi0.add('h', OnElementsOf='Region[{Domain}]', File='./build/h.pos')  # , -Pml
-# poi0.add('e', OnLine='{{0.0, 0.0, 0.02} {0.0, 0.0, 1.1}} {100}',
-#          File='./build/e_linez.pos')
-# poi0.add('h', OnLine='{{0.0, 0.0, 0.02} {0.0, 0.0, 1.1}} {100}',
-#          File='./build/h_linez.pos')
-# poi0.add('e', OnLine='{{0.0, 0.0, 0.2} {0.0, 0.0, 1.2}} {100}', Format='SimpleTable',
-#          File='./build/e_linez.txt')
-# poi0.add(
-#     'e', OnSection='{{0.0, 0.0, 0.0} {1.0, 0.0, 0.0} {0.0, 1.0, 0.0}}', File='./build/e_norm.pos')
-poi0.add('y[SkinFeed]', OnGlobal='', Format='FrequencyTable',
-         StoreInVariable='$y', File='./build/y.txt')
-poi0.add('s11', OnRegion='SkinFeed', Format='FrequencyTable',
-         StoreInVariable='$s11', SendToServer='"s11"', File='./build/s11.txt')
-
-pro.make_file()
-pro.write_file()
-gmsh.open(pro.filename)
-model.set_current(MODEL_NAME)
-
-model.mesh.generate(3)
-gmsh.write(f'{MODEL_NAME}.msh')
-onelab.run()
-setup_planes()
-setup_plugins(1.1, onelab.get_number('Model/WaveNumber')[0])
-
-
-# result = []
-# for s in np.arange(90.0, 200.0, 10.0):
-#     # onelab.set_number('Model/Frequency', [s])
-#     # antenna.refresh()
-#     antenna.d_feed = s * 0.001
-#     model.mesh.generate(3)
-#     gmsh.write(f'{MODEL_NAME}.msh')
-#     model.set_current(MODEL_NAME)
-#     onelab.run()
-#     s11 = onelab.get_number('s11')[0]
-#     size = onelab.get_number('Model/FeedDistance')[0]
-#     freq = onelab.get_number('Model/Frequency')[0]
-#     result.append([freq, size, s11])
-#     # d = np.loadtxt('/home/taran/work/gmsh/mspa/build/e_linez.txt')
-#     # np.savetxt(f'/home/taran/work/gmsh/mspa/build/e_linez_{int(s):03d}.txt', d)
-#     # v1 = np.vectorize(complex)(d[:, 3], d[:, 4])
-#     # v2 = np.vectorize(complex)(d[:, 6], d[:, 7])
-#     # angle = np.degrees(np.angle(-v1 * v2))
-#     # v1 = np.vectorize(complex)(d[:, 3], d[:, 4])
-#     # v2 = np.vectorize(complex)(d[:, 6], d[:, 7])
-#     # v = -v1 * v2
-#     # angle = np.degrees(np.angle(v2) - np.angle(v1))
-#     # angle[angle < 0.0] += 360.0
-#     # pyplot.plot(angle, 'o-')
-#     # pyplot.grid()
-#     # pyplot.savefig(f'v1v2_{int(s):03d}.png')
-#     # pyplot.cla()
-#     # pyplot.clf()
-#     # pyplot.plot(v, 'o-')
-#     # pyplot.grid()
-#     # pyplot.savefig(f'v_{int(s):03d}.png')
-#     # pyplot.cla()
-#     # pyplot.clf()
-#     # result.append((size, angle))
-# pprint(result)
-# gmsh.finalize()
-# exit(0)
+    gmsh.initialize()
+    onelab.set(json.dumps([
+        {
+            'type': 'number',
+            'name': 'Model/Frequency',
+            'values': [FREQUENCY],
+            'min': 141.5,
+            'max': 141.0,
+            'step': 10.0,
+            'index': 0,
+            'clients': {'Gmsh': 0},
+        },
+        {
+            'type': 'number',
+            'name': 'Model/epr',
+            'values': [EPR],
+            'min': 1.0,
+            'max': 1.5,
+            'step': 0.1,
+            'index': 0,
+            'clients': {'Gmsh': 0},
+        },
+        {
+            'type': 'number',
+            'name': 'Model/Lambda',
+            'readOnly': True,
+            'index': 1,
+            'clients': {'Gmsh': 0},
+        },
+        {
+            'type': 'number',
+            'name': 'Model/WaveNumber',
+            'label': 'Wave Number',
+            'readOnly': True,
+            'index': 2,
+            'clients': {'Gmsh': 0},
+        },
+    ]))
+
+
+def setup_far_field(wavenumber, n_theta=30, n_phi=60, plane=None,
+                    condition='pmc'):
+    """
+    Directivity (dBi) from e and h on the near field sphere, computed
+    by far_field instead of the NearToFarField plugin and written to
+    ./build/far_field.pos. Returns theta, phi and the (T, Q) pattern.
+    A half model's half sphere is mirrored about plane first.
+    """
+    import far_field
+    import symmetry
+
+    points, ds, e, h = far_field.read_near_field(
+        './build/e_sphere.pos', './build/h_sphere.pos')
+    if plane is not None:
+        points, ds, e, h = symmetry.unfold_surface(points, ds, e, h, plane,
+                                                   condition)
+    theta, phi = far_field.angles(n_theta, n_phi)
+    f_theta, f_phi = far_field.far_field(
+        points, ds, e, h, wavenumber, theta, phi)
+    d = far_field.directivity(
+        f_theta, f_phi, far_field.radiated_power(ds, e, h))
+    d = far_field.to_db(d[0])
+    far_field.write_pattern('./build/far_field.pos', theta, phi, d,
+                            'directivity')
+    return theta, phi, d
+
+
+def setup_full_fields(antenna):
+    """
+    Mirror the e and h views of a half model into full space views,
+    ./build/e_full.pos and ./build/h_full.pos
+    """
+    import pos_reader
+    import symmetry
+
+    for field in ('e', 'h'):
+        stores = pos_reader.convert(f'./build/{field}.pos',
+                                    mesh_filename=f'{MODEL_NAME}.msh')
+        store = next(s for s in stores.values() if s.kind[0] == 'V')
+        filename = f'./build/{field}_full.pos'
+        symmetry.write_view(filename, store, antenna.symmetry,
+                            antenna.symmetry_bc, field, f'{field}_full')
+
+
+def create_problem(antenna, pml_k0=None, output='full', order=1,
+                   solver='direct'):
+    """
+    Build the GetDP problem for antenna.
+    pml_k0 freezes the PML stretching at that wavenumber, the system
+    matrix is then a polynomial in frequency (see frequency_rom).
+    A half model (antenna.symmetry) gets its PEC or PMC wall, the
+    admittance of the full feed and the near field on a half sphere.
+    output is one of the OUTPUTS profiles of Microwave_e. order 2
+    adds the hierarchical second order edge and facet functions to
+    first order edge elements, with Gauss rules raised to match.
+    solver is one of solvers.SOLVERS, set for getdp by the .pro itself.
+    """
+    from gmsh import model
+    from pygetdp import Problem
+    from scipy.constants import mu_0, epsilon_0
+    import far_field
+    import symmetry
+
+    petsc_options = solvers.options(solver)
+    if output not in OUTPUTS:
+        raise ValueError(f'unknown output {output}, '
+                         f'expected one of {", ".join(OUTPUTS)}')
+    _check_order(order)
+    antenna.build()
+    if antenna.symmetry is not None and \
+            antenna.symmetry_bc not in symmetry.PARITY:
+        raise ValueError(f'unknown symmetry_bc {antenna.symmetry_bc}, '
+                         f'expected one of {", ".join(symmetry.PARITY)}')
+    pro = Problem()
+    pro.filename = MODEL_NAME + '.pro'
+    pro.include('defines.pro')
+
+    groups = model.get_physical_groups()
+    for g in groups:
+        tag = g[1]
+        name = model.get_physical_name(g[0], g[1])
+        pro.group.add(name, tag)
+    pro.group.Region('SurBC', 'SkinFeed')
+    pro.group.Region(
+        'DomainTot', ['Substrate', 'SkinFeed', 'Air', 'Pml', 'SigmaInf'])
+    pro.group.Region('DomainC', [])  # TODO remove
+    pro.group.Region('Domain', ['Substrate', 'Air', 'Pml'])
+    pro.group.define('DomainS')  # TODO remove
+    pro.group.define('SurS')  # TODO remove
+    pro.group.ElementsOf('TrGr', 'Domain', OnOneSideOf='SkinFeed')
+
+    fvar = {}
+    fvar['mu0'] = mu_0
+    fvar['nu0'] = 1.0 / mu_0
+    fvar['ep0'] = epsilon_0
+    # fvar['epr'] = 1.5  # 1.5  # Dielectric constant for FR4 is ~4.5
+
+    box = model.occ.get_bounding_box(*antenna.tags['vol_air'])
+
+    fvar['pml_xmax'] = box[3]
+    fvar['pml_ymax'] = box[4]
+    fvar['pml_zmax'] = box[5]
+    fvar['pml_xmin'] = box[0]
+    fvar['pml_ymin'] = box[1]
+    fvar['pml_zmin'] = box[2]
+    dc = 0.0  # 0.035e-3
+    gap = antenna.dims['gap']
+    fvar['gap'] = gap  # TODO refactor it
+    # the PML absorbs from the air sphere to the outer sphere of the mesh
+    fvar['pml_delta'] = antenna.dims['r_pml'] - antenna.dims['r_air']
+    fvar['air_boundary'] = antenna.dims['r_air']
+    fvar['zl'] = 50.0  # Ohm load resistance
+
+    f = pro.function
+
+    for name, value in fvar.items():
+        f.constant(name, value)
+
+    f.add('I', f.Complex(0.0, 1.0))
+    f.add('epsilon', 'ep0', region=['Air', 'SkinFeed', 'SigmaInf'])
+    f.add('epsilon', 'epr * ep0', region=['Substrate'])
+    f.add('nu', 'nu0', region=['Air', 'Substrate', 'SkinFeed', 'SigmaInf'])
+
+    f.add('sigma', '6.0e7')  # Copper 6.0e7
+    f.define('js0')  # TODO remove
+    f.define('ks0')  # TODO remove
+    f.define('nxh')  # TODO remove
+
+    f.add('r', f.Sqrt('X[]^2 + Y[]^2 + Z[]^2'))
+    f.add('dumping_r', '(r[] >= air_boundary) ? 1.0 / (pml_delta - (r[] - air_boundary)) : 0.0')
+    k_pml = 'k0'
+    if pml_k0 is not None:
+        f.constant('k_pml', pml_k0)
+        k_pml = 'k_pml'
+    f.add('cx', f.Complex(1.0, f'-dumping_r[] / {k_pml}'))
+    f.add('cy', f.Complex(1.0, f'-dumping_r[] / {k_pml}'))
+    f.add('cz', f.Complex(1.0, f'-dumping_r[] / {k_pml}'))
+
+    f.add('tens', f.TensorDiag('cy[] * cz[] / cx[]',
+                               'cx[] * cz[] / cy[]',
+                               'cx[] * cy[] / cz[]'))
+    f.add('epsilon', 'ep0 * tens[]', region='Pml')
+    f.add('nu', 'nu0 / tens[]', region='Pml')
+
+    y_feed = antenna.dims['d_feed']  # - 0.5 * antenna.dims['w_path']
+    f.constant('y_feed', y_feed)
+
+    # f.add('r_xy', f.Sqrt('X[]^2 + (Y[] + y_feed)^2'))
+    # f.add('BC_Fct_e', f.Vector('X[] / r_xy[] / gap',
+    #       '(Y[] + y_feed) / r_xy[] / gap', 0.0))
+
+    # f.add('dr', f.Vector('-(Y[] + y_feed) / r_xy[] / gap',
+    #       'X[] / r_xy[] / gap', 0.0), region=['SkinFeed'])
+
+    f.add('r_xy', f.Sqrt('(X[] + y_feed)^2 + (Y[] + y_feed)^2'))
+    f.add('BC_Fct_e', f.Vector('(X[] + y_feed) / r_xy[] / gap',
+          '(Y[] + y_feed) / r_xy[] / gap', 0.0))
+
+    f.add('dr', f.Vector('-(Y[] + y_feed) / r_xy[] / gap',
+          '(X[] + y_feed) / r_xy[] / gap', 0.0), region=['SkinFeed'])
+
+    constr = pro.constraint
+    ef = constr.add('ElectricField')
+    c0 = ef.add()
+    c0.add(Region='SkinFeed', Type='AssignFromResolution',
+           NameOfResolution='Microwave_e_BC')
+    c0.add(Region='SkinConductor', Type='Assign', Value=0.0)
+    c0.add(Region='SigmaInf', Type='Assign', Value=0.0)
+    if antenna.symmetry is not None and antenna.symmetry_bc == 'pec':
+        # a PMC wall is the natural boundary condition, nothing to add
+        c0.add(Region='SymmetryPlane', Type='Assign', Value=0.0)
+
+    jacobian = pro.jacobian
+    for js, s in enumerate(['Vol', 'Sur']):
+        jacobian.add(Name=('J' + s))
+        jacobian.items[js].add()
+        jacobian.items[js].cases[0].add(Region="All", Jacobian=s)
+
+    fspace = pro.functionspace
+    for space, prefix, constrained in (('Hcurl_e', 'e', True),
+                                       ('Hcurl_h', 'h', False)):
+        fs = fspace.add(space, Type='Form1')
+        for suffix, function, entity in BASIS[order]:
+            fs.add_basis_function(
+                Name=f's{prefix}{suffix}',
+                NameOfCoef=f'{prefix}e{suffix}',
+                Function=function,
+                Support='DomainTot',
+                Entity=f'{entity}[All]'
+            )
+            if constrained:
+                fs.add_constraint(NameOfCoef=f'{prefix}e{suffix}',
+                                  EntityType=entity,
+                                  NameOfConstraint='ElectricField')
+
+    add_integration(pro.integration, 'I1', GDICTS[order - 1])
+    add_integration(pro.integration, 'I2', GDICTS[order])
+
+    formulation = pro.formulation
+    f = formulation.add('Microwave_e_BC', Type='FemEquation')
+    q = f.add_quantity()
+    q.add(Name='e', Type='Local', NameOfSpace='Hcurl_e')
+    e = f.add_equation()
+    e.add('Galerkin', '',
+          'Dof{e} , {e}',
+          In='SurBC', Integration='I2', Jacobian='JSur')
+    e.add('Galerkin', '',
+          '-BC_Fct_e[] , {e}',
+          In='SurBC', Integration='I2', Jacobian='JSur')
+
+    f = formulation.add('Microwave_e', Type='FemEquation')
+    q = f.add_quantity()
+    q.add(Name='e', Type='Local', NameOfSpace='Hcurl_e')
+    q.add(Name='h', Type='Local', NameOfSpace='Hcurl_h')
+
+    e = f.add_equation()
+    e.add('Galerkin', '',
+          'nu[] * Dof{d e} , {d e}',
+          In='Domain', Integration='I1', Jacobian='JVol')
+    e.add('Galerkin', 'DtDof',
+          'sigma[] * Dof{e}, {e}',
+          In='DomainC', Integration='I1', Jacobian='JVol')
+    e.add('Galerkin', 'DtDtDof',
+          'epsilon[] * Dof{e} , {e}',
+          In='Domain', Integration='I1', Jacobian='JVol')
+    e.add('Galerkin', '',
+          'Dof{h} , {h}',
+          In='TrGr', Integration='I1', Jacobian='JVol')
+    e.add('Galerkin', '',
+          '-I[] * nu[] * Dof{d e} / (2.0 * Pi * freq), {h}',
+          In='TrGr', Integration='I1', Jacobian='JVol')
+
+    resolution = pro.resolution
+
+    res = resolution.add('Microwave_e_BC; Hidden 1')
+    s = res.add_system()
+    s.add(Name='B', NameOfFormulation='Microwave_e_BC', DestinationSystem='A')
+
+    operation = res.add_operation()
+    operation.Generate('B')
+    operation.Solve('B')
+    operation.TransferSolution('B')
+
+    res = resolution.add('Analysis')
+    s = res.add_system()
+    s.add(Name='A', NameOfFormulation='Microwave_e',
+          Type='Complex', Frequency='freq')
+
+    operation = res.add_operation()
+    operation.CreateDirectory('build')
+    if petsc_options:
+        operation.SetGlobalSolverOptions(' '.join(petsc_options))
+    operation.Generate('A')
+    operation.Solve('A')
+    operation.SaveSolution('A')
+
+    pp = pro.postprocessing
+    ppi = pp.add('Microwave_e', 'Microwave_e')
+    quantity = ppi.add()
+    quantity.add(Name='e', Type='Local',
+                 Value='{e}',
+                 In='DomainTot', Jacobian='JVol')
+    quantity.add(Name='h', Type='Local',
+                 Value='I[] * nu[] * {d e} / (2.0 * Pi * freq)',
+                 In='Domain', Jacobian='JVol')
+
+    # quantity.add(Name='e_norm', Type='Local',
+    #              Value='Norm[{e}]',
+    #              In='Domain', Jacobian='JVol')
+    # admittance
+    # a half model sees half of the feed current
+    quantity.add(Name='y', Type='Integral',
+                 Value='{h} * dr[]' if antenna.symmetry is None
+                 else '2.0 * {h} * dr[]', In='SkinFeed',
+                 Jacobian='JSur', Integration='I2')
+    quantity.add(Name='s11', Type='Term',
+                 Value='20.0 * Log10[Norm[(1.0 - zl * $y) / (1.0 + zl * $y)]]', In='SkinFeed')
+
+    po = pro.postoperation
+    poi = po.add('Microwave_e', 'Microwave_e')
+    poi0 = poi.add()
+    outputs = OUTPUTS[output]
+    if 'volume' in outputs:
+        poi0.add('e', OnElementsOf='Region[{Domain}]', File='./build/e.pos')
+        poi0.add('h', OnElementsOf='Region[{Domain}]', File='./build/h.pos')
+    if 'binary' in outputs:
+        # mesh-based ElementNodeData, binary when getdp runs with -bin
+        for field in ('e', 'h'):
+            poi0.add(field, OnElementsOf='Region[{Substrate, Air}]',
+                     Format='Gmsh', File=f'./build/{field}.pos')
+    # poi0.add('e', OnLine='{{0.0, 0.0, 0.02} {0.0, 0.0, 1.1}} {100}',
+    #          File='./build/e_linez.pos')
+    # poi0.add('h', OnLine='{{0.0, 0.0, 0.02} {0.0, 0.0, 1.1}} {100}',
+    #          File='./build/h_linez.pos')
+    # poi0.add('e', OnLine='{{0.0, 0.0, 0.2} {0.0, 0.0, 1.2}} {100}', Format='SimpleTable',
+    #          File='./build/e_linez.txt')
+    if 'plane' in outputs:
+        for field in ('e', 'h'):
+            poi0.add(field, OnSection=section(),
+                     File=f'./build/{field}_cut.pos')
+    if 'sphere' in outputs:
+        if antenna.symmetry is None:
+            sphere = far_field.ongrid(antenna.dims['r_near'])
+        else:
+            sphere = far_field.ongrid(antenna.dims['r_near'], 30, 30,
+                                      *symmetry.phi_range(antenna.symmetry))
+        # parsed views are text even with -bin, far_field reads them
+        sphere_format = {'Format': 'GmshParsed'} if 'binary' in outputs \
+            else {}
+        poi0.add('e', OnGrid=sphere, File='./build/e_sphere.pos',
+                 **sphere_format)
+        poi0.add('h', OnGrid=sphere, File='./build/h_sphere.pos',
+                 **sphere_format)
+    poi0.add('y[SkinFeed]', OnGlobal='', Format='FrequencyTable',
+             StoreInVariable='$y', File='./build/y.txt')
+    poi0.add('s11', OnRegion='SkinFeed', Format='FrequencyTable',
+             StoreInVariable='$s11', SendToServer='"s11"', File='./build/s11.txt')
+
+    # port quantities only, for post-processing stored solutions
+    poi = po.add('Admittance', 'Microwave_e')
+    poi0 = poi.add()
+    poi0.add('y[SkinFeed]', OnGlobal='', Format='FrequencyTable',
+             StoreInVariable='$y', File='./build/y.txt')
+    poi0.add('s11', OnRegion='SkinFeed', Format='FrequencyTable',
+             StoreInVariable='$s11', SendToServer='"s11"', File='./build/s11.txt')
+
+    return pro
+
+
+def prepare(pro, antenna, cache=None, size_view=None):
+    """
+    Write the .pro and mesh the antenna. A size_view (see adaptive_mesh)
+    replaces the antenna's size fields and bypasses the mesh cache.
+    """
+    from gmsh import model
+    import gmsh
+
+    with profiling.stage('write_pro', [pro.filename]):
+        pro.make_file()
+        pro.write_file()
+        gmsh.open(pro.filename)
+    model.set_current(MODEL_NAME)
+    if size_view is not None:
+        import adaptive_mesh
+
+        adaptive_mesh.apply_size_view(size_view)
+        cache = None
+
+    antenna.mesh(f'{MODEL_NAME}.msh', cache)
+
+
+def solve(pro, antenna, cache=None, ranks=1, size_view=None):
+    """
+    Mesh and solve, with ranks > 1 on a partitioned mesh by that many
+    MPI getdp processes, falling back to the serial onelab run
+    """
+    from gmsh import onelab
+    import mpi_solve
+
+    prepare(pro, antenna, cache, size_view)
+    with profiling.stage('solve', ['build', f'{MODEL_NAME}.res']):
+        if ranks > 1:
+            mpi_solve.partition(f'{MODEL_NAME}.msh', ranks)
+            if mpi_solve.run(MODEL_NAME, ranks):
+                return
+        onelab.run()
+
+
+def read_frequency_table(filename):
+    """Last row of a FrequencyTable file as (frequency, complex value)"""
+    table = np.loadtxt(filename, ndmin=2)
+    return table[-1, 0], complex(table[-1, -2], table[-1, -1])
 
 
 # def check_event():
@@ -433,10 +608,158 @@ setup_plugins(1.1, onelab.get_number('Model/WaveNumber')[0])
 #     return True
 
 
-if "-nopopup" not in sys.argv:
-    gmsh.fltk.initialize()
-    gmsh.fltk.run()
-    # while gmsh.fltk.isAvailable() and check_event():
-    #     gmsh.fltk.wait()
-
-gmsh.finalize()
+def run(antenna=None, cache=None, ranks=1):
+    """
+    Headless pipeline on an initialized session (see setup_onelab):
+    problem, mesh, solve and far field, without any display option.
+    Returns s11 (dB), y, the wavenumber and the peak directivity (dBi).
+    """
+    from gmsh import onelab
+
+    if antenna is None:
+        antenna = __getattr__('Mspa')(MODEL_NAME)
+    with profiling.stage('problem'):
+        pro = create_problem(antenna)
+    solve(pro, antenna, cache, ranks)
+    k0 = onelab.get_number('Model/WaveNumber')[0]
+    with profiling.stage('far_field', ['./build/far_field.pos']):
+        _, _, d = setup_far_field(k0, plane=antenna.symmetry,
+                                  condition=antenna.symmetry_bc)
+    _, y = read_frequency_table('./build/y.txt')
+    return {'s11': onelab.get_number('s11')[0], 'y': y, 'wavenumber': k0,
+            'directivity': float(d.max())}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Build, mesh and solve the patch antenna')
+    parser.add_argument('-nocache', action='store_true',
+                        help='always regenerate the mesh')
+    parser.add_argument('-nopopup', action='store_true',
+                        help='do not open the gmsh window at the end')
+    parser.add_argument('-headless', action='store_true',
+                        help='no display options, cut planes or window, '
+                             'just print the results')
+    parser.add_argument('-ranks', type=int, default=1,
+                        help='MPI getdp processes')
+    parser.add_argument('-profile', default='./build/profile.json',
+                        help='JSON stage report')
+    parser.add_argument('-cprofile', default=None,
+                        help='also dump cProfile statistics to this file')
+    parser.add_argument('-symmetry', default=None,
+                        help='solve the half model on this side of the '
+                             "plane 'x=0', 'y=0', 'x=y' or 'x=-y'")
+    parser.add_argument('-symmetry-bc', default='pmc',
+                        choices=['pmc', 'pec'],
+                        help='wall on the symmetry plane')
+    parser.add_argument('-force', action='store_true',
+                        help='rerun every stage, even the up to date ones')
+    parser.add_argument('-output', default='full', choices=list(OUTPUTS),
+                        help='fields written by the post-processing: '
+                             'full, binary outside the PML, the cut plane '
+                             'and near field sphere, the sphere only, or '
+                             'just y and s11')
+    parser.add_argument('-order', type=int, default=1,
+                        choices=sorted(BASIS),
+                        help='edge element order, 2 also coarsens the '
+                             'mesh away from the antenna')
+    parser.add_argument('-solver', default='direct',
+                        choices=list(solvers.SOLVERS),
+                        help='linear solver strategy')
+    parser.add_argument('-elements', type=float, default=None,
+                        help='size the mesh for this many tetrahedra')
+    parser.add_argument('-dofs', type=float, default=None,
+                        help='size the mesh for this many unknowns')
+    parser.add_argument('-per-wavelength', type=float, default=None,
+                        help='with -elements or -dofs, minimum elements '
+                             'per wavelength in air')
+    parser.add_argument('-mesh-backend', default=None,
+                        choices=list(meshing.BACKENDS),
+                        help="3D meshing algorithm, 'hxt' is parallel")
+    parser.add_argument('-mesh-threads', type=int, default=None,
+                        help='meshing threads, all the cores with '
+                             '-mesh-backend')
+    parser.add_argument('-air-fraction', type=float, default=None,
+                        help='air clearance around the antenna, in '
+                             'wavelengths')
+    parser.add_argument('-pml-fraction', type=float, default=None,
+                        help='PML thickness, in wavelengths')
+    args = parser.parse_args(argv)
+
+    from mesh_cache import MeshCache
+    import gmsh
+    import pipeline
+
+    cache = None if args.nocache else MeshCache()
+    pipe = pipeline.Pipeline(force=args.force)
+    with profiling.Profiler(args.profile, args.cprofile, args.order):
+        setup_onelab()
+        sizing = {name: getattr(args, name)
+                  for name in ('air_fraction', 'pml_fraction')
+                  if getattr(args, name) is not None}
+        antenna = __getattr__('Mspa')(MODEL_NAME, lazy=True,
+                                      symmetry=args.symmetry,
+                                      symmetry_bc=args.symmetry_bc,
+                                      frequency=FREQUENCY, **sizing)
+        if args.mesh_backend is not None or args.mesh_threads is not None:
+            antenna.mesh_settings = meshing.backend_settings(
+                antenna.mesh_settings, args.mesh_backend, args.mesh_threads)
+        if args.elements is None and args.dofs is None:
+            antenna.mesh_settings = order_mesh_settings(
+                antenna.mesh_settings, args.order)
+        else:
+            import mesh_budget
+
+            _, budget = mesh_budget.plan(antenna, args.elements, args.dofs,
+                                         args.order, args.per_wavelength)
+            print(f"mesh budget: about {budget['tetrahedra']} tetrahedra, "
+                  f"{budget['dofs']} dofs for {budget['target']:.0f} "
+                  f"after {budget['passes']} pre-meshes"
+                  + (', limited by the wavelength'
+                     if budget['limited_by_wavelength'] else ''))
+        results = pipeline.build(antenna, pipe, cache, args.ranks,
+                                 output=args.output, order=args.order,
+                                 solver=args.solver)
+        outputs = OUTPUTS[args.output]
+        volume = 'volume' in outputs or 'binary' in outputs
+        if not args.headless:
+            setup_gui()
+            views = []
+            if volume:
+                views = ['./build/e.pos', './build/h.pos']
+                if args.symmetry is not None:
+                    views = ['./build/e_full.pos', './build/h_full.pos']
+                    pipe.run('full_fields', {'bc': antenna.symmetry_bc},
+                             views, lambda: setup_full_fields(antenna),
+                             after=['post'])
+            elif 'plane' in outputs:
+                views = ['./build/e_cut.pos', './build/h_cut.pos']
+            for filename in views:
+                gmsh.merge(filename)
+            if volume:
+                with profiling.stage('cut_planes'):
+                    setup_planes()
+            if 'sphere' in outputs:
+                gmsh.merge('./build/far_field.pos')
+    directivity = 'n/a' if results['directivity'] is None \
+        else f"{results['directivity']:.2f} dBi"
+    print(f"s11 {results['s11']:.3f} dB, y {results['y']:.6g} S, "
+          f"directivity {directivity}")
+    for i, solve in enumerate(results['solver']['solves']):
+        print(f"{args.solver} solve {i}: {solve['iterations']} iterations, "
+              f"{solve.get('reason', 'no reason reported')}")
+    print(f"reused: {', '.join(pipe.reused) or 'nothing'}; "
+          f"ran: {', '.join(pipe.ran) or 'nothing'}")
+
+    if not args.headless and not args.nopopup:
+        gmsh.fltk.initialize()
+        gmsh.fltk.run()
+        # while gmsh.fltk.isAvailable() and check_event():
+        #     gmsh.fltk.wait()
+
+    gmsh.finalize()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,271 @@
+from adaptive_sweep import s11_db
+from scipy.optimize import minimize
+import argparse
+import json
+import numpy as np
+import os
+import sys
+
+
+# search box of each design parameter (m)
+BOUNDS = {
+    'd_feed': (0.02, 0.30),
+    'patch_size': (0.70, 0.95),
+    'r_cut': (0.0005, 0.10),
+}
+# designs closer than this (m) are the same design, solved once
+RESOLUTION = 1.0e-4
+THRESHOLD = -10.0  # dB, matched band edge
+
+
+class DesignMemo(object):
+    '''
+    Solved points (design, frequency, epr) -> y, appended to a JSON
+    lines file as soon as they are solved, so an interrupted run
+    resumes with everything it already paid for. With config (see
+    sweep.configuration) the first line records it, and a file of
+    another configuration is refused.
+    '''
+
+    def __init__(self, filename, config=None):
+        super().__init__()
+        self.filename = filename
+        self.points = {}
+        stored = None
+        if os.path.isfile(filename):
+            with open(filename) as f:
+                for line in f:
+                    if line.strip():
+                        record = json.loads(line)
+                        if 'config' in record:
+                            stored = record['config']
+                            continue
+                        self.points[self.key(record['point'])] = \
+                            complex(*record['y'])
+        if config is not None:
+            self._check_config(config, stored)
+
+    def _check_config(self, config, stored):
+        text = json.dumps(config, sort_keys=True)
+        if stored is None:
+            if len(self):
+                raise ValueError(f'{self.filename} has no recorded '
+                                 f'configuration, cannot resume into it')
+            with open(self.filename, 'a') as f:
+                f.write(json.dumps({'config': config}, sort_keys=True) +
+                        '\n')
+        elif stored != json.loads(text):
+            raise ValueError(f'{self.filename} holds points of '
+                             f'{json.dumps(stored, sort_keys=True)}, '
+                             f'not {text}')
+
+    @staticmethod
+    def key(point):
+        return json.dumps({k: round(v, 9) for k, v in point.items()},
+                          sort_keys=True)
+
+    def __contains__(self, point):
+        return self.key(point) in self.points
+
+    def __len__(self):
+        return len(self.points)
+
+    def get(self, point):
+        return self.points[self.key(point)]
+
+    def put(self, point, y):
+        self.points[self.key(point)] = y
+        with open(self.filename, 'a') as f:
+            f.write(json.dumps({'point': point, 'y': [y.real, y.imag]}) +
+                    '\n')
+
+
+def quantize(design, resolution=RESOLUTION):
+    return {k: round(round(v / resolution) * resolution, 9)
+            for k, v in design.items()}
+
+
+def band(frequency, goal='s11', span=4.0, n_band=9):
+    """Frequencies (MHz) solved for each design of goal around frequency"""
+    if goal == 's11':
+        return np.array([frequency])
+    if goal == 'bandwidth':
+        return frequency + np.linspace(-0.5, 0.5, n_band) * span
+    raise ValueError(f'unknown goal {goal}')
+
+
+def bandwidth(freqs, s11, target, threshold=THRESHOLD):
+    """
+    Width (MHz) of the band around target where s11 <= threshold,
+    edges interpolated linearly, 0 when target itself is not matched
+    """
+    freqs = np.asarray(freqs, dtype=float)
+    s11 = np.asarray(s11, dtype=float)
+    i = int(np.argmin(np.abs(freqs - target)))
+    if s11[i] > threshold:
+        return 0.0
+
+    def edge(j, step):
+        while 0 <= j + step < len(freqs) and s11[j + step] <= threshold:
+            j += step
+        if not 0 <= j + step < len(freqs):
+            return freqs[j]
+        a, b = s11[j], s11[j + step]
+        return freqs[j] + (threshold - a) / (b - a) * (freqs[j + step] -
+                                                       freqs[j])
+
+    return edge(i, 1) - edge(i, -1)
+
+
+class Objective(object):
+    '''
+    Design vector -> value to minimize, every full-wave solve going
+    through the memo first and the missing ones through sweep.run
+
+    goal 's11' minimizes S11 (dB) at the target frequency, 'bandwidth'
+    maximizes the matched band over n_band frequencies spanning span
+    MHz around it (a design not matched at the target scores its S11
+    above the threshold, so any matched design ranks better).
+    '''
+
+    def __init__(self, names, memo, frequency, epr=None, goal='s11',
+                 span=4.0, n_band=9, resolution=RESOLUTION, root='optimize',
+                 workers=None, cache_dir=None):
+        super().__init__()
+        self.names = tuple(names)
+        self.memo = memo
+        self.frequency = frequency
+        self.epr = epr
+        self.goal = goal
+        self.resolution = resolution
+        self.root = root
+        self.workers = workers
+        self.cache_dir = cache_dir
+        self.freqs = band(frequency, goal, span, n_band)
+        self.history = []
+        self.solves = 0
+
+    def points(self, design):
+        points = []
+        for f in self.freqs:
+            point = dict(design, frequency=float(f))
+            if self.epr is not None:
+                point['epr'] = self.epr
+            points.append(point)
+        return points
+
+    def _solve(self, points):
+        import sweep
+
+        root = os.path.join(self.root, f'solve_{self.solves:04d}')
+        self.solves += 1
+        # one domain for every step, sized for the top of the band
+        rows = sweep.run(points, root, self.workers, cache_dir=self.cache_dir,
+                         design_frequency=float(self.freqs.max()))
+        for point, row in zip(points, rows):
+            if row['error']:
+                print(f'optimizer: {point} failed: {row["error"]}',
+                      file=sys.stderr)
+            else:
+                self.memo.put(point, complex(row['y_re'], row['y_im']))
+
+    def __call__(self, x):
+        design = quantize(dict(zip(self.names, x)), self.resolution)
+        points = self.points(design)
+        missing = [p for p in points if p not in self.memo]
+        if missing:
+            self._solve(missing)
+        # a failed solve counts as total reflection
+        s11 = np.array([s11_db(self.memo.get(p)) if p in self.memo else 0.0
+                        for p in points])
+        if self.goal == 's11':
+            value = s11[0]
+        else:
+            i = int(np.argmin(np.abs(self.freqs - self.frequency)))
+            bw = bandwidth(self.freqs, s11, self.frequency)
+            value = -bw if bw > 0.0 else s11[i] - THRESHOLD
+        self.history.append({'design': design, 'value': float(value),
+                             'solved': len(missing)})
+        return value
+
+
+def optimize(objective, x0, bounds, max_evals=60, xatol=RESOLUTION,
+             fatol=0.05):
+    """
+    Bounded Nelder-Mead on objective. It is deterministic, so rerunning
+    with the same memo replays the finished steps from disk and picks
+    up where an interrupted run stopped.
+    """
+    lo = np.array([b[0] for b in bounds])
+    hi = np.array([b[1] for b in bounds])
+    x0 = np.clip(np.asarray(x0, dtype=float), lo, hi)
+    # first simplex spans 10% of the box so steps are far above
+    # the memo resolution
+    simplex = [x0]
+    for i in range(len(x0)):
+        x = x0.copy()
+        step = 0.1 * (hi[i] - lo[i])
+        x[i] = x[i] + step if x[i] + step <= hi[i] else x[i] - step
+        simplex.append(x)
+    return minimize(objective, x0, method='Nelder-Mead', bounds=bounds,
+                    options={'maxfev': max_evals, 'xatol': xatol,
+                             'fatol': fatol, 'initial_simplex': simplex})
+
+
+def main(argv=None):
+    import patch_137
+    import sweep
+
+    parser = argparse.ArgumentParser(
+        description='Optimize the patch antenna design')
+    parser.add_argument('-f', '--frequency', type=float, default=137.1,
+                        help='target frequency (MHz)')
+    parser.add_argument('--epr', type=float, default=None)
+    parser.add_argument('--goal', choices=['s11', 'bandwidth'], default='s11')
+    parser.add_argument('--span', type=float, default=4.0,
+                        help='MHz around the target for --goal bandwidth')
+    parser.add_argument('--n-band', type=int, default=9)
+    parser.add_argument('-p', '--param', action='append',
+                        metavar='NAME[=LO:HI]',
+                        help='parameter to optimize with optional bounds, '
+                             'default all of ' + ', '.join(BOUNDS))
+    parser.add_argument('--max-evals', type=int, default=60)
+    parser.add_argument('--resolution', type=float, default=RESOLUTION)
+    parser.add_argument('-m', '--memo', default='optimize.jsonl',
+                        help='solved points, reused to resume')
+    parser.add_argument('-d', '--root', default='optimize')
+    parser.add_argument('-j', '--workers', type=int, default=None)
+    parser.add_argument('--cache', default=None,
+                        help='mesh cache directory')
+    args = parser.parse_args(argv)
+
+    bounds = {}
+    for text in args.param or list(BOUNDS):
+        name, _, box = text.partition('=')
+        if name not in BOUNDS:
+            parser.error(f'unknown parameter {name}')
+        bounds[name] = tuple(float(v) for v in box.split(':')) if box \
+            else BOUNDS[name]
+
+    defaults = patch_137.Mspa(lazy=True)
+    x0 = [getattr(defaults, name) for name in bounds]
+    top = band(args.frequency, args.goal, args.span, args.n_band).max()
+    memo = DesignMemo(args.memo, sweep.configuration(float(top)))
+    known = len(memo)
+    objective = Objective(bounds, memo, args.frequency, args.epr, args.goal,
+                          args.span, args.n_band, args.resolution, args.root,
+                          args.workers, args.cache)
+    result = optimize(objective, x0, list(bounds.values()), args.max_evals,
+                      args.resolution)
+
+    best = quantize(dict(zip(bounds, result.x)), args.resolution)
+    solved = sum(h['solved'] for h in objective.history)
+    print(f'{len(objective.history)} evaluations, {solved} solves, '
+          f'{known} points reused from {args.memo}')
+    print(' '.join(f'{k}={v:g}' for k, v in best.items()),
+          f'{args.goal}: {result.fun:.3f}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,28 +1,110 @@
 
+from contextlib import contextmanager
+from entity_index import EntityIndex
 from gmsh import model
 from gmsh import onelab
 from gmsh import option
 import gmsh
 import numpy as np
+import profiling
+import symmetry
+import truncation
 
 occ = model.occ
 field = model.mesh.field
 
+FREQUENCY = 137.1  # MHz, design frequency, sizes the air and PML spheres
+MESH_SETTINGS = {
+    # 1: MeshAdapt, 2: Automatic, 3: Initial mesh only,
+    # 5: Delaunay, 6: Frontal-Delaunay, 7: BAMG,
+    # 8: Frontal-Delaunay for Quads, 9: Packing of Parallelograms
+    'Mesh.Algorithm': 2,
+    # 1: Delaunay, 3: Initial mesh only,
+    # 4: Frontal, 7: MMG3D, 9: R-tree, 10: HXT
+    'Mesh.Algorithm3D': 4,
+    'Mesh.Optimize': 1,
+    'Mesh.Smoothing': 5,
+    'Mesh.MeshSizeExtendFromBoundary': 0,
+    'Mesh.MeshSizeFromPoints': 0,
+    'Mesh.MeshSizeFromCurvature': 0,
+    'Distance.NumPointsPerCurve': 20,
+    'Threshold.SizeMin': 0.01,
+    'Threshold.SizeMax': 0.20,
+    'Threshold.DistMin': 0.00,
+    'Threshold.DistMax': 0.20,
+    'Cylinder.Radius': 0.0011,
+    'Cylinder.VIn': 0.0005,
+    'Cylinder.VOut': 0.30,
+}
+
 
 class Mspa(object):
     '''
     Microstrip patch antenna
+
+    Every parameter change rebuilds the geometry, unless it happens
+    inside batch()/update() (one rebuild at the end) or the antenna is
+    lazy (rebuilt on first access to dims, tags or the mesh).
+
+    With a symmetry plane (see symmetry.PLANES, 'x=y' runs along the
+    feed diagonal) only the half on the positive side is built, the
+    plane carrying a symmetry_bc 'pmc' or 'pec' wall in the problem.
+
+    The air sphere clears the substrate by air_fraction and the PML is
+    pml_fraction thick, in wavelengths at frequency (MHz), the highest
+    one the model is solved at (see truncation.radii).
     '''
 
-    def __init__(self, name='untitled'):
+    PARAMETERS = ('patch_size', 'd_feed', 'r_cut')
+    # mesh settings that are element sizes
+    SIZES = ('Threshold.SizeMin', 'Threshold.SizeMax', 'Cylinder.VIn',
+             'Cylinder.VOut')
+
+    def __init__(self, name='untitled', lazy=False, mesh_settings=None,
+                 symmetry=None, symmetry_bc='pmc', frequency=FREQUENCY,
+                 air_fraction=truncation.AIR_FRACTION,
+                 pml_fraction=truncation.PML_FRACTION):
         super().__init__()
         self.name = name
-        self.dims = {}
-        self.tags = {}
+        self.symmetry = symmetry
+        self.symmetry_bc = symmetry_bc
+        self._frequency = frequency
+        self.air_fraction = air_fraction
+        self.pml_fraction = pml_fraction
+        self._dims = {}
+        self._tags = {}
+        self.mesh_settings = dict(MESH_SETTINGS)
+        self.mesh_settings.update(mesh_settings or {})
         self._d_feed = 0.12
         self._r_cut = 0.001
         self._patch_size = 0.850
-        self.refresh()
+        self._lazy = lazy
+        self._batch_depth = 0
+        self._dirty = True
+        if not lazy:
+            self.refresh()
+
+    @property
+    def dims(self):
+        """Geometry dimensions"""
+        self.build()
+        return self._dims
+
+    @property
+    def tags(self):
+        """Entity tags"""
+        self.build()
+        return self._tags
+
+    @property
+    def frequency(self):
+        """Highest frequency (MHz), sizes the air and PML spheres"""
+        return self._frequency
+
+    @frequency.setter
+    def frequency(self, value):
+        self._frequency = value
+        self._changed()
 
     @property
     def patch_size(self):
@@ -42,19 +124,59 @@ class Mspa(object):
     @patch_size.setter
     def patch_size(self, value):
         self._patch_size = value
-        self.refresh()
+        self._changed()
 
     @d_feed.setter
     def d_feed(self, value):
         self._d_feed = value
-        self.refresh()
+        self._changed()
 
     @r_cut.setter
     def r_cut(self, value):
         self._r_cut = value
-        self.refresh()
+        self._changed()
+
+    def _changed(self):
+        self._dirty = True
+        if not self._lazy and self._batch_depth == 0:
+            self.refresh()
+
+    @contextmanager
+    def batch(self):
+        """Defer rebuilding until the outermost batch exits"""
+        self._batch_depth += 1
+        try:
+            yield self
+        finally:
+            self._batch_depth -= 1
+            if self._batch_depth == 0 and not self._lazy:
+                self.build()
+
+    def update(self, **params):
+        """Set several parameters with a single rebuild"""
+        for name in params:
+            if name not in self.PARAMETERS:
+                raise AttributeError(f'unknown Mspa parameter: {name}')
+        with self.batch():
+            for name, value in params.items():
+                setattr(self, name, value)
+
+    def build(self):
+        """Rebuild the geometry if parameters changed since the last build"""
+        if self._dirty and self._batch_depth == 0:
+            self.refresh()
 
     def refresh(self):
+        # clean while building, dims and tags call build(), but a failed
+        # build leaves a partial model to be redone on next access
+        self._dirty = False
+        try:
+            self._rebuild()
+        except BaseException:
+            self._dirty = True
+            raise
+
+    def _rebuild(self):
         gmsh.clear()
 
         mm = 1.0e-3
@@ -76,11 +198,20 @@ class Mspa(object):
         self.dims['r_feed'] = r_feed
         self.dims['r_shield'] = r_shield
         self.dims['d_feed'] = self.d_feed
-
-        model.add(self.name)
-        self._create_antenna()
-        occ.synchronize()
-        self._set_mesh_settings()
+        self.dims.update(truncation.radii(
+            [-0.5 * w_sub, -0.5 * l_sub, -0.5 * d,
+             0.5 * w_sub, 0.5 * l_sub, 0.5 * d],
+            self.frequency, self.air_fraction, self.pml_fraction))
+
+        with profiling.stage('occ_build'):
+            model.add(self.name)
+            self._create_antenna()
+            occ.synchronize()
+            if self.symmetry is not None:
+                self._cut_half()
+            self._find_surfaces()
+        with profiling.stage('mesh_settings'):
+            self._set_mesh_settings()
         self._create_groups()
 
     def _create_antenna(self):
@@ -150,9 +281,9 @@ class Mspa(object):
                           tag=0, removeObject=True, removeTool=True)
         vol_patch = tags[0]
 
-        tag = occ.add_sphere(0.0, 0.0, 0.0, l_sub)
+        tag = occ.add_sphere(0.0, 0.0, 0.0, self.dims['r_air'])
         vol_air = (3, tag)
-        tag = occ.add_sphere(0.0, 0.0, 0.0, l_sub + 0.20)
+        tag = occ.add_sphere(0.0, 0.0, 0.0, self.dims['r_pml'])
         vol_pml = (3, tag)
 
         occ.synchronize()
@@ -175,40 +306,80 @@ class Mspa(object):
         occ.synchronize()
         occ.remove_all_duplicates()
 
-        self.tags['sur_feed'] = (2, 52)
-        self.tags['sur_conductor'] = [19, 20, 21, 23, 25, 50, 51]
-
         self.tags['sur_pml'] = sur_pml
         self.tags['vol_air'] = vol_air
         self.tags['vol_pml'] = vol_pml
         self.tags['vol_substrate'] = [vol_patch[1],
                                       vol_substrate1[1], vol_substrate2[1]]
 
+    def _cut_half(self):
+        symmetry.check(self.symmetry)
+        r_pml = self.dims['r_pml']
+        kept = symmetry.cut_half(self.symmetry, r_pml)
+        self.tags['vol_air'] = (3, kept[self.tags['vol_air'][1]][0])
+        self.tags['vol_pml'] = (3, kept[self.tags['vol_pml'][1]][0])
+        self.tags['vol_substrate'] = [
+            t for v in self.tags['vol_substrate'] for t in kept[v]]
+        self.tags['sur_pml'] = symmetry.outer_face(self.tags['vol_pml'],
+                                                   self.symmetry)
+        self.tags['sur_symmetry'] = symmetry.on_plane(self.symmetry)
+
+    def _find_surfaces(self):
+        d = self.dims['d']
+        w_sub = self.dims['w_sub']
+        l_sub = self.dims['l_sub']
+        r_feed = self.dims['r_feed']
+        r_shield = self.dims['r_shield']
+        d_feed = self.d_feed
+        z_bot = -0.5 * d
+        z_top = 0.5 * d
+
+        index = EntityIndex(2)
+        shield = [-d_feed - r_shield, -d_feed - r_shield, z_bot,
+                  -d_feed + r_shield, -d_feed + r_shield, z_bot]
+        pin = [-d_feed - r_feed, -d_feed - r_feed, z_bot,
+               -d_feed + r_feed, -d_feed + r_feed, z_top]
+        top = [-0.5 * w_sub, -0.5 * l_sub, z_top,
+               0.5 * w_sub, 0.5 * l_sub, z_top]
+
+        if self.symmetry is None:
+            # coax aperture: the feed/shield annulus on the ground side
+            sur_feed = index.one(index.matching(shield), 'feed aperture')
+            # inner conductor wall
+            sur_pin = [index.one(index.matching(pin), 'feed pin')[1]]
+            # bare substrate top around the patch
+            sur_bare = index.one(index.matching(top), 'substrate top')
+        else:
+            # the plane halves these faces, find them by containment
+            in_pin = set(index.inside(pin))
+            tags = [t for t in index.inside(shield) if t not in in_pin]
+            sur_feed = index.one(tags, 'feed aperture')
+            on_top = set(index.on_plane(2, z_top))
+            flat = set(index.on_plane(2, z_bot)) | on_top | \
+                set(self.tags['sur_symmetry'])
+            # the cylinder seam may split the half wall in two
+            sur_pin = sorted(in_pin - flat)
+            if not sur_pin:
+                raise ValueError('expected the feed pin wall, found none')
+            reach = 0.5 * min(w_sub, l_sub) - index.tol
+            tags = [t for t, box in zip(index.tags, index.boxes)
+                    if t in on_top and np.abs(box).max() >= reach]
+            sur_bare = index.one(tags, 'substrate top')
+
+        # ground plane, patch and pin ends all lie on the substrate faces
+        sur_conductor = set(index.on_plane(2, z_bot))
+        sur_conductor |= set(index.on_plane(2, z_top))
+        sur_conductor -= {sur_feed[1], sur_bare[1]}
+        sur_conductor |= set(sur_pin)
+
+        self.tags['sur_feed'] = sur_feed
+        self.tags['sur_conductor'] = sorted(int(t) for t in sur_conductor)
+
     def _set_mesh_settings(self):
-        option.set_number('General.Antialiasing', 1)
-        option.set_number('General.AlphaBlending', 1)
-        option.set_number('View.FakeTransparency', 1)
-
-        # 1: MeshAdapt, 2: Automatic, 3: Initial mesh only,
-        # 5: Delaunay, 6: Frontal-Delaunay, 7: BAMG,
-        # 8: Frontal-Delaunay for Quads, 9: Packing of Parallelograms
-        option.set_number('Mesh.Algorithm', 2)
-        # 1: Delaunay, 3: Initial mesh only,
-        # 4: Frontal, 7: MMG3D, 9: R-tree, 10: HXT
-        option.set_number('Mesh.Algorithm3D', 4)
-        option.set_number('Mesh.Optimize', 1)
-        option.set_number('Mesh.Smoothing', 5)
-        option.set_number('Mesh.SmoothNormals', 1)
-        # 0: By element type
-        # 1: By elementary entity
-        # 2: By physical group
-        # 3: By mesh partition
-        option.set_number('Mesh.ColorCarousel', 2)
-        option.set_number('Mesh.VolumeEdges', 0)
-
-        option.set_number("Mesh.MeshSizeExtendFromBoundary", 0)
-        option.set_number("Mesh.MeshSizeFromPoints", 0)
-        option.set_number("Mesh.MeshSizeFromCurvature", 0)
+        settings = self.mesh_settings
+        for name, value in settings.items():
+            if name.startswith('Mesh.'):
+                option.set_number(name, value)
 
         # mesh sizes by elements
         d = self.dims['d']
@@ -217,31 +388,32 @@ class Mspa(object):
         vol_substrate = self.tags['vol_substrate']
 
         tags = model.get_boundary(
-            [
-                (3, vol_substrate[0]),
-                (3, vol_substrate[1]),
-                (3, vol_substrate[2])
-            ], False, False, False)
+            [(3, tag) for tag in vol_substrate], False, False, False)
 
         tags = model.get_boundary(tags, False, False, False)
         a = np.array(tags)
         a = list(np.unique(a[:, 1]))
+        if self.symmetry is not None:
+            # cut edges are not feature edges, don't refine along them
+            cut = set(symmetry.on_plane(self.symmetry, 1))
+            a = [t for t in a if t not in cut]
 
         field.add("Distance", 1)
         field.set_numbers(1, "CurvesList", a)
-        field.set_number(1, "NumPointsPerCurve", 20)
+        field.set_number(1, "NumPointsPerCurve",
+                         settings['Distance.NumPointsPerCurve'])
 
         field.add("Threshold", 2)
         field.set_number(2, "InField", 1)
-        field.set_number(2, "SizeMin", 0.01)
-        field.set_number(2, "SizeMax", 0.20)
-        field.set_number(2, "DistMin", 0.00)
-        field.set_number(2, "DistMax", 0.20)
+        field.set_number(2, "SizeMin", settings['Threshold.SizeMin'])
+        field.set_number(2, "SizeMax", settings['Threshold.SizeMax'])
+        field.set_number(2, "DistMin", settings['Threshold.DistMin'])
+        field.set_number(2, "DistMax", settings['Threshold.DistMax'])
 
         field.add("Cylinder", 3)
-        field.set_number(3, "Radius", 0.0011)
-        field.set_number(3, "VIn", 0.0005)
-        field.set_number(3, "VOut", 0.30)
+        field.set_number(3, "Radius", settings['Cylinder.Radius'])
+        field.set_number(3, "VIn", settings['Cylinder.VIn'])
+        field.set_number(3, "VOut", settings['Cylinder.VOut'])
         field.set_number(3, "XAxis", 0.00)
         field.set_number(3, "XCenter", -d_feed)
         # field.set_number(3, "XCenter", 0.00)
@@ -255,6 +427,44 @@ class Mspa(object):
 
         field.set_as_background_mesh(4)
 
+    def apply_mesh_settings(self, settings):
+        """
+        Replace the mesh settings and size fields of the built model,
+        without rebuilding the geometry
+        """
+        self.build()
+        self.mesh_settings = dict(settings)
+        for tag in field.list():
+            field.remove(tag)
+        self._set_mesh_settings()
+
+    def mesh(self, filename, cache=None):
+        """
+        Generate the 3D mesh and write it to filename.
+        With a MeshCache, an identical geometry is merged from disk
+        instead of being remeshed. Returns True on a cache hit.
+        """
+        self.build()
+        key = None
+        cached = None
+        if cache is not None:
+            key = cache.key(self)
+            cached = cache.get(key)
+        if cached is None:
+            with profiling.stage('mesh_generate', counts=True):
+                model.mesh.generate(3)
+        else:
+            # the cached file carries the same physical groups,
+            # drop ours so merging doesn't tag the entities twice
+            model.remove_physical_groups()
+            with profiling.stage('mesh_merge', [cached], counts=True):
+                gmsh.merge(cached)
+        with profiling.stage('mesh_write', [filename]):
+            gmsh.write(filename)
+        if key is not None and cached is None:
+            cache.put(key, filename)
+        return cached is not None
+
     def _create_groups(self):
 
         sur_feed = self.tags['sur_feed']
@@ -282,3 +492,7 @@ class Mspa(object):
 
         tag = model.add_physical_group(2, [sur_pml[1]])
         model.set_physical_name(2, tag, 'SigmaInf')
+
+        if self.symmetry is not None:
+            tag = model.add_physical_group(2, self.tags['sur_symmetry'])
+            model.set_physical_name(2, tag, 'SymmetryPlane')
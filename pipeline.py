@@ -0,0 +1,253 @@
+from scipy.constants import speed_of_light
+import hashlib
+import inspect
+import json
+import numpy as np
+import os
+import profiling
+import re
+import subprocess
+import sys
+
+
+MANIFEST = os.path.join('build', 'pipeline.json')
+
+
+def digest(value):
+    """sha256 of text, or of the sorted JSON of any other value"""
+    if not isinstance(value, str):
+        value = json.dumps(value, sort_keys=True, default=repr)
+    return hashlib.sha256(value.encode()).hexdigest()
+
+
+def file_digest(filename):
+    h = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _stamp(filename):
+    st = os.stat(filename)
+    return [st.st_size, st.st_mtime_ns]
+
+
+class Pipeline(object):
+    '''
+    Make-like chain of stages recorded in a JSON manifest
+
+    A stage hashes its declared inputs together with the hashes of the
+    stages it comes after, and runs only when that hash differs from
+    the one recorded after its last run or when one of its outputs is
+    missing or was touched since. Otherwise its outputs are reused and
+    the result it returned last time is returned again.
+    '''
+
+    def __init__(self, manifest=MANIFEST, force=False):
+        super().__init__()
+        self.manifest = manifest
+        self.force = force
+        self.records = {}
+        if os.path.isfile(manifest):
+            with open(manifest) as f:
+                self.records = json.load(f)
+        self.hashes = {}
+        self.ran = []
+        self.reused = []
+
+    def fresh(self, name, key, outputs):
+        record = self.records.get(name)
+        if self.force or record is None or record['hash'] != key:
+            return False
+        for filename in outputs:
+            if not os.path.isfile(filename) or \
+                    _stamp(filename) != record['outputs'].get(filename):
+                return False
+        return True
+
+    def run(self, name, inputs, outputs=(), action=None, after=()):
+        """
+        Stage name: call action() unless up to date, return its result.
+        A stage without action only contributes its hash to later ones.
+        """
+        key = digest({'inputs': inputs,
+                      'after': [self.hashes[a] for a in after]})
+        self.hashes[name] = key
+        if action is None:
+            return None
+        if self.fresh(name, key, outputs):
+            self.reused.append(name)
+            return self.records[name]['result']
+        with profiling.stage(name, outputs):
+            result = action()
+        self.ran.append(name)
+        self.records[name] = {
+            'hash': key,
+            'outputs': {f: _stamp(f) for f in outputs},
+            'result': result,
+        }
+        self.save()
+        return result
+
+    def save(self):
+        directory = os.path.dirname(self.manifest)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp = self.manifest + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.records, f, indent=1, sort_keys=True)
+        os.replace(tmp, self.manifest)
+
+
+def split_problem(code):
+    """
+    GetDP code of the solve (everything up to PostProcessing) and of
+    the post-processing, so editing the latter keeps the solution
+    """
+    start = code.index('\nPostProcessing{')
+    return code[:start], code[start:]
+
+
+def post_outputs(code):
+    """Files written by the post-operations of the code"""
+    return sorted(set(re.findall(r'File "([^"]+)"', code)))
+
+
+def getdp(model_name, args, ranks=1, log=None):
+    """
+    Run getdp on model_name.pro/.msh with the onelab model parameters,
+    through mpiexec when ranks > 1, serially if that is not possible.
+    getdp's output goes to the file log, if given.
+    """
+    from gmsh import onelab
+    import mpi_solve
+
+    cmd = [os.environ.get('GETDP', 'getdp'), f'{model_name}.pro',
+           '-msh', f'{model_name}.msh']
+    for name in ('Model/Frequency', 'Model/epr'):
+        cmd += ['-setnumber', name, repr(onelab.get_number(name)[0])]
+    cmd += list(args)
+
+    def call(command):
+        if log is None:
+            subprocess.run(command, check=True, stdout=subprocess.DEVNULL)
+            return
+        os.makedirs(os.path.dirname(log) or '.', exist_ok=True)
+        with open(log, 'w') as f:
+            subprocess.run(command, check=True, stdout=f,
+                           stderr=subprocess.STDOUT)
+
+    launcher = mpi_solve.mpiexec()
+    if ranks > 1 and launcher is not None:
+        try:
+            call([launcher, '-n', str(ranks)] + cmd +
+                 mpi_solve.SOLVER_OPTIONS)
+            return
+        except (OSError, subprocess.CalledProcessError) as e:
+            print(f'pipeline: {e}, running serially', file=sys.stderr)
+    call(cmd)
+
+
+def _class_source(antenna):
+    cls = type(antenna)
+    return digest(inspect.getsource(cls))
+
+
+def build(antenna, pipe, cache=None, ranks=1, n_theta=30, n_phi=60,
+          output='full', order=1, solver='direct'):
+    """
+    mstrip's geometry -> mesh -> .pro -> solve -> post -> far field
+    chain on an initialized session (see mstrip.setup_onelab), each
+    stage redone only when what it depends on changed. output is one
+    of mstrip.OUTPUTS, the 'binary' one is post-processed with -bin,
+    order the edge element order and solver one of solvers.SOLVERS
+    (see mstrip.create_problem).
+    Returns the same dict as mstrip.run, directivity None when the
+    output has no near field sphere, plus the solver settings and
+    convergence under 'solver' (see solvers.record).
+    """
+    from gmsh import onelab
+    import gmsh
+    import mpi_solve
+    import mstrip
+    import solvers
+
+    name = mstrip.MODEL_NAME
+    params = {p: onelab.get_number(f'Model/{p}')[0]
+              for p in ('Frequency', 'epr')}
+
+    pipe.run('geometry', {
+        'class': _class_source(antenna),
+        'dims': antenna.dims,
+        'symmetry': antenna.symmetry,
+    })
+
+    def mesh():
+        antenna.mesh(f'{name}.msh', cache)
+        if ranks > 1:
+            mpi_solve.partition(f'{name}.msh', ranks)
+
+    pipe.run('mesh', {
+        'mesh_settings': antenna.mesh_settings,
+        'partitions': ranks,
+        'gmsh': gmsh.__version__,
+    }, [f'{name}.msh'], mesh, after=['geometry'])
+
+    with profiling.stage('problem'):
+        pro = mstrip.create_problem(antenna, output=output, order=order,
+                                   solver=solver)
+        pro.make_file()
+        code = pro.get_code()
+    solve_code, post_code = split_problem(code)
+
+    def write_pro():
+        pro.write_file()
+
+    pipe.run('write_pro', {'code': code}, [pro.filename], write_pro)
+
+    def solve():
+        getdp(name, ['-solve', 'Analysis'], ranks, solvers.LOG)
+        with open(solvers.LOG) as f:
+            result = solvers.record(solver, f.read())
+        if not result['converged']:
+            print(f'pipeline: {solver} did not converge, see {solvers.LOG}',
+                  file=sys.stderr)
+        return result
+
+    convergence = pipe.run('solve', {
+        'problem': solve_code,
+        'defines': file_digest('defines.pro'),
+        'params': params,
+    }, [f'{name}.pre', f'{name}.res', solvers.RECORD], solve,
+        after=['mesh'])
+
+    post_args = ['-res', f'{name}.res', '-pos', 'Microwave_e']
+    if 'binary' in mstrip.OUTPUTS[output]:
+        # mesh-based binary files; binary list-based ones are far larger
+        post_args += ['-v2', '-bin']
+    pipe.run('post', {'problem': post_code, 'args': post_args},
+             post_outputs(post_code), lambda: getdp(name, post_args),
+             after=['solve'])
+    mpi_solve.set_results()
+
+    k0 = 2.0 * np.pi * params['Frequency'] * 1.0e6 / speed_of_light
+
+    def far_field():
+        _, _, d = mstrip.setup_far_field(k0, n_theta, n_phi,
+                                         antenna.symmetry,
+                                         antenna.symmetry_bc)
+        return float(d.max())
+
+    directivity = None
+    if 'sphere' in mstrip.OUTPUTS[output]:
+        directivity = pipe.run('far_field', {
+            'n_theta': n_theta,
+            'n_phi': n_phi,
+            'bc': antenna.symmetry_bc,
+            'source': digest(inspect.getsource(mstrip.setup_far_field)),
+        }, ['./build/far_field.pos'], far_field, after=['post'])
+
+    _, y = mstrip.read_frequency_table('./build/y.txt')
+    return {'s11': onelab.get_number('s11')[0], 'y': y, 'wavenumber': k0,
+            'directivity': directivity, 'solver': convergence}
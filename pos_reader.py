@@ -0,0 +1,543 @@
+import argparse
+import json
+import numpy as np
+import os
+import re
+import sys
+
+
+# node count and gmsh type of each post-processing element kind
+ELEMENTS = {
+    'P': (1, 15), 'L': (2, 1), 'T': (3, 2), 'Q': (4, 3),
+    'S': (4, 4), 'H': (8, 5), 'I': (6, 6), 'Y': (5, 7),
+    'L2': (3, 8), 'T2': (6, 9), 'Q2': (9, 10), 'S2': (10, 11),
+    'H2': (27, 12), 'I2': (18, 13), 'Y2': (14, 14),
+}
+COMPONENTS = {'S': 1, 'V': 3, 'T': 9}
+# gmsh element type -> number of nodes and kind, for mesh-based files
+GMSH_NODES = {t: n for n, t in ELEMENTS.values()}
+GMSH_KINDS = {t: kind for kind, (_, t) in ELEMENTS.items()}
+FIELDS = {c: field for field, c in COMPONENTS.items()}
+
+CHUNK = 1 << 16
+
+
+class FieldStore(object):
+    '''
+    One post-processing view of one element kind, as memory-mapped arrays
+
+    nodes (N, 3) float64, connectivity (E, n) node indices,
+    values (E, n, c) complex128, plus element_tags (E) when the view
+    refers to mesh elements. Arrays are opened read-only on access,
+    so only the pages actually touched are loaded.
+    '''
+
+    def __init__(self, directory):
+        super().__init__()
+        self.directory = directory
+        with open(os.path.join(directory, 'meta.json')) as f:
+            self.meta = json.load(f)
+        self.name = self.meta['name']
+        self.kind = self.meta['kind']
+
+    def __contains__(self, name):
+        return name in self.meta['arrays']
+
+    def __getitem__(self, name):
+        info = self.meta['arrays'][name]
+        shape = tuple(info['shape'])
+        if 0 in shape:
+            return np.zeros(shape, dtype=info['dtype'])
+        return np.memmap(os.path.join(self.directory, name + '.bin'),
+                         dtype=info['dtype'], mode='r', shape=shape)
+
+    @property
+    def nodes(self):
+        return self['nodes']
+
+    @property
+    def connectivity(self):
+        return self['connectivity']
+
+    @property
+    def values(self):
+        return self['values']
+
+    def __len__(self):
+        return self.meta['arrays']['values']['shape'][0]
+
+    def chunks(self, size=CHUNK):
+        """Element slices of at most size elements"""
+        for start in range(0, len(self), size):
+            yield slice(start, min(start + size, len(self)))
+
+    def element_nodes(self, s=slice(None)):
+        """Node coordinates of elements s, shape (E, n, 3)"""
+        return np.asarray(self.nodes[self.connectivity[s]])
+
+
+class _Writer(object):
+    '''Appends rows of one array to a raw binary file'''
+
+    def __init__(self, directory, name, dtype, row_shape):
+        super().__init__()
+        self.filename = os.path.join(directory, name + '.bin')
+        self.dtype = np.dtype(dtype)
+        self.row_shape = tuple(row_shape)
+        self.rows = 0
+        self.file = open(self.filename, 'wb')
+
+    def write(self, data):
+        data = np.ascontiguousarray(data, dtype=self.dtype)
+        data = data.reshape((-1,) + self.row_shape)
+        self.file.write(data.tobytes())
+        self.rows += data.shape[0]
+
+    def close(self):
+        self.file.close()
+        return {'dtype': self.dtype.str, 'shape': [self.rows] +
+                list(self.row_shape)}
+
+
+class _StoreBuilder(object):
+
+    def __init__(self, directory, name, kind, n_nodes, n_comp, steps):
+        super().__init__()
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.meta = {'name': name, 'kind': kind, 'arrays': {}}
+        self.n_nodes = n_nodes
+        self.n_comp = n_comp
+        self.steps = steps
+        self.writers = {}
+
+    def writer(self, name, dtype, row_shape):
+        if name not in self.writers:
+            self.writers[name] = _Writer(self.directory, name, dtype,
+                                         row_shape)
+        return self.writers[name]
+
+    def add_elements(self, coords, values):
+        """coords (E, n, 3), values (E, steps, n, c)"""
+        n = self.n_nodes
+        nodes = self.writer('nodes', np.float64, (3,))
+        first = nodes.rows
+        nodes.write(coords.reshape(-1, 3))
+        conn = first + np.arange(coords.shape[0] * n).reshape(-1, n)
+        self.writer('connectivity', np.int64, (n,)).write(conn)
+        self.add_values(values)
+
+    def add_values(self, values):
+        values = values.reshape(values.shape[0], self.steps, self.n_nodes,
+                                self.n_comp)
+        z = values[:, 0].astype(np.complex128)
+        if self.steps > 1:
+            # harmonic results: time step 0 is the real, 1 the imaginary part
+            z += 1j * values[:, 1]
+        self.writer('values', np.complex128,
+                    (self.n_nodes, self.n_comp)).write(z)
+
+    def close(self):
+        for name, writer in self.writers.items():
+            self.meta['arrays'][name] = writer.close()
+        with open(os.path.join(self.directory, 'meta.json'), 'w') as f:
+            json.dump(self.meta, f, indent=1)
+        return FieldStore(self.directory)
+
+
+class _Numbers(object):
+    '''Whitespace separated numbers of a text file, taken in blocks'''
+
+    def __init__(self, f):
+        super().__init__()
+        self.f = f
+        self.pending = []
+
+    def take(self, count):
+        tokens = self.pending
+        while len(tokens) < count:
+            line = self.f.readline()
+            if not line:
+                raise ValueError('unexpected end of file')
+            tokens.extend(line.split())
+        self.pending = tokens[count:]
+        return np.array(tokens[:count], dtype=float)
+
+    def take_rows(self, rows, width):
+        for start in range(0, rows, CHUNK):
+            k = min(CHUNK, rows - start)
+            yield self.take(k * width).reshape(k, width)
+
+
+def _read_legacy(f, directory):
+    """
+    $PostFormat 1.x views, every element carries its own coordinates,
+    ASCII or binary (GetDP -bin without -v2); f is opened in binary mode
+    and positioned after the $PostFormat line
+    """
+    version, file_type, data_size = f.readline().split()[:3]
+    version = float(version)
+    binary = int(file_type) == 1
+    if int(file_type) not in (0, 1):
+        raise ValueError(f'unknown $PostFormat file type {int(file_type)}, '
+                         'expected one of 0, 1')
+    if binary and int(data_size) != 8:
+        raise ValueError(f'$PostFormat data size {int(data_size)}, '
+                         'only 8 byte doubles are supported')
+    f.readline()  # $EndPostFormat
+    stores = {}
+    for line in f:
+        if not line.startswith(b'$View'):
+            continue
+        header = f.readline().split()
+        name = header[0].decode()
+        steps = int(header[1])
+        numbers = _Numbers(f)
+        numbers.pending = header[2:]
+        kinds = ['P', 'L', 'T', 'Q', 'S', 'H', 'I', 'Y']
+        if version >= 1.4:
+            kinds += ['L2', 'T2', 'Q2', 'S2', 'H2', 'I2', 'Y2']
+        counts = numbers.take(3 * len(kinds)).astype(int)
+        numbers.take(4)  # text2d/text3d counts
+        if binary:
+            if numbers.pending:
+                raise ValueError('binary $View data on the header line')
+            one = f.read(4)
+            byteorder = '<'
+            if np.frombuffer(one, '<i4')[0] != 1:
+                byteorder = '>'
+            f.read(8 * steps)  # time values
+            take_rows = _binary_doubles(f, byteorder)
+        else:
+            numbers.take(steps)  # time values
+            take_rows = numbers.take_rows
+        for i, kind in enumerate(kinds):
+            n = ELEMENTS[kind][0]
+            for j, field in enumerate('SVT'):
+                count = counts[3 * i + j]
+                if count == 0:
+                    continue
+                c = COMPONENTS[field]
+                key = field + kind
+                builder = _StoreBuilder(
+                    os.path.join(directory, f'{name}_{key}'), name, key,
+                    n, c, steps)
+                for rows in take_rows(count, 3 * n + steps * n * c):
+                    # x1..xn y1..yn z1..zn
+                    coords = rows[:, :3 * n].reshape(-1, 3, n)
+                    builder.add_elements(coords.transpose(0, 2, 1),
+                                         rows[:, 3 * n:])
+                stores[f'{name}_{key}'] = builder.close()
+    return stores
+
+
+def _binary_doubles(f, byteorder='<'):
+    """take_rows of _Numbers, over the raw doubles of a binary file"""
+    dtype = np.dtype(byteorder + 'f8')
+
+    def take_rows(rows, width):
+        for start in range(0, rows, CHUNK):
+            k = min(CHUNK, rows - start)
+            data = f.read(k * width * dtype.itemsize)
+            if len(data) != k * width * dtype.itemsize:
+                raise ValueError('unexpected end of file')
+            yield np.frombuffer(data, dtype).reshape(k, width).astype(
+                np.float64)
+    return take_rows
+
+
+_PARSED = re.compile(r'\s*([STV])([A-Z]2?)\s*\(([^)]*)\)\s*\{([^}]*)\}')
+
+
+def _read_parsed(f, directory, first):
+    """Parsed 'View "name" { VS(...){...}; ... };' files"""
+    stores = {}
+    builders = {}
+    name = re.search(r'View\s+"([^"]*)"', first).group(1)
+    batch = {}
+
+    def flush(key):
+        coords, values = zip(*batch.pop(key))
+        b = builders[key]
+        b.add_elements(np.array(coords).reshape(len(coords), -1, 3),
+                       np.array(values))
+
+    for line in f:
+        m = _PARSED.match(line)
+        if m is None:
+            if line.lstrip().startswith('View'):
+                name = re.search(r'View\s+"([^"]*)"', line).group(1)
+            continue
+        field, kind, xyz, vals = m.groups()
+        key = field + kind
+        coords = np.array(xyz.replace(',', ' ').split(), dtype=float)
+        values = np.array(vals.replace(',', ' ').split(), dtype=float)
+        if key not in builders:
+            n = ELEMENTS[kind][0]
+            c = COMPONENTS[field]
+            steps = len(values) // (n * c)
+            builders[key] = _StoreBuilder(
+                os.path.join(directory, f'{name}_{key}'), name, key,
+                n, c, steps)
+        batch.setdefault(key, []).append((coords, values))
+        if len(batch[key]) == CHUNK:
+            flush(key)
+    for key in list(batch):
+        flush(key)
+    for key, builder in builders.items():
+        stores[f'{builder.meta["name"]}_{key}'] = builder.close()
+    return stores
+
+
+def _read_mesh(mesh_filename, directory):
+    """Nodes sorted by tag and element connectivity of a msh 4.1 ASCII file"""
+    nodes = _Writer(directory, 'mesh_nodes', np.float64, (3,))
+    tags = _Writer(directory, 'mesh_node_tags', np.int64, ())
+    elements = {}
+    with open(mesh_filename) as f:
+        for line in f:
+            if line.startswith('$MeshFormat'):
+                version = f.readline().split()[0]
+                if not version.startswith('4'):
+                    raise ValueError(f'{mesh_filename}: msh {version}, '
+                                     'only ASCII 4.x is supported')
+            elif line.startswith('$Nodes'):
+                numbers = _Numbers(f)
+                blocks = int(numbers.take(4)[0])
+                for _ in range(blocks):
+                    _, _, parametric, count = numbers.take(4).astype(int)
+                    if parametric:
+                        raise ValueError('parametric nodes are not supported')
+                    for rows in numbers.take_rows(count, 1):
+                        tags.write(rows[:, 0])
+                    for rows in numbers.take_rows(count, 3):
+                        nodes.write(rows)
+            elif line.startswith('$Elements'):
+                numbers = _Numbers(f)
+                blocks = int(numbers.take(4)[0])
+                for _ in range(blocks):
+                    _, _, etype, count = numbers.take(4).astype(int)
+                    n = GMSH_NODES.get(etype)
+                    if n is None:
+                        raise ValueError(f'unknown element type {etype}')
+                    if etype not in elements:
+                        elements[etype] = _Writer(
+                            directory, f'mesh_elements_{etype}', np.int64,
+                            (n + 1,))
+                    for rows in numbers.take_rows(count, n + 1):
+                        elements[etype].write(rows)
+    info = {'nodes': nodes.close(), 'tags': tags.close()}
+    info['elements'] = {t: w.close() for t, w in elements.items()}
+
+    def open_raw(name, meta):
+        return np.memmap(os.path.join(directory, name + '.bin'),
+                         dtype=meta['dtype'], mode='r+',
+                         shape=tuple(meta['shape']))
+
+    node_tags = open_raw('mesh_node_tags', info['tags'])
+    order = np.argsort(node_tags, kind='stable')
+    mesh = {
+        'node_tags': np.asarray(node_tags)[order],
+        'nodes': open_raw('mesh_nodes', info['nodes']),
+        'node_order': order,
+        'elements': {},
+    }
+    for etype, meta in info['elements'].items():
+        table = open_raw(f'mesh_elements_{etype}', meta)
+        order = np.argsort(table[:, 0], kind='stable')
+        mesh['elements'][etype] = (table, order, np.asarray(table[order, 0]))
+    return mesh
+
+
+def _read_mesh_based(f, directory, mesh_filename):
+    """
+    $ElementNodeData views referring to the elements of a .msh file,
+    ASCII or binary (GetDP -bin); f is opened in binary mode and
+    positioned after the $MeshFormat line
+    """
+    if mesh_filename is None:
+        raise ValueError('mesh-based .pos files need the .msh file')
+    _, file_type, _ = f.readline().split()[:3]
+    binary = int(file_type) == 1
+    byteorder = '<'
+    if binary:
+        one = f.read(4)
+        f.readline()
+        if np.frombuffer(one, '<i4')[0] != 1:
+            byteorder = '>'
+    mesh = _read_mesh(mesh_filename, directory)
+    elements = mesh['elements']
+    stores = {}
+    builders = {}
+    for line in f:
+        if not line.startswith(b'$ElementNodeData'):
+            continue
+        strings = [f.readline().strip().strip(b'"').decode()
+                   for _ in range(int(f.readline()))]
+        for _ in range(int(f.readline())):
+            f.readline()
+        ints = [int(f.readline()) for _ in range(int(f.readline()))]
+        name = strings[0] if strings else 'view'
+        step, n_comp, count = ints[:3]
+        if binary:
+            blocks = _binary_rows(f, count, n_comp, byteorder)
+        else:
+            blocks = _element_node_rows(_Numbers(f), count, n_comp)
+        key = None
+        for rows in blocks:
+            tags_ = rows[:, 0].astype(np.int64)
+            n = int(rows[0, 1])
+            if key is None:
+                etype, table, order, sorted_tags = _find_type(
+                    elements, tags_[0], n)
+                kind = FIELDS[n_comp] + GMSH_KINDS[etype]
+                key = f'{name}_{kind}'
+                if key not in builders:
+                    builders[key] = _StoreBuilder(
+                        os.path.join(directory, key), name, kind,
+                        n, n_comp, 1)
+            b = builders[key]
+            values = rows[:, 2:]
+            if step == 0:
+                conn = table[order[np.searchsorted(sorted_tags, tags_)], 1:]
+                idx = np.searchsorted(mesh['node_tags'], conn)
+                b.writer('element_tags', np.int64, ()).write(tags_)
+                b.writer('connectivity', np.int64, (n,)).write(
+                    mesh['node_order'][idx])
+                b.add_values(values)
+            else:
+                # harmonic results: time step 1 is the imaginary part
+                b.writer('values_im', np.float64, (n, n_comp)).write(values)
+    for b in builders.values():
+        if 'values_im' in b.writers:
+            _merge_imaginary(b)
+    for key, b in builders.items():
+        nodes = b.writer('nodes', np.float64, (3,))
+        for start in range(0, len(mesh['nodes']), CHUNK):
+            nodes.write(mesh['nodes'][start:start + CHUNK])
+        stores[key] = b.close()
+    for name in os.listdir(directory):
+        if name.startswith('mesh_'):
+            os.remove(os.path.join(directory, name))
+    return stores
+
+
+def _element_node_rows(numbers, count, n_comp):
+    """Rows 'tag n v...' of equal length n, in blocks"""
+    done = 0
+    while done < count:
+        head = numbers.take(2)
+        n = int(head[1])
+        width = 2 + n * n_comp
+        k = min(CHUNK, count - done)
+        rest = numbers.take(k * width - 2)
+        rows = np.concatenate([head, rest]).reshape(k, width)
+        if np.any(rows[:, 1] != n):
+            raise ValueError('mixed element kinds in one view')
+        done += k
+        yield rows
+
+
+def _binary_rows(f, count, n_comp, byteorder='<'):
+    """
+    Binary records (int tag, int n, n * n_comp doubles) as the rows of
+    _element_node_rows, in blocks
+    """
+    done = 0
+    while done < count:
+        head = f.read(8)
+        n = int(np.frombuffer(head, byteorder + 'i4')[1])
+        record = np.dtype([('tag', byteorder + 'i4'),
+                           ('n', byteorder + 'i4'),
+                           ('v', byteorder + 'f8', (n * n_comp,))])
+        k = min(CHUNK, count - done)
+        data = head + f.read(k * record.itemsize - 8)
+        if len(data) != k * record.itemsize:
+            raise ValueError('unexpected end of file')
+        records = np.frombuffer(data, record)
+        if np.any(records['n'] != n):
+            raise ValueError('mixed element kinds in one view')
+        done += k
+        yield np.concatenate([records['tag'][:, None],
+                              records['n'][:, None],
+                              records['v']], axis=1).astype(np.float64)
+
+
+def _find_type(elements, tag, n):
+    for etype, (table, order, sorted_tags) in elements.items():
+        if GMSH_NODES[etype] != n:
+            continue
+        i = np.searchsorted(sorted_tags, tag)
+        if i < len(sorted_tags) and sorted_tags[i] == tag:
+            return etype, table, order, sorted_tags
+    raise ValueError(f'element {tag} not found in mesh')
+
+
+def _merge_imaginary(builder):
+    """Fold the values_im rows into the complex values, chunk by chunk"""
+    real = builder.writers['values']
+    imag = builder.writers.pop('values_im')
+    real.file.flush()
+    imag.close()
+    shape = (builder.n_nodes, builder.n_comp)
+    values = np.memmap(real.filename, dtype=np.complex128, mode='r+',
+                       shape=(real.rows,) + shape)
+    parts = np.memmap(imag.filename, dtype=np.float64, mode='r',
+                      shape=(imag.rows,) + shape)
+    for start in range(0, min(real.rows, imag.rows), CHUNK):
+        values[start:start + CHUNK] += 1j * parts[start:start + CHUNK]
+    values.flush()
+    del values, parts
+    os.remove(imag.filename)
+
+
+def convert(pos_filename, directory=None, mesh_filename=None):
+    """
+    Convert a GetDP .pos file into memory-mapped stores, one per view
+    and element kind, returned as a dict of FieldStore. Legacy and
+    mesh-based files may be ASCII or binary; mesh-based files need the
+    .msh file they refer to.
+    """
+    if directory is None:
+        directory = pos_filename + '.store'
+    os.makedirs(directory, exist_ok=True)
+    with open(pos_filename, 'rb') as f:
+        first = f.readline()
+        while first and not first.strip():
+            first = f.readline()
+        if first.startswith(b'$MeshFormat'):
+            return _read_mesh_based(f, directory, mesh_filename)
+        if first.startswith(b'$PostFormat'):
+            return _read_legacy(f, directory)
+    with open(pos_filename) as f:
+        first = f.readline()
+        while first and not first.strip():
+            first = f.readline()
+        if first.lstrip().startswith('View'):
+            return _read_parsed(f, directory, first)
+    raise ValueError(f'{pos_filename}: unknown post-processing format')
+
+
+def open_stores(directory):
+    """FieldStores previously written by convert"""
+    return {name: FieldStore(os.path.join(directory, name))
+            for name in sorted(os.listdir(directory))
+            if os.path.isfile(os.path.join(directory, name, 'meta.json'))}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Convert GetDP .pos output to memory-mapped arrays')
+    parser.add_argument('pos', nargs='+')
+    parser.add_argument('-m', '--mesh', default=None,
+                        help='.msh file for mesh-based .pos files')
+    args = parser.parse_args(argv)
+    for filename in args.pos:
+        for name, store in convert(filename, mesh_filename=args.mesh).items():
+            print(f'{filename}: {name} {len(store)} elements '
+                  f'-> {store.directory}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,208 @@
+from contextlib import contextmanager
+import cProfile
+import datetime
+import json
+import os
+import resource
+import sys
+import time
+
+
+_active = []
+_reset_peak = 0.0  # peak RSS in MiB before the last VmHWM reset
+
+
+def _peak_rss():
+    """
+    Lifetime peak resident set size in MiB of this process and of its
+    largest waited for child, cumulative since the process started
+    """
+    scale = 1.0 / 1024.0 if sys.platform != 'darwin' else 1.0 / 1024.0 ** 2
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale
+    return max(own, _reset_peak), children
+
+
+def _reset_peak_rss():
+    """
+    Restart the Linux peak RSS (VmHWM) from the current RSS, if allowed;
+    ru_maxrss restarts with it, so the peak so far is kept for _peak_rss
+    """
+    global _reset_peak
+    _reset_peak = _peak_rss()[0]
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        return False
+    return True
+
+
+def _stage_peak_rss():
+    """Peak RSS in MiB since the last _reset_peak_rss, None if unknown"""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024.0
+    except OSError:
+        pass
+    return None
+
+
+def dof_count(order, edges, faces):
+    """Unknowns of the hierarchical Hcurl space of order (mstrip.BASIS)"""
+    return edges if order == 1 else 2 * edges + 2 * faces
+
+
+def mesh_counts(order=1):
+    """
+    Node, element, edge and face counts of the current gmsh mesh, and
+    dofs, the size of the e system of the given edge element order
+    before constraints: one per edge at order 1, two per edge and two
+    per face at order 2.
+    """
+    from gmsh import model
+    from gmsh import option
+
+    counts = {
+        'nodes': int(option.get_number('Mesh.NbNodes')),
+        'triangles': int(option.get_number('Mesh.NbTriangles')),
+        'tetrahedra': int(option.get_number('Mesh.NbTetrahedra')),
+    }
+    if counts['tetrahedra']:
+        model.mesh.create_edges()
+        model.mesh.create_faces()
+        counts['edges'] = len(model.mesh.get_all_edges()[0])
+        counts['faces'] = len(model.mesh.get_all_faces(3)[0])
+        counts['dofs'] = dof_count(order, counts['edges'], counts['faces'])
+    return counts
+
+
+def _sizes(paths):
+    """Byte sizes of the files, and of the files inside directories"""
+    sizes = {}
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, names in os.walk(path):
+                for name in names:
+                    f = os.path.join(root, name)
+                    sizes[f] = os.path.getsize(f)
+        elif os.path.isfile(path):
+            sizes[path] = os.path.getsize(path)
+    return sizes
+
+
+class Profiler(object):
+    '''
+    Wall time, peak RSS, mesh counts and output sizes per pipeline stage
+
+    Used as a context manager around a run, it becomes the target of
+    the module level stage() calls made by the pipeline and writes a
+    JSON report on exit. With cprofile set, the whole run is also
+    recorded by cProfile and dumped to that file. Mesh counts report
+    the dofs of edge elements of order.
+
+    peak_rss_mb is the peak RSS of this process within the stage, where
+    Linux lets it be reset (None otherwise); process_peak_rss_mb and
+    process_peak_rss_children_mb are the cumulative lifetime peaks.
+    '''
+
+    def __init__(self, filename=None, cprofile=None, order=1):
+        super().__init__()
+        self.filename = filename
+        self.cprofile = cprofile
+        self.order = order
+        self.stages = []
+        self.started = None
+        self._t0 = None
+        self._profile = None
+        self._peaks = []  # running peak RSS of the open stages
+
+    def __enter__(self):
+        self.started = datetime.datetime.now().isoformat(timespec='seconds')
+        self._t0 = time.perf_counter()
+        if self.cprofile is not None:
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+        _active.append(self)
+        return self
+
+    def __exit__(self, *exc):
+        _active.remove(self)
+        if self._profile is not None:
+            self._profile.disable()
+            self._profile.dump_stats(self.cprofile)
+        if self.filename is not None:
+            self.write(self.filename)
+        return False
+
+    @contextmanager
+    def stage(self, name, files=(), counts=False):
+        """
+        Time the body; counts adds mesh_counts(), files the sizes of
+        files or directories written by it. Stages may nest, the peak
+        of an inner stage counts towards the enclosing ones.
+        """
+        record = {'name': name}
+        self._fold_peak(_stage_peak_rss())
+        reset = _reset_peak_rss()
+        self._peaks.append(None)
+        t0 = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record['wall'] = time.perf_counter() - t0
+            peak = self._peaks.pop()
+            if reset:
+                now = _stage_peak_rss()
+                peak = now if peak is None or now is None else max(peak, now)
+                self._fold_peak(peak)
+            else:
+                peak = None
+            own, children = _peak_rss()
+            record['peak_rss_mb'] = peak
+            record['process_peak_rss_mb'] = own
+            record['process_peak_rss_children_mb'] = children
+            if counts:
+                record.update(mesh_counts(self.order))
+            sizes = _sizes(files)
+            if sizes:
+                record['files'] = sizes
+            self.stages.append(record)
+
+    def _fold_peak(self, peak):
+        """Raise the running peak of the innermost open stage to peak"""
+        if self._peaks and peak is not None:
+            last = self._peaks[-1]
+            self._peaks[-1] = peak if last is None else max(last, peak)
+
+    def report(self):
+        total = {}
+        for record in self.stages:
+            total[record['name']] = total.get(record['name'], 0.0) + \
+                record['wall']
+        return {
+            'started': self.started,
+            'argv': sys.argv,
+            'wall': time.perf_counter() - self._t0,
+            'stages': self.stages,
+            'totals': total,
+        }
+
+    def write(self, filename):
+        directory = os.path.dirname(filename)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(filename, 'w') as f:
+            json.dump(self.report(), f, indent=1)
+
+
+@contextmanager
+def stage(name, files=(), counts=False):
+    """Profiler.stage of the innermost active Profiler, a no-op without one"""
+    if not _active:
+        yield None
+        return
+    with _active[-1].stage(name, files, counts) as record:
+        yield record
@@ -0,0 +1,306 @@
+from sweep import COLUMNS, MSPA_PARAMS, ONELAB_PARAMS
+import argparse
+import csv
+import json
+import numpy as np
+import sys
+import time
+
+
+# design parameters and frequency, every one of them indexed
+KEYS = tuple(ONELAB_PARAMS) + tuple(MSPA_PARAMS)
+DIGITS = 9  # keys are rounded so reruns of a point find it again
+TEXT = ('error', 'host')
+FLOAT = ('s11', 'directivity', 'wall', 'mesh_time', 'solve_time', 'started')
+
+
+def _bisect(values, x, side):
+    """searchsorted on a sorted 1D dataset, reading log2(n) elements"""
+    lo, hi = 0, len(values)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        v = values[mid]
+        if v < x or (side == 'right' and v == x):
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+
+class ResultStore(object):
+    '''
+    Sweep results in an HDF5 file, one row per solved point
+
+    Columns are resizable datasets under /rows: the design parameters
+    and frequency (KEYS), y, s11, peak directivity, timings, host and
+    error. Far-field patterns (dBi on the theta x phi grid) go to
+    /far_field, NaN for rows without one. For each key /index holds the
+    row numbers sorted by that key and the sorted values, so a query
+    bisects the index of its most selective condition and reads only
+    the candidate rows. Rows appended with reindex=False stay out of
+    the index until reindex(), queries scan them directly meanwhile.
+
+    A config (JSON-able dict of what the results depend on besides the
+    keys, see sweep.configuration) is recorded by the first writer, and
+    opening the store with a different one raises ValueError, so rows
+    solved under other settings are never read back as matches.
+    '''
+
+    def __init__(self, filename, mode='a', config=None):
+        import h5py
+
+        super().__init__()
+        self.filename = filename
+        self.file = h5py.File(filename, mode)
+        if 'rows' not in self.file and mode != 'r':
+            self._create()
+        if config is not None:
+            self._check_config(config)
+
+    def _check_config(self, config):
+        text = json.dumps(config, sort_keys=True)
+        stored = self.file.attrs.get('config')
+        if stored is None:
+            if len(self):
+                raise ValueError(f'{self.filename} has no recorded '
+                                 f'configuration, cannot resume into it')
+            self.file.attrs['config'] = text
+        elif json.loads(stored) != json.loads(text):
+            raise ValueError(f'{self.filename} holds results of {stored}, '
+                             f'not {text}')
+
+    def _create(self):
+        import h5py
+
+        rows = self.file.create_group('rows')
+        text = h5py.string_dtype()
+        for name in KEYS + FLOAT:
+            rows.create_dataset(name, (0,), 'f8', maxshape=(None,),
+                                chunks=True)
+        rows.create_dataset('y', (0,), 'c16', maxshape=(None,), chunks=True)
+        for name in TEXT:
+            rows.create_dataset(name, (0,), text, maxshape=(None,),
+                                chunks=True)
+        index = self.file.create_group('index')
+        for name in KEYS:
+            index.create_dataset(f'{name}_rows', (0,), 'i8',
+                                 maxshape=(None,), chunks=True)
+            index.create_dataset(f'{name}_values', (0,), 'f8',
+                                 maxshape=(None,), chunks=True)
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return len(self.file['rows/y'])
+
+    @staticmethod
+    def key(point):
+        return tuple(round(float(point[k]), DIGITS) for k in KEYS)
+
+    def append(self, rows, patterns=None, grid=None, reindex=True):
+        """
+        Add rows (sweep.evaluate dicts with every key set), patterns
+        (n, T, Q) dBi on grid = (theta, phi), and reindex unless told
+        not to (when appending row by row, call reindex() at the end)
+        """
+        if not rows:
+            return
+        n0 = len(self)
+        n = n0 + len(rows)
+        data = self.file['rows']
+        for name in data:
+            data[name].resize((n,))
+        for name in KEYS:
+            data[name][n0:] = [round(float(r[name]), DIGITS) for r in rows]
+        for name in FLOAT:
+            data[name][n0:] = [float(r[name]) if r.get(name, '') != ''
+                               else np.nan for r in rows]
+        data['y'][n0:] = [complex(r['y_re'], r['y_im'])
+                          if r.get('y_re', '') != '' else np.nan
+                          for r in rows]
+        for name in TEXT:
+            data[name][n0:] = [str(r.get(name, '')) for r in rows]
+        if patterns is not None:
+            self._append_patterns(n0, patterns, grid)
+        elif 'far_field' in self.file:
+            self.file['far_field'].resize(n, axis=0)
+            self.file['far_field'][n0:] = np.nan
+        if reindex:
+            self.reindex()
+        self.file.flush()
+
+    def _append_patterns(self, n0, patterns, grid):
+        patterns = np.asarray(patterns, dtype='f4')
+        n = n0 + len(patterns)
+        if 'far_field' not in self.file:
+            ff = self.file.create_dataset(
+                'far_field', (n0,) + patterns.shape[1:], 'f4',
+                maxshape=(None,) + patterns.shape[1:], chunks=True,
+                fillvalue=np.nan)
+            ff.attrs['theta'], ff.attrs['phi'] = grid
+        ff = self.file['far_field']
+        if ff.shape[1:] != patterns.shape[1:]:
+            raise ValueError(f'{self.filename}: far field grid '
+                             f'{ff.shape[1:]}, got {patterns.shape[1:]}')
+        ff.resize(n, axis=0)
+        ff[n0:] = patterns
+
+    def reindex(self):
+        """Sort the rows appended since the last reindex into the index"""
+        if self.indexed() == len(self):
+            return
+        for name in KEYS:
+            values = self.file[f'rows/{name}'][:]
+            order = np.argsort(values, kind='stable')
+            for suffix, data in (('rows', order), ('values', values[order])):
+                d = self.file[f'index/{name}_{suffix}']
+                d.resize((len(data),))
+                d[:] = data
+        self.file['index'].attrs['rows'] = len(self)
+
+    def indexed(self):
+        """Number of leading rows covered by the index"""
+        index = self.file['index']
+        return int(index.attrs.get('rows', len(index[f'{KEYS[0]}_rows'])))
+
+    def _candidates(self, name, condition):
+        lo, hi = condition if isinstance(condition, tuple) \
+            else (condition, condition)
+        values = self.file[f'index/{name}_values']
+        start = _bisect(values, round(lo, DIGITS), 'left')
+        end = _bisect(values, round(hi, DIGITS), 'right')
+        return start, end
+
+    def query(self, **conditions):
+        """
+        Row numbers matching every condition, a value or an inclusive
+        (lo, hi) range per key, e.g. query(epr=1.05, d_feed=(0.1, 0.14))
+        """
+        for name in conditions:
+            if name not in KEYS:
+                raise ValueError(f'{name} is not indexed, keys are {KEYS}')
+        if not conditions:
+            return np.arange(len(self))
+        spans = {name: self._candidates(name, c)
+                 for name, c in conditions.items()}
+        best = min(spans, key=lambda name: spans[name][1] - spans[name][0])
+        start, end = spans[best]
+        rows = np.sort(self.file[f'index/{best}_rows'][start:end])
+        rows = self._select(rows, conditions, skip=best)
+        n = self.indexed()
+        if n < len(self):
+            tail = self._select(np.arange(n, len(self)), conditions)
+            rows = np.concatenate([rows, tail])
+        return rows
+
+    def _select(self, rows, conditions, skip=None):
+        for name, condition in conditions.items():
+            if name == skip or not len(rows):
+                continue
+            lo, hi = condition if isinstance(condition, tuple) \
+                else (condition, condition)
+            values = self.file[f'rows/{name}'][rows]
+            rows = rows[(values >= round(lo, DIGITS)) &
+                        (values <= round(hi, DIGITS))]
+        return rows
+
+    def get(self, rows):
+        """Records (dicts) of the given row numbers"""
+        rows = np.sort(np.asarray(rows, dtype=int))
+        if not len(rows):
+            return []
+        data = self.file['rows']
+        columns = {name: data[name][rows] for name in data}
+        records = []
+        for i, row in enumerate(rows):
+            record = {'row': int(row)}
+            for name, values in columns.items():
+                v = values[i]
+                if name in TEXT:
+                    v = v.decode() if isinstance(v, bytes) else str(v)
+                elif name == 'y':
+                    v = complex(v)
+                else:
+                    v = float(v)
+                record[name] = v
+            records.append(record)
+        return records
+
+    def pattern(self, row):
+        """Far-field pattern (T, Q) of a row and its (theta, phi) grid"""
+        ff = self.file['far_field']
+        return ff[row], (ff.attrs['theta'], ff.attrs['phi'])
+
+    def find(self, point):
+        """Row number of an error free result at point, None if absent"""
+        key = dict(zip(KEYS, self.key(point)))
+        rows = self.query(**key)
+        if len(rows):
+            errors = self.file['rows/error'][np.sort(rows)]
+            for row, error in zip(np.sort(rows), errors):
+                if not error:
+                    return int(row)
+        return None
+
+
+def to_sweep_row(record, index):
+    """Store record -> sweep.run row (COLUMNS)"""
+    row = dict.fromkeys(COLUMNS, '')
+    row.update({k: v for k, v in record.items() if k in COLUMNS})
+    row['index'] = index
+    row['y_re'] = record['y'].real
+    row['y_im'] = record['y'].imag
+    return row
+
+
+def parse_condition(text):
+    """'name=value' or 'name=lo:hi'"""
+    name, _, value = text.partition('=')
+    if ':' in value:
+        lo, hi = (float(v) for v in value.split(':'))
+        return name, (lo, hi)
+    return name, float(value)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Query an HDF5 sweep result store')
+    parser.add_argument('store')
+    parser.add_argument('-w', '--where', action='append', default=[],
+                        metavar='NAME=VALUE|NAME=LO:HI',
+                        help=f'condition on one of {", ".join(KEYS)}')
+    parser.add_argument('-o', '--output', default=None,
+                        help='write the matches as CSV instead of printing')
+    args = parser.parse_args(argv)
+
+    conditions = dict(parse_condition(w) for w in args.where)
+    with ResultStore(args.store, 'r') as store:
+        t0 = time.perf_counter()
+        rows = store.query(**conditions)
+        records = store.get(rows)
+        dt = time.perf_counter() - t0
+        total = len(store)
+    columns = ['row'] + list(KEYS) + ['y', 's11', 'directivity', 'error']
+    if args.output is not None:
+        with open(args.output, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=columns,
+                                    extrasaction='ignore')
+            writer.writeheader()
+            writer.writerows(records)
+    else:
+        for r in records:
+            print(' '.join(f'{k}={r[k]}' for k in columns))
+    print(f'{len(records)} of {total} rows in {1e3 * dt:.1f} ms',
+          file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,84 @@
+import json
+import re
+
+
+# PETSc options of each linear solver strategy for the complex symmetric,
+# indefinite curl-curl system. The PML makes it non-Hermitian, so the
+# Krylov methods are GMRES and BiCGStab(l), preconditioned by
+# incomplete factorizations that need a fraction of the LU memory.
+SOLVERS = {
+    # getdp's own factorization, MUMPS under MPI (mpi_solve)
+    'direct': [],
+    'mumps': ['-ksp_type', 'preonly', '-pc_type', 'lu',
+              '-pc_factor_mat_solver_type', 'mumps'],
+    # ILU(2) on each rank's block
+    'gmres-ilu': ['-ksp_type', 'gmres', '-ksp_gmres_restart', '200',
+                  '-pc_type', 'bjacobi', '-sub_pc_type', 'ilu',
+                  '-sub_pc_factor_levels', '2'],
+    'bcgs-ilu': ['-ksp_type', 'bcgsl', '-ksp_bcgsl_ell', '4',
+                 '-pc_type', 'bjacobi', '-sub_pc_type', 'ilu',
+                 '-sub_pc_factor_levels', '2'],
+    # overlapping Schwarz blocks carry the waves across rank boundaries
+    'gmres-asm': ['-ksp_type', 'gmres', '-ksp_gmres_restart', '200',
+                  '-pc_type', 'asm', '-pc_asm_overlap', '2',
+                  '-sub_pc_type', 'ilu', '-sub_pc_factor_levels', '1'],
+}
+TOLERANCES = ['-ksp_rtol', '1e-8', '-ksp_max_it', '3000']
+MONITOR = ['-ksp_monitor', '-ksp_converged_reason']
+LOG = 'build/solver.log'
+RECORD = 'build/solver.json'
+
+_RESIDUAL = re.compile(r'^\s*(\d+) KSP Residual norm (\S+)', re.M)
+_REASON = re.compile(
+    r'Linear solve (converged|did not converge) due to (\w+) '
+    r'iterations (\d+)')
+
+
+def options(solver):
+    """PETSc options of a SOLVERS strategy, with tolerances and monitor"""
+    if solver not in SOLVERS:
+        raise ValueError(f'unknown solver {solver}, '
+                         f'expected one of {", ".join(SOLVERS)}')
+    if solver in ('direct', 'mumps'):
+        return list(SOLVERS[solver])
+    return SOLVERS[solver] + TOLERANCES + MONITOR
+
+
+def convergence(text):
+    """
+    Residual history of every Krylov solve in getdp's output, one dict
+    per solve with its residuals, iterations and PETSc's reason
+    """
+    solves = []
+    for line in text.splitlines():
+        m = _RESIDUAL.match(line)
+        if m is not None:
+            if int(m.group(1)) == 0 or not solves or \
+                    'reason' in solves[-1]:
+                solves.append({'residuals': []})
+            solves[-1]['residuals'].append(float(m.group(2)))
+            continue
+        m = _REASON.search(line)
+        if m is not None:
+            if not solves or 'reason' in solves[-1]:
+                solves.append({'residuals': []})
+            solves[-1].update(converged=m.group(1) == 'converged',
+                              reason=m.group(2),
+                              iterations=int(m.group(3)))
+    for s in solves:
+        s.setdefault('iterations', max(len(s['residuals']) - 1, 0))
+    return solves
+
+
+def record(solver, text, filename=RECORD):
+    """Write and return the solver settings and convergence of a run"""
+    result = {
+        'solver': solver,
+        'options': options(solver),
+        'solves': convergence(text),
+    }
+    result['converged'] = all(s.get('converged', True)
+                              for s in result['solves'])
+    with open(filename, 'w') as f:
+        json.dump(result, f, indent=1)
+    return result
@@ -0,0 +1,458 @@
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, \
+    as_completed, wait
+import argparse
+import csv
+import itertools
+import multiprocessing
+import numpy as np
+import os
+import platform
+import shutil
+import sys
+import time
+import traceback
+
+
+ONELAB_PARAMS = {
+    'frequency': 'Model/Frequency',
+    'epr': 'Model/epr',
+}
+MSPA_PARAMS = ('d_feed', 'r_cut', 'patch_size')
+COLUMNS = ['index'] + list(ONELAB_PARAMS) + list(MSPA_PARAMS) + \
+    ['s11', 'y_re', 'y_im', 'directivity', 'started', 'wall', 'mesh_time',
+     'solve_time', 'host', 'error']
+SOURCE_DIR = os.path.dirname(os.path.abspath(__file__))
+SOLVER = 'direct'  # solvers.SOLVERS strategy of every point
+
+
+def make_grid(**axes):
+    """
+    Cartesian product of parameter axes as a list of dicts,
+    e.g. make_grid(frequency=[136.0, 137.0], d_feed=[0.10, 0.12])
+    """
+    for name in axes:
+        if name not in ONELAB_PARAMS and name not in MSPA_PARAMS:
+            raise ValueError(f'unknown sweep parameter: {name}')
+    names = list(axes)
+    return [dict(zip(names, values))
+            for values in itertools.product(*axes.values())]
+
+
+def defaults():
+    """Value of every sweep parameter when a point leaves it out"""
+    import mstrip
+
+    antenna = mstrip.Mspa(mstrip.MODEL_NAME, lazy=True)
+    values = {'frequency': mstrip.FREQUENCY, 'epr': mstrip.EPR}
+    values.update({name: getattr(antenna, name) for name in MSPA_PARAMS})
+    return values
+
+
+def configuration(design_frequency, order=1, far_field=False):
+    """
+    What a point's results depend on besides its parameters: the
+    domain, basis order, mesh settings, solver and far field output.
+    A result store only resumes a sweep of the same configuration.
+    """
+    import mstrip
+
+    antenna = mstrip.Mspa(mstrip.MODEL_NAME, lazy=True)
+    return {
+        'design_frequency': design_frequency,
+        'air_fraction': antenna.air_fraction,
+        'pml_fraction': antenna.pml_fraction,
+        'order': order,
+        'mesh_settings': mstrip.order_mesh_settings(antenna.mesh_settings,
+                                                    order),
+        'solver': SOLVER,
+        'far_field': far_field,
+    }
+
+
+def _stage(stages, *names):
+    return sum(s['wall'] for s in stages if s['name'] in names)
+
+
+def parse_values(text):
+    """'a,b,c' or inclusive range 'start:stop:step'"""
+    if ':' in text:
+        start, stop, step = (float(v) for v in text.split(':'))
+        n = int(round((stop - start) / step)) + 1
+        return list(start + step * np.arange(n))
+    return [float(v) for v in text.split(',')]
+
+
+def _init_worker():
+    # one getdp per core, don't let BLAS/OpenMP oversubscribe the node
+    os.environ.setdefault('OMP_NUM_THREADS', '1')
+    os.environ.setdefault('OPENBLAS_NUM_THREADS', '1')
+
+
+def _enter(index, root):
+    build_dir = os.path.join(os.path.abspath(root), f'point_{index:05d}')
+    os.makedirs(build_dir, exist_ok=True)
+    shutil.copy(os.path.join(SOURCE_DIR, 'defines.pro'), build_dir)
+    os.chdir(build_dir)
+
+
+def _set_params(point):
+    from gmsh import onelab
+    import mstrip
+
+    mstrip.setup_onelab()
+    for name, value in point.items():
+        if name in ONELAB_PARAMS:
+            onelab.set_number(ONELAB_PARAMS[name], [value])
+
+
+def _problem(point, design_frequency, order, far_field):
+    """Mspa of a point, meshed for order, and its problem"""
+    import mstrip
+    import profiling
+
+    antenna = mstrip.Mspa(mstrip.MODEL_NAME, lazy=True,
+                          frequency=design_frequency or
+                          point.get('frequency', mstrip.FREQUENCY))
+    antenna.update(**{name: value for name, value in point.items()
+                      if name in MSPA_PARAMS})
+    antenna.mesh_settings = mstrip.order_mesh_settings(
+        antenna.mesh_settings, order)
+
+    antenna.build()
+    with profiling.stage('problem'):
+        pro = mstrip.create_problem(
+            antenna, output='far_field' if far_field else 's11',
+            order=order, solver=SOLVER)
+    return antenna, pro
+
+
+def _results(row, far_field):
+    """Port quantities and, for far_field, the pattern of a solved point"""
+    from gmsh import onelab
+    import mstrip
+    import profiling
+
+    row['s11'] = onelab.get_number('s11')[0]
+    _, y = mstrip.read_frequency_table('./build/y.txt')
+    row['y_re'] = y.real
+    row['y_im'] = y.imag
+    if far_field:
+        k0 = onelab.get_number('Model/WaveNumber')[0]
+        with profiling.stage('far_field'):
+            theta, phi, d = mstrip.setup_far_field(k0)
+        row['directivity'] = float(d.max())
+        row['pattern'] = (theta, phi, d)
+
+
+def evaluate(index, point, root, cache_dir=None, ranks=1, far_field=False,
+             design_frequency=None, order=1):
+    """
+    Solve one sweep point in its own build directory.
+    Runs in a worker process, so gmsh state is private to it.
+    Meshes are shared between workers through the mesh cache,
+    so points differing only in frequency or epr skip meshing.
+    ranks > 1 solves each point with that many MPI processes.
+    Stage timings go to profile.json in the build directory.
+    far_field adds the peak directivity and, under 'pattern', the
+    (theta, phi, dBi) pattern. Only the port quantities and, for
+    far_field, the near field sphere are written, no volume fields.
+    The air and PML spheres are sized for design_frequency (MHz), the
+    highest of the sweep, so every point meshes the same domain.
+    order is the edge element order, its mesh coarsened to match.
+    """
+    _enter(index, root)
+
+    from mesh_cache import MeshCache
+    import gmsh
+    import mstrip
+    import profiling
+
+    row = dict.fromkeys(COLUMNS, '')
+    row['index'] = index
+    row.update(point)
+    row['host'] = platform.node()
+    row['started'] = time.time()
+    profiler = profiling.Profiler('profile.json', order=order)
+    try:
+        with profiler:
+            _set_params(point)
+            antenna, pro = _problem(point, design_frequency, order,
+                                    far_field)
+            cache = MeshCache(cache_dir) if cache_dir is not False else None
+            mstrip.solve(pro, antenna, cache, ranks)
+            _results(row, far_field)
+    except Exception:
+        row['error'] = traceback.format_exc(limit=1).strip().splitlines()[-1]
+    finally:
+        gmsh.finalize()
+    row['wall'] = time.time() - row['started']
+    row['mesh_time'] = _stage(profiler.stages, 'mesh_generate', 'mesh_merge')
+    row['solve_time'] = _stage(profiler.stages, 'solve')
+    return row
+
+
+def mesh_point(index, point, root, cache_dir=None, ranks=1, far_field=False,
+               design_frequency=None, order=1):
+    """
+    Producer half of evaluate: build the point's Mspa and write its
+    .pro and (partitioned, for ranks > 1) mesh to its build directory,
+    for solve_point. Stage timings go to mesh_profile.json there.
+    Returns the row so far, with mesh_time and the wall time in 'wall'.
+    """
+    _enter(index, root)
+
+    from mesh_cache import MeshCache
+    import gmsh
+    import mpi_solve
+    import mstrip
+    import profiling
+
+    row = dict.fromkeys(COLUMNS, '')
+    row['index'] = index
+    row.update(point)
+    row['host'] = platform.node()
+    row['started'] = time.time()
+    profiler = profiling.Profiler('mesh_profile.json', order=order)
+    try:
+        with profiler:
+            _set_params(point)
+            antenna, pro = _problem(point, design_frequency, order,
+                                    far_field)
+            with profiling.stage('write_pro', [pro.filename]):
+                pro.make_file()
+                pro.write_file()
+            cache = MeshCache(cache_dir) if cache_dir is not False else None
+            filename = f'{mstrip.MODEL_NAME}.msh'
+            antenna.mesh(filename, cache)
+            if ranks > 1:
+                mpi_solve.partition(filename, ranks)
+    except Exception:
+        row['error'] = traceback.format_exc(limit=1).strip().splitlines()[-1]
+    finally:
+        gmsh.finalize()
+    row['wall'] = time.time() - row['started']
+    row['mesh_time'] = _stage(profiler.stages, 'mesh_generate', 'mesh_merge')
+    return row
+
+
+def solve_point(row, root, ranks=1, far_field=False):
+    """
+    Consumer half of evaluate: solve the point mesh_point prepared,
+    with ranks MPI processes when ranks > 1, by running getdp directly
+    so no geometry is built. Stage timings go to profile.json.
+    Returns the completed row, 'wall' the meshing plus solving time.
+    """
+    _enter(row['index'], root)
+
+    import gmsh
+    import mpi_solve
+    import mstrip
+    import pipeline
+    import profiling
+
+    row = dict(row)
+    t0 = time.time()
+    profiler = profiling.Profiler('profile.json')
+    try:
+        with profiler:
+            _set_params({name: row[name] for name in ONELAB_PARAMS})
+            name = mstrip.MODEL_NAME
+            with profiling.stage('solve', ['build', f'{name}.res']):
+                pipeline.getdp(name, ['-solve', 'Analysis',
+                                      '-pos', 'Microwave_e'], ranks)
+                mpi_solve.set_results()
+            _results(row, far_field)
+    except Exception:
+        row['error'] = traceback.format_exc(limit=1).strip().splitlines()[-1]
+    finally:
+        gmsh.finalize()
+    row['wall'] += time.time() - t0
+    row['solve_time'] = _stage(profiler.stages, 'solve')
+    return row
+
+
+def _overlap(jobs, root, workers, mesh_workers, queue_depth, cache_dir,
+             ranks, far_field, design_frequency, order, collect):
+    """
+    Mesh the (index, point) jobs in a pool of mesh_workers processes
+    while workers processes solve the meshed ones, passing each
+    finished row to collect. At most queue_depth points are being
+    meshed or wait for a solver, which bounds the meshes on disk ahead
+    of the solvers.
+    """
+    context = multiprocessing.get_context('spawn')
+    jobs = iter(jobs)
+    meshing, solving = set(), set()
+    with ProcessPoolExecutor(max_workers=mesh_workers, mp_context=context,
+                             initializer=_init_worker) as meshers, \
+            ProcessPoolExecutor(max_workers=workers, mp_context=context,
+                                initializer=_init_worker) as solvers:
+
+        def feed():
+            while len(meshing) + max(len(solving) - workers, 0) < \
+                    queue_depth:
+                job = next(jobs, None)
+                if job is None:
+                    return
+                meshing.add(meshers.submit(
+                    mesh_point, *job, root, cache_dir, ranks, far_field,
+                    design_frequency, order))
+
+        feed()
+        while meshing or solving:
+            done, _ = wait(meshing | solving, return_when=FIRST_COMPLETED)
+            for f in done:
+                if f in meshing:
+                    meshing.remove(f)
+                    row = f.result()
+                    if row['error']:
+                        collect(row)
+                    else:
+                        solving.add(solvers.submit(
+                            solve_point, row, root, ranks, far_field))
+                else:
+                    solving.remove(f)
+                    collect(f.result())
+            feed()
+
+
+def run(points, root='sweep', workers=None, filename=None, cache_dir=None,
+        ranks=1, store=None, far_field=False, order=1, mesh_workers=0,
+        queue_depth=None, design_frequency=None):
+    """
+    Spread sweep points over a process pool and collect one row per point.
+    Rows come back in point order; failed points carry an 'error' message.
+    cache_dir=False disables the mesh cache. Each point uses ranks
+    cores, so workers * ranks should not exceed the core count.
+
+    With mesh_workers > 0, geometry and meshing run in a pool of that
+    many processes of their own (mesh_point) and the workers only
+    solve (solve_point), so meshing the next points overlaps solving
+    the current ones. queue_depth, by default mesh_workers + workers,
+    bounds the points meshed ahead of the solvers.
+
+    The air and PML spheres are sized for design_frequency (MHz), by
+    default the highest frequency of these points. Callers running
+    several batches of one study pass the band maximum, so every batch
+    solves the same domain.
+
+    With a store (results.ResultStore file name) every point already
+    solved there without error is read back instead of solved, and each
+    new row is appended as soon as its worker returns, so an interrupted
+    sweep resumes where it stopped. The store must hold results of the
+    same configuration(), ValueError otherwise.
+    """
+    if workers is None:
+        workers = os.cpu_count()
+    os.makedirs(root, exist_ok=True)
+    base = defaults()
+    points = [dict(base, **p) for p in points]
+    if design_frequency is None:
+        design_frequency = max((p['frequency'] for p in points),
+                               default=None)
+    rows = [None] * len(points)
+    if store is not None:
+        import results
+
+        store = results.ResultStore(store, config=configuration(
+            design_frequency, order, far_field))
+        for i, p in enumerate(points):
+            found = store.find(p)
+            if found is not None:
+                rows[i] = results.to_sweep_row(store.get([found])[0], i)
+        print(f'sweep: {len(points) - rows.count(None)} of {len(points)} '
+              f'points read from {store.filename}', file=sys.stderr)
+    jobs = [(i, p) for i, p in enumerate(points) if rows[i] is None]
+
+    def collect(row):
+        pattern = row.pop('pattern', None)
+        rows[row['index']] = row
+        if store is not None:
+            # indexed once at the end, not after every row
+            if pattern is None:
+                store.append([row], reindex=False)
+            else:
+                theta, phi, d = pattern
+                store.append([row], [d], (theta, phi), reindex=False)
+
+    context = multiprocessing.get_context('spawn')
+    try:
+        if mesh_workers > 0:
+            if queue_depth is None:
+                queue_depth = mesh_workers + workers
+            if queue_depth < 1:
+                raise ValueError('queue_depth must be at least 1')
+            _overlap(jobs, root, workers, mesh_workers, queue_depth,
+                     cache_dir, ranks, far_field, design_frequency, order,
+                     collect)
+        else:
+            with ProcessPoolExecutor(max_workers=workers, mp_context=context,
+                                     initializer=_init_worker) as pool:
+                futures = [pool.submit(evaluate, i, p, root, cache_dir,
+                                       ranks, far_field, design_frequency,
+                                       order)
+                           for i, p in jobs]
+                for f in as_completed(futures):
+                    collect(f.result())
+    finally:
+        if store is not None:
+            store.reindex()
+            store.close()
+    if filename is not None:
+        write_table(rows, filename)
+    return rows
+
+
+def write_table(rows, filename):
+    with open(filename, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=COLUMNS)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Parallel parameter sweep of the patch antenna')
+    for name in list(ONELAB_PARAMS) + list(MSPA_PARAMS):
+        parser.add_argument(f'--{name}', type=parse_values,
+                            help='comma separated list or start:stop:step')
+    parser.add_argument('-j', '--workers', type=int, default=None)
+    parser.add_argument('-d', '--root', default='sweep',
+                        help='directory for per-point builds')
+    parser.add_argument('-o', '--output', default='sweep.csv')
+    parser.add_argument('--cache', default=None,
+                        help='mesh cache directory')
+    parser.add_argument('--no-cache', dest='cache', action='store_false')
+    parser.add_argument('--ranks', type=int, default=1,
+                        help='MPI processes per point')
+    parser.add_argument('--store', default=None,
+                        help='HDF5 result store, solved points are '
+                             'skipped and new ones appended')
+    parser.add_argument('--far-field', action='store_true',
+                        help='also compute the far-field pattern')
+    parser.add_argument('--order', type=int, default=1, choices=[1, 2],
+                        help='edge element order')
+    parser.add_argument('--mesh-workers', type=int, default=0,
+                        help='mesh in a pool of this many processes of '
+                             'its own, the workers only solve')
+    parser.add_argument('--queue-depth', type=int, default=None,
+                        help='with --mesh-workers, points meshed ahead '
+                             'of the solvers')
+    args = parser.parse_args(argv)
+
+    axes = {name: getattr(args, name)
+            for name in list(ONELAB_PARAMS) + list(MSPA_PARAMS)
+            if getattr(args, name) is not None}
+    cores = (os.cpu_count() or 1) - args.mesh_workers
+    workers = args.workers or max(1, cores // args.ranks)
+    rows = run(make_grid(**axes), args.root, workers, args.output,
+               args.cache, args.ranks, args.store, args.far_field,
+               args.order, args.mesh_workers, args.queue_depth)
+    failed = [r for r in rows if r['error']]
+    for r in failed:
+        print(f"point {r['index']}: {r['error']}", file=sys.stderr)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,187 @@
+import numpy as np
+
+
+# symmetry planes through the origin by unit normal, the half model
+# keeps the side normal . x >= 0
+PLANES = {
+    'x=0': (1.0, 0.0, 0.0),
+    'y=0': (0.0, 1.0, 0.0),
+    'x=y': (1.0, -1.0, 0.0),
+    'x=-y': (1.0, 1.0, 0.0),
+}
+# boundary condition on the plane -> parity of e and h under reflection,
+# field(R p) = parity * R field(p)
+PARITY = {
+    'pmc': (1.0, -1.0),  # magnetic wall: e tangential, h normal
+    'pec': (-1.0, 1.0),  # electric wall: e normal, h tangential
+}
+
+
+def normal(plane):
+    if plane not in PLANES:
+        raise ValueError(f'unknown symmetry plane {plane}, '
+                         f'expected one of {", ".join(PLANES)}')
+    n = np.array(PLANES[plane], dtype=float)
+    return n / np.linalg.norm(n)
+
+
+def reflection(plane):
+    n = normal(plane)
+    return np.eye(3) - 2.0 * np.outer(n, n)
+
+
+def mirror_box(box, plane):
+    """Bounding box of the mirror image of a bounding box"""
+    corners = np.array([[x, y, z] for x in (box[0], box[3])
+                        for y in (box[1], box[4]) for z in (box[2], box[5])])
+    image = corners @ reflection(plane).T
+    return list(image.min(axis=0)) + list(image.max(axis=0))
+
+
+def check(plane, tol=1.0e-6):
+    """
+    Raise ValueError unless every surface of the current model has a
+    mirror image, a cheap test that the geometry is symmetric
+    """
+    from entity_index import EntityIndex
+
+    index = EntityIndex(2, tol)
+    for tag, box in zip(index.tags, index.boxes):
+        if not index.matching(mirror_box(box, plane)):
+            raise ValueError(f'geometry is not symmetric about {plane}: '
+                             f'surface {tag} has no mirror image')
+
+
+def cut_half(plane, radius):
+    """
+    Keep the normal . x >= 0 half of every volume of the current model.
+    Fragmenting with a half space box keeps the pieces conformal.
+    Returns {old volume tag: [kept volume tags]}.
+    """
+    from gmsh import model
+
+    occ = model.occ
+    volumes = occ.get_entities(3)
+    n = normal(plane)
+    size = 4.0 * radius
+    tool = occ.add_box(-size, -0.5 * size, -0.5 * size, size, size, size)
+    occ.rotate([(3, tool)], 0.0, 0.0, 0.0, 0.0, 0.0, 1.0,
+               np.arctan2(n[1], n[0]))
+    _, pieces = occ.fragment(volumes, [(3, tool)])
+    removed = set(pieces[-1])
+    kept = {}
+    for (_, tag), out in zip(volumes, pieces[:-1]):
+        kept[tag] = [t for d, t in out if (d, t) not in removed]
+    occ.remove(sorted(removed), recursive=True)
+    occ.synchronize()
+    return kept
+
+
+def clip(box, plane):
+    """
+    Bounding box of the kept part of an axis aligned box, exact for
+    the x=0 and y=0 planes only
+    """
+    n = normal(plane)
+    axis = int(np.argmax(np.abs(n)))
+    if abs(n[axis]) != 1.0:
+        raise ValueError(f'cannot clip a box by the {plane} plane')
+    box = list(box)
+    box[axis] = max(box[axis], 0.0)
+    return box
+
+
+def on_plane(plane, dim=2, tol=1.0e-6):
+    """Tags of the entities of dim lying on the symmetry plane"""
+    from entity_index import EntityIndex
+    from gmsh import model
+
+    n = normal(plane)
+    index = EntityIndex(dim, tol)
+    tags = []
+    for tag, box in zip(index.tags, index.boxes):
+        if abs(np.dot(n, box[:3])) <= tol and abs(np.dot(n, box[3:])) <= tol:
+            com = model.occ.get_center_of_mass(dim, int(tag))
+            if abs(np.dot(n, com)) <= tol:
+                tags.append(int(tag))
+    return tags
+
+
+def outer_face(volume, plane, tol=1.0e-6):
+    """
+    The largest boundary surface of volume off the symmetry plane, the
+    outer sphere of a spherical shell (bounding boxes of curved OCC
+    surfaces are too loose to tell the two spheres apart)
+    """
+    from gmsh import model
+
+    flat = set(on_plane(plane, 2, tol))
+    faces = [tag for _, tag in model.get_boundary([volume], oriented=False)
+             if tag not in flat]
+    if not faces:
+        raise ValueError(f'{volume} has no boundary off the plane')
+    return (2, max(faces, key=lambda tag: model.occ.get_mass(2, tag)))
+
+
+def unfold(points, values, plane, parity):
+    """
+    Points (..., 3) and vector values (..., 3) of one half completed with
+    their mirror images: field(R p) = parity * R field(p)
+    """
+    r = reflection(plane)
+    points = np.asarray(points)
+    values = np.asarray(values)
+    return (np.concatenate([points, points @ r.T]),
+            np.concatenate([values, parity * (values @ r.T)]))
+
+
+def unfold_surface(points, ds, e, h, plane, condition='pmc'):
+    """
+    Near field samples on the half of a closed surface (far_field.surface
+    layout, e and h (P, 3) or (F, P, 3)) completed to the full surface
+    """
+    pe, ph = PARITY[condition]
+    r = reflection(plane)
+    points2, e2 = unfold(points, np.moveaxis(np.asarray(e), -2, 0), plane,
+                         pe)
+    _, h2 = unfold(points, np.moveaxis(np.asarray(h), -2, 0), plane, ph)
+    # mirrored outward normals stay outward
+    ds2 = np.concatenate([ds, np.asarray(ds) @ r.T])
+    return points2, ds2, np.moveaxis(e2, 0, -2), np.moveaxis(h2, 0, -2)
+
+
+def phi_range(plane):
+    """Start and span of phi covering the kept half of a sphere"""
+    n = normal(plane)
+    start = np.arctan2(n[1], n[0]) - 0.5 * np.pi
+    return start, np.pi
+
+
+def write_view(filename, store, plane, condition='pmc', field='e',
+               name=None):
+    """
+    Full space list based view of a vector FieldStore of the half
+    model: the elements as solved plus their mirror images, real and
+    imaginary parts as time steps 0 and 1 like GetDP's harmonic output
+    """
+    if store.kind[0] != 'V':
+        raise ValueError(f'{store.name}: {store.kind} is not a vector view')
+    parity = PARITY[condition][0 if field == 'e' else 1]
+    r = reflection(plane)
+    with open(filename, 'w') as f:
+        f.write(f'View "{name or store.name}" {{\n')
+        for s in store.chunks():
+            coords = store.element_nodes(s)
+            values = np.asarray(store.values[s])
+            n = values.shape[1]
+            for xyz, v in ((coords, values),
+                           (coords @ r.T, parity * (values @ r.T))):
+                rows = np.concatenate(
+                    [xyz.reshape(len(xyz), -1),
+                     v.real.reshape(len(v), -1),
+                     v.imag.reshape(len(v), -1)], axis=1)
+                f.write(''.join(
+                    f'{store.kind}(' + ','.join(map(repr, row[:3 * n])) +
+                    '){' + ','.join(map(repr, row[3 * n:])) + '};\n'
+                    for row in rows))
+        f.write('};\n')
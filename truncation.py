@@ -0,0 +1,43 @@
+from scipy.constants import speed_of_light
+import numpy as np
+
+
+# default clearance between the antenna and the PML and PML thickness,
+# in wavelengths at the highest frequency of interest
+AIR_FRACTION = 0.15
+PML_FRACTION = 0.10
+# near field sphere, this far from the antenna towards the PML
+NEAR_FIELD_FRACTION = 0.75
+
+
+def wavelength(frequency):
+    """Free space wavelength (m) at the highest of the frequencies (MHz)"""
+    return speed_of_light / (np.max(frequency) * 1.0e6)
+
+
+def enclosing_radius(box):
+    """Radius of the sphere about the origin enclosing a bounding box"""
+    corners = np.array([[x, y, z] for x in (box[0], box[3])
+                        for y in (box[1], box[4]) for z in (box[2], box[5])])
+    return float(np.linalg.norm(corners, axis=1).max())
+
+
+def radii(box, frequency, air_fraction=AIR_FRACTION,
+          pml_fraction=PML_FRACTION):
+    """
+    Spherical truncation of the domain around an antenna bounding box
+    for the (highest) frequency in MHz: the antenna radius r_antenna,
+    the air sphere r_air where the PML starts, the outer PML radius
+    r_pml and the near field sphere r_near in between, in metres
+    """
+    if air_fraction <= 0.0 or pml_fraction <= 0.0:
+        raise ValueError('air and PML fractions must be positive')
+    lam = wavelength(frequency)
+    r_antenna = enclosing_radius(box)
+    r_air = r_antenna + air_fraction * lam
+    return {
+        'r_antenna': r_antenna,
+        'r_near': r_antenna + NEAR_FIELD_FRACTION * (r_air - r_antenna),
+        'r_air': r_air,
+        'r_pml': r_air + pml_fraction * lam,
+    }
@@ -0,0 +1,398 @@
+from sweep import MSPA_PARAMS, ONELAB_PARAMS
+import argparse
+import asyncio
+import itertools
+import json
+import multiprocessing
+import os
+import shutil
+import signal
+import sys
+import tempfile
+import time
+import traceback
+
+
+SOCKET = os.path.join(tempfile.gettempdir(), 'mspa-worker.sock')
+SOURCE_DIR = os.path.dirname(os.path.abspath(__file__))
+COMMANDS = ('serve', 'submit', 'cancel', 'status', 'shutdown')
+# events after which a job is gone from the daemon
+FINAL = ('result', 'error', 'timeout', 'cancelled')
+
+
+def _session(conn, directory, frequency):
+    """
+    Body of a worker process: one gmsh session with its onelab
+    parameters, antenna and pipeline, kept across the jobs received on
+    conn until None. Each job only redoes the stages it changes, so a
+    new frequency or epr runs getdp alone.
+    """
+    os.setpgrp()  # a timeout kills the whole group, getdp included
+    os.makedirs(directory, exist_ok=True)
+    shutil.copy(os.path.join(SOURCE_DIR, 'defines.pro'), directory)
+    os.chdir(directory)
+
+    from gmsh import onelab
+    from mesh_cache import MeshCache
+    import gmsh
+    import mstrip
+    import pipeline
+
+    mstrip.setup_onelab()
+    antenna = mstrip.Mspa(mstrip.MODEL_NAME, lazy=True, frequency=frequency)
+    base = dict(antenna.mesh_settings)
+    pipe = pipeline.Pipeline()
+    cache = MeshCache()
+    defaults = {'frequency': mstrip.FREQUENCY, 'epr': mstrip.EPR}
+    conn.send({'event': 'ready', 'pid': os.getpid()})
+    try:
+        while True:
+            job = conn.recv()
+            if job is None:
+                break
+            t0 = time.perf_counter()
+            pipe.ran, pipe.reused = [], []
+            try:
+                for name, path in ONELAB_PARAMS.items():
+                    onelab.set_number(path, [job.get(name, defaults[name])])
+                params = job.get('params', {})
+                unknown = [name for name in params if name not in MSPA_PARAMS]
+                if unknown:
+                    raise ValueError(f'unknown Mspa parameters {unknown}, '
+                                     f'expected {", ".join(MSPA_PARAMS)}')
+                # an unchanged value would still rebuild the geometry
+                antenna.update(**{name: value for name, value in
+                                  params.items()
+                                  if getattr(antenna, name) != value})
+                order = job.get('order', 1)
+                settings = mstrip.order_mesh_settings(base, order)
+                if settings != antenna.mesh_settings:
+                    antenna.mesh_settings = settings
+                    antenna.refresh()
+                r = pipeline.build(antenna, pipe, cache,
+                                   output=job.get('output', 's11'),
+                                   order=order,
+                                   solver=job.get('solver', 'direct'))
+                message = {'event': 'result', 'result': {
+                    's11': r['s11'],
+                    'y': [r['y'].real, r['y'].imag],
+                    'wavenumber': r['wavenumber'],
+                    'directivity': r['directivity'],
+                    'converged': r['solver']['converged'],
+                    'ran': pipe.ran,
+                    'reused': pipe.reused,
+                }}
+            except Exception:
+                message = {'event': 'error', 'error': traceback.format_exc(
+                    limit=1).strip().splitlines()[-1]}
+            message['wall'] = time.perf_counter() - t0
+            conn.send(message)
+    finally:
+        gmsh.finalize()
+
+
+class Worker(object):
+    '''
+    A warm session process (_session) in its own directory
+
+    Jobs run one at a time. Killing the process, on a timeout or a
+    cancellation, takes its getdp with it, and start() brings up a
+    fresh session in the same directory.
+    '''
+
+    def __init__(self, directory, frequency):
+        super().__init__()
+        self.directory = directory
+        self.frequency = frequency
+        self.process = None
+        self.conn = None
+
+    async def start(self):
+        context = multiprocessing.get_context('spawn')
+        self.conn, child = context.Pipe()
+        self.process = context.Process(
+            target=_session, args=(child, self.directory, self.frequency),
+            daemon=True)
+        self.process.start()
+        child.close()
+        return await self._receive()
+
+    async def _receive(self):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.conn.recv)
+
+    async def run(self, job):
+        self.conn.send(job)
+        return await self._receive()
+
+    def kill(self):
+        try:
+            os.killpg(self.process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        self.process.join()
+        self.conn.close()
+
+    async def stop(self):
+        self.conn.send(None)
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.process.join)
+        self.conn.close()
+
+
+class Daemon(object):
+    '''
+    Local job server in front of warm worker sessions
+
+    Clients send JSON lines on the unix socket: {"op": "submit", "id",
+    "params": {Mspa parameters}, "frequency", "epr", "output", "order",
+    "solver", "timeout"} queues a job, {"op": "cancel", "id"} drops a
+    queued job or kills a running one, {"op": "status"} and
+    {"op": "shutdown"}. Each job's events (queued, started, then one
+    of FINAL) stream back on the connection that submitted it, as they
+    happen. Every worker takes the next queued job as soon as it is
+    free. A running job is stopped after its timeout (seconds, default
+    timeout), its worker restarted.
+    '''
+
+    def __init__(self, path=SOCKET, workers=1, root='worker',
+                 frequency=None, timeout=None):
+        super().__init__()
+        self.path = path
+        self.root = os.path.abspath(root)
+        self.frequency = frequency
+        self.timeout = timeout
+        self.workers = [Worker(os.path.join(self.root, f'worker_{i}'),
+                               frequency) for i in range(workers)]
+        self.jobs = {}
+        self.queue = None
+        self.stopping = None
+        self._ids = itertools.count()
+
+    async def serve(self):
+        self.queue = asyncio.Queue()
+        self.stopping = asyncio.Event()
+        await asyncio.gather(*(w.start() for w in self.workers))
+        server = await asyncio.start_unix_server(self.handle, path=self.path)
+        consumers = [asyncio.create_task(self.consume(w))
+                     for w in self.workers]
+        print(f'worker: {len(self.workers)} sessions on {self.path}',
+              file=sys.stderr)
+        try:
+            async with server:
+                await self.stopping.wait()
+        finally:
+            for task in consumers:
+                task.cancel()
+            await asyncio.gather(*consumers, return_exceptions=True)
+            for w in self.workers:
+                w.kill()
+            if os.path.exists(self.path):
+                os.remove(self.path)
+
+    async def send(self, writer, message):
+        try:
+            writer.write((json.dumps(message) + '\n').encode())
+            await writer.drain()
+        except (ConnectionError, RuntimeError):
+            pass  # the client went away, the job still completes
+
+    async def finish(self, job_id, message):
+        state = self.jobs.pop(job_id, None)
+        if state is not None:
+            await self.send(state['writer'], dict(message, id=job_id))
+
+    async def consume(self, worker):
+        while True:
+            job_id = await self.queue.get()
+            state = self.jobs.get(job_id)
+            if state is None:
+                continue  # cancelled while queued
+            await self.send(state['writer'],
+                            {'id': job_id, 'event': 'started'})
+            if job_id not in self.jobs:
+                continue  # cancelled while the event was sent
+            timeout = state['job'].get('timeout', self.timeout)
+            state['task'] = asyncio.create_task(
+                asyncio.wait_for(worker.run(state['job']), timeout))
+            try:
+                message = await state['task']
+            except asyncio.TimeoutError:
+                message = {'event': 'timeout'}
+            except asyncio.CancelledError:
+                if not state.get('cancelled'):
+                    raise  # the daemon is shutting down
+                message = {'event': 'cancelled'}
+            except Exception as e:
+                # the session died (crash, out of memory), replace it
+                message = {'event': 'error',
+                           'error': f'worker session lost: {e!r}'}
+            else:
+                await self.finish(job_id, message)
+                continue
+            worker.kill()
+            await self.finish(job_id, message)
+            await worker.start()
+
+    async def submit(self, request, writer):
+        job_id = str(request.get('id', next(self._ids)))
+        if job_id in self.jobs:
+            await self.send(writer, {'id': job_id, 'event': 'error',
+                                     'error': 'duplicate job id'})
+            return
+        self.jobs[job_id] = {'job': request, 'writer': writer}
+        await self.send(writer, {'id': job_id, 'event': 'queued',
+                                 'position': self.queue.qsize()})
+        self.queue.put_nowait(job_id)
+
+    async def cancel(self, request, writer):
+        job_id = str(request.get('id'))
+        state = self.jobs.get(job_id)
+        if state is None:
+            await self.send(writer, {'id': job_id, 'event': 'error',
+                                     'error': 'no such job'})
+        elif 'task' in state:
+            state['cancelled'] = True
+            state['task'].cancel()
+        else:
+            await self.finish(job_id, {'event': 'cancelled'})
+        if state is not None and state['writer'] is not writer:
+            await self.send(writer, {'id': job_id, 'event': 'cancelling'})
+
+    async def handle(self, reader, writer):
+        while not self.stopping.is_set():
+            line = await reader.readline()
+            if not line:
+                break
+            try:
+                request = json.loads(line)
+                op = request.get('op', 'submit')
+            except (ValueError, AttributeError):
+                await self.send(writer, {'event': 'error',
+                                         'error': 'not a JSON object'})
+                continue
+            if op == 'submit':
+                await self.submit(request, writer)
+            elif op == 'cancel':
+                await self.cancel(request, writer)
+            elif op == 'status':
+                await self.send(writer, {
+                    'event': 'status',
+                    'workers': len(self.workers),
+                    'queued': self.queue.qsize(),
+                    'running': [i for i, s in self.jobs.items()
+                                if 'task' in s],
+                })
+            elif op == 'shutdown':
+                self.stopping.set()
+            else:
+                await self.send(writer, {'event': 'error',
+                                         'error': f'unknown op {op}, '
+                                         f'expected submit, cancel, '
+                                         f'status or shutdown'})
+        writer.close()
+
+
+async def stream(jobs, path=SOCKET):
+    """
+    Submit jobs (dicts, see Daemon) to a running daemon and yield their
+    events as they arrive, until every job reached a FINAL event
+    """
+    reader, writer = await asyncio.open_unix_connection(path)
+    pending = set()
+    try:
+        for i, job in enumerate(jobs):
+            job = dict(job, op='submit')
+            job.setdefault('id', f'{os.getpid()}-{i}')
+            pending.add(str(job['id']))
+            writer.write((json.dumps(job) + '\n').encode())
+        await writer.drain()
+        while pending:
+            line = await reader.readline()
+            if not line:
+                raise ConnectionError('worker daemon closed the connection')
+            message = json.loads(line)
+            if message['event'] in FINAL:
+                pending.discard(message.get('id'))
+            yield message
+    finally:
+        writer.close()
+
+
+async def request(message, path=SOCKET):
+    """Send one control message, return the reply (None for shutdown)"""
+    reader, writer = await asyncio.open_unix_connection(path)
+    try:
+        writer.write((json.dumps(message) + '\n').encode())
+        await writer.drain()
+        line = await reader.readline()
+        return json.loads(line) if line else None
+    finally:
+        writer.close()
+
+
+def _read_jobs(filenames):
+    """Jobs as JSON lines from the files, or standard input"""
+    jobs = []
+    for filename in filenames or ['-']:
+        f = sys.stdin if filename == '-' else open(filename)
+        with f:
+            jobs += [json.loads(line) for line in f if line.strip()]
+    return jobs
+
+
+async def _print_events(jobs, path):
+    failed = 0
+    async for message in stream(jobs, path):
+        print(json.dumps(message), flush=True)
+        if message['event'] in FINAL and message['event'] != 'result':
+            failed += 1
+    return failed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Persistent patch antenna workers: serve keeps warm '
+                    'gmsh sessions, submit streams the results of JSON '
+                    'job lines back')
+    parser.add_argument('command', choices=COMMANDS)
+    parser.add_argument('args', nargs='*',
+                        help='submit: job files (default standard input), '
+                             'cancel: job ids')
+    parser.add_argument('--socket', default=SOCKET)
+    parser.add_argument('-j', '--workers', type=int, default=1,
+                        help='warm sessions, jobs solved concurrently')
+    parser.add_argument('-d', '--root', default='worker',
+                        help='directory for the sessions')
+    parser.add_argument('--design-frequency', type=float, default=None,
+                        help='MHz, sizes the air and PML spheres of '
+                             'every job')
+    parser.add_argument('--timeout', type=float, default=None,
+                        help='seconds a job may run, unless it sets its own')
+    args = parser.parse_args(argv)
+
+    if args.command == 'serve':
+        import mstrip
+
+        daemon = Daemon(args.socket, args.workers, args.root,
+                        args.design_frequency or mstrip.FREQUENCY,
+                        args.timeout)
+        asyncio.run(daemon.serve())
+        return 0
+    if args.command == 'submit':
+        failed = asyncio.run(_print_events(_read_jobs(args.args),
+                                           args.socket))
+        return 1 if failed else 0
+    if args.command == 'cancel':
+        for job_id in args.args:
+            print(json.dumps(asyncio.run(request(
+                {'op': 'cancel', 'id': job_id}, args.socket))))
+        return 0
+    reply = asyncio.run(request({'op': args.command}, args.socket))
+    if reply is not None:
+        print(json.dumps(reply))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())